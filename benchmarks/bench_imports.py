@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""
+Time taken to import Coaster's modules, each in a new interpreter, as seen by
+command line tools and short-lived workers. Run from the repository root::
+
+    python benchmarks/bench_imports.py
+"""
+
+import sys
+import os
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+MODULES = ['coaster', 'coaster.utils', 'coaster.gfm', 'coaster.sqlalchemy', 'coaster.views',
+    'coaster.app']
+
+CODE = 'from time import time; start = time(); import %s; print(time() - start)'
+
+
+def import_time(module, number=5):
+    return min(float(subprocess.check_output([sys.executable, '-c', CODE % module], cwd=ROOT))
+        for i in range(number))
+
+
+def main():
+    for module in MODULES:
+        print "%-20s %8.1f ms" % (module, import_time(module) * 1000)
+
+
+if __name__ == '__main__':
+    main()
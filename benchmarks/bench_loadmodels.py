@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Per-request overhead of the load_models decorator, compared with loading the
+same instances with the same single JOINed query written by hand, both built for
+each request and baked (compiled once). Run from the repository root::
+
+    python benchmarks/bench_loadmodels.py
+"""
+
+import sys
+import os
+from timeit import repeat
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask, abort
+from sqlalchemy import Column, Integer, Unicode, ForeignKey, UniqueConstraint, bindparam
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import relationship, synonym
+from coaster.sqlalchemy import BaseNameMixin, BaseScopedNameMixin, BaseScopedIdNameMixin
+from coaster.views import load_models
+from coaster.db import db
+
+app = Flask(__name__)
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+db.init_app(app)
+
+
+class Organization(BaseNameMixin, db.Model):
+    __tablename__ = 'organization'
+
+
+class Event(BaseScopedNameMixin, db.Model):
+    __tablename__ = 'event'
+    organization_id = Column(Integer, ForeignKey('organization.id'), nullable=False)
+    organization = relationship(Organization)
+    parent = synonym('organization')
+    __table_args__ = (UniqueConstraint('organization_id', 'name'),)
+
+
+class Session(BaseScopedIdNameMixin, db.Model):
+    __tablename__ = 'session'
+    event_id = Column(Integer, ForeignKey('event.id'), nullable=False)
+    event = relationship(Event)
+    parent = synonym('event')
+    __table_args__ = (UniqueConstraint('event_id', 'url_id'),)
+
+
+@load_models(
+    (Organization, {'name': 'organization'}, 'organization'),
+    (Event, {'name': 'event', 'parent': 'organization'}, 'event'),
+    (Session, {'url_name': 'session', 'parent': 'event'}, 'session'))
+def decorated_view(organization, event, session):
+    return session
+
+
+def joined_query(session):
+    return session.query(Organization, Event, Session).filter(
+        Event.organization_id == Organization.id, Session.event_id == Event.id,
+        Organization.name == bindparam('organization'), Event.name == bindparam('event'),
+        Session.url_id == bindparam('url_id'))
+
+bakery = baked.bakery()
+
+
+def manual_view(organization, event, session):
+    url_id = int(session.split('-')[0])
+    row = joined_query(db.session()).params(organization=organization, event=event,
+        url_id=url_id).first()
+    if row is None:
+        abort(404)
+    return row[2]
+
+
+def baked_view(organization, event, session):
+    url_id = int(session.split('-')[0])
+    row = bakery(joined_query)(db.session()).params(organization=organization, event=event,
+        url_id=url_id).first()
+    if row is None:
+        abort(404)
+    return row[2]
+
+
+def main(number=2000):
+    with app.test_request_context():
+        db.create_all()
+        organization = Organization(title=u"Organization")
+        event = Event(title=u"Event", organization=organization)
+        db.session.add(Session(title=u"Session", event=event))
+        db.session.commit()
+        kwargs = {'organization': u'organization', 'event': u'event', 'session': u'1-session'}
+        assert decorated_view(**kwargs) is manual_view(**kwargs) is baked_view(**kwargs)
+
+        for name, func in [('load_models', decorated_view), ('joined query', manual_view),
+                ('baked query', baked_view)]:
+            best = min(repeat(lambda: func(**kwargs), number=number, repeat=3))
+            print "%-16s %8.1f us per request" % (name, best / number * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Time an error log takes in the request thread with QueueHandler and
+LocalVarFormatter, which copies shortened values of local variables there and
+formats the traceback in the listener thread. For comparison, the time to take
+the full repr of every local variable, as was done in the request thread before,
+and the time the listener thread takes. The failing view holds a listing of
+rows, as views often do. Run from the repository root::
+
+    python benchmarks/bench_logging.py
+"""
+
+import sys
+import os
+import logging
+from functools import partial
+from timeit import repeat
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from coaster.logging import LocalVarFormatter, QueueHandler
+
+
+def view():
+    rows = [{'id': id, 'title': u'Item %d' % id, 'tags': range(10)} for id in range(1000)]  # NOQA
+    raise ValueError("Failed")
+
+
+def full_reprs(exc_info):
+    tb = exc_info[2]
+    while tb.tb_next:
+        tb = tb.tb_next
+    frame = tb.tb_frame
+    while frame:
+        for value in frame.f_locals.values():
+            repr(value)
+        frame = frame.f_back
+
+
+def main(number=200):
+    try:
+        view()
+    except ValueError:
+        exc_info = sys.exc_info()
+    record = logging.LogRecord('bench', logging.ERROR, __file__, 0, "Error", None, exc_info)
+    formatter = LocalVarFormatter()
+    handler = QueueHandler([])
+    handler.setFormatter(formatter)
+    for name, func in [
+            ('QueueHandler.prepare', lambda: handler.prepare(logging.makeLogRecord(record.__dict__))),
+            ('full reprs', lambda: full_reprs(exc_info)),
+            # Not a local variable of this frame, which would be copied too
+            ('listener thread', partial(formatter.formatCaptured, formatter.captureException(exc_info)))]:
+        best = min(repeat(func, number=number, repeat=3))
+        print "%-20s %8.2f us per record" % (name, best / number * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput and payload size of MessagePack responses compared with jsonp, for
+a typical API listing. Run from the repository root::
+
+    python benchmarks/bench_msgpack.py
+"""
+
+import sys
+import os
+from datetime import datetime, timedelta
+from decimal import Decimal
+from timeit import repeat
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask
+from coaster import msgpack
+from coaster.views import jsonp, msgpackify
+
+app = Flask(__name__)
+
+
+def listing(count=500):
+    start = datetime(2014, 7, 1)
+    return {
+        'total': count,
+        'items': [{
+            'id': number,
+            'name': u'session-%d' % number,
+            'title': u'Session %d: A talk about things ✓' % number,
+            'start': start + timedelta(minutes=30 * number),
+            'price': Decimal('1200.50'),
+            'speakers': [u'Speaker %d' % number, u'Speaker %d' % (number + 1)],
+            'featured': number % 7 == 0,
+            } for number in xrange(count)],
+        }
+
+
+def main(number=100):
+    data = listing()
+    c_msgpack = msgpack._msgpack
+
+    def pure_msgpackify(data):
+        msgpack._msgpack = None
+        try:
+            return msgpackify(data)
+        finally:
+            msgpack._msgpack = c_msgpack
+
+    handlers = [('jsonp', jsonp), ('msgpack (Python)', pure_msgpackify)]
+    if c_msgpack is not None:
+        handlers.append(('msgpack (C)', msgpackify))
+    with app.test_request_context():
+        for name, handler in handlers:
+            size = len(handler(data).get_data())
+            best = min(repeat(lambda: handler(data).get_data(), number=number, repeat=3))
+            print "%-18s %8.2f ms per response, %7d bytes" % (name, best / number * 1e3, size)
+
+
+if __name__ == '__main__':
+    main()
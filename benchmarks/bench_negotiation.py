@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Per-request cost of choosing a template in render_with from the Accept header,
+with and without the memoized negotiation. Run from the repository root::
+
+    python benchmarks/bench_negotiation.py
+"""
+
+import sys
+import os
+from timeit import repeat
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from coaster import views
+
+negotiate = views.__dict__['__negotiate_mimetype']
+best_mimetype = views.__dict__['__best_mimetype']
+
+MIMETYPES = ('*/*', 'application/json', 'text/json', 'text/x-json', 'text/plain')
+
+ACCEPT_HEADERS = [
+    # Browsers
+    'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    # XMLHttpRequest
+    'application/json, text/javascript, */*; q=0.01',
+    # curl and API clients
+    '*/*',
+    'application/json',
+    ]
+
+
+def splitting(accept, mimetypes):
+    # The original render_with implementation, which ignores quality values
+    for mimetype in [m.strip() for m in accept.replace(';', ',').split(',') if '/' in m]:
+        if mimetype in mimetypes:
+            return mimetype
+    if '*/*' in mimetypes:
+        return '*/*'
+
+
+def main(number=20000):
+    for name, func in [
+            ('string splitting', splitting),
+            ('negotiation', negotiate),
+            ('memoized', best_mimetype)]:
+        best = min(repeat(lambda: [func(accept, MIMETYPES) for accept in ACCEPT_HEADERS],
+            number=number, repeat=3))
+        print "%-18s %8.2f us per request" % (name, best / number / len(ACCEPT_HEADERS) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
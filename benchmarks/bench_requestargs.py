@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+Per-call overhead of the requestargs decorator. Run from the repository root::
+
+    python benchmarks/bench_requestargs.py
+"""
+
+import sys
+import os
+from timeit import repeat
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask
+from coaster.views import requestargs
+
+app = Flask(__name__)
+
+
+@requestargs('query', ('page', int), ('tags[]', int))
+def search(query, page=1, tags=None):
+    return query, page, tags
+
+
+def plain(query, page=1, tags=None):
+    return query, page, tags
+
+
+def main(number=20000):
+    with app.test_request_context('/?query=python&page=2&tags=1&tags=2'):
+        assert search() == (u'python', 2, [1, 2])
+        for name, func in [('requestargs', search), ('undecorated', lambda: plain(u'python'))]:
+            best = min(repeat(func, number=number, repeat=3))
+            print "%-12s %8.2f us per call" % (name, best / number * 1e6)
+
+
+if __name__ == '__main__':
+    main()
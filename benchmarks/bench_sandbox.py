@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Time taken to render a listing template with Flask, with Jinja2's sandbox and
+with SandboxedFlask, with and without the listing's attributes declared safe
+with allow_attributes. Run from the repository root::
+
+    python benchmarks/bench_sandbox.py
+"""
+
+import sys
+import os
+from timeit import repeat
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask, render_template_string
+from jinja2.sandbox import SandboxedEnvironment
+from coaster.app import SandboxedFlask
+
+TEMPLATE = u'''
+<ul>
+{% for item in items %}
+  <li id="item-{{ item.id }}" class="{{ item.status.title }}">
+    <a href="{{ item.url }}">{{ item.title }}</a> by {{ item.user.fullname }}
+    {% if item.description %}<p>{{ item.description.strip() }}</p>{% endif %}
+  </li>
+{% endfor %}
+</ul>
+'''
+
+
+class Status(object):
+    def __init__(self, title):
+        self.title = title
+
+
+class User(object):
+    def __init__(self, fullname):
+        self.fullname = fullname
+
+
+class Item(object):
+    def __init__(self, id):
+        self.id = id
+        self.title = u'Item %d' % id
+        self.url = u'/items/%d' % id
+        self.description = u' Description of item %d ' % id
+        self.status = Status(u'published')
+        self.user = User(u'User %d' % (id % 10))
+
+
+class JinjaSandboxedFlask(Flask):
+    def create_jinja_environment(self):
+        # Autoescaping as in Flask and SandboxedFlask
+        options = dict(self.jinja_options)
+        if 'autoescape' not in options:
+            options['autoescape'] = self.select_jinja_autoescape
+        rv = SandboxedEnvironment(loader=self.create_global_jinja_loader(), **options)
+        rv.globals.update(Flask.create_jinja_environment(self).globals)
+        return rv
+
+
+def main(number=200):
+    items = [Item(id) for id in range(100)]
+    for name, app_class, allowed in [
+            ('Flask', Flask, False),
+            ('Jinja2 sandbox', JinjaSandboxedFlask, False),
+            ('SandboxedFlask', SandboxedFlask, False),
+            ('+ allowed', SandboxedFlask, True)]:
+        app = app_class(__name__)
+        if allowed:
+            app.jinja_env.allow_attributes(Item, ['id', 'title', 'url', 'description', 'status', 'user'])
+            app.jinja_env.allow_attributes(Status, ['title'])
+            app.jinja_env.allow_attributes(User, ['fullname'])
+        with app.test_request_context():
+            best = min(repeat(lambda: render_template_string(TEMPLATE, items=items),
+                number=number, repeat=3))
+        print "%-16s %8.2f ms per render" % (name, best / number * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Cost of serializing a listing of models for JSON output: dictionaries built by
+hand from fully loaded instances, compared with Query.serialized(). Run from the
+repository root::
+
+    python benchmarks/bench_serialize.py
+"""
+
+import sys
+import os
+from timeit import repeat
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask
+from sqlalchemy import Column
+from coaster.sqlalchemy import BaseNameMixin, MarkdownColumn, JsonDict
+from coaster.db import db
+
+app = Flask(__name__)
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+db.init_app(app)
+
+
+class Proposal(BaseNameMixin, db.Model):
+    __tablename__ = 'proposal'
+    serialize_fields = ('id', 'name', 'title')
+    description = MarkdownColumn('description')
+    data = Column(JsonDict)
+
+
+def by_hand():
+    return [{'id': p.id, 'name': p.name, 'title': p.title} for p in Proposal.query.all()]
+
+
+def serialized():
+    return list(Proposal.query.serialized())
+
+
+def main(number=20, count=2000):
+    with app.test_request_context():
+        db.create_all()
+        description = u'A *long* description. ' * 100
+        for number_ in xrange(count):
+            db.session.add(Proposal(name=u'proposal-%d' % number_, title=u'Proposal %d' % number_,
+                description=description, data={u'votes': range(50)}))
+        db.session.commit()
+        db.session.expunge_all()
+        assert by_hand() == serialized()
+
+        for name, func in [('by hand', by_hand), ('serialized', serialized)]:
+            def run():
+                func()
+                db.session.expunge_all()
+            best = min(repeat(run, number=number, repeat=3))
+            print "%-12s %8.2f ms per listing of %d" % (name, best / number * 1e3, count)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,34 @@
 # -*- coding: utf-8 -*-
 
+from __future__ import absolute_import
 from os import environ
+import os
 import sys
+import errno
+import shutil
+import tempfile
+from glob import glob
+from collections import OrderedDict
+from inspect import getmro
+from threading import Lock, local
+from time import time
 from warnings import warn
+import jinja2
+from jinja2 import FileSystemBytecodeCache, Template, TemplateError, nodes
+from jinja2.exceptions import SecurityError
 from jinja2.sandbox import SandboxedEnvironment as BaseSandboxedEnvironment
+from werkzeug.datastructures import ImmutableDict
+from werkzeug.exceptions import InternalServerError
 from flask import Flask, url_for, get_flashed_messages, request, session, g
 try:
     from flask.helpers import _tojson_filter
 except ImportError:
     from flask.json import tojson_filter as _tojson_filter
 import coaster.logging
+from coaster.cache import FragmentCacheExtension
 
-__all__ = ['SandboxedFlask', 'init_app']
+__all__ = ['SandboxedFlask', 'SandboxBudgetExceeded', 'TemplateBytecodeCache', 'init_app', 'precompile_templates',
+    'warmup', 'warmup_steps']
 
 _additional_config = {
     'dev': 'development.py',
@@ -23,18 +40,231 @@ _additional_config = {
     }
 
 
+class SandboxBudgetExceeded(SecurityError, InternalServerError):
+    """
+    A sandboxed template exceeded one of its limits, such as the time allowed
+    for rendering. See :class:`SandboxedEnvironment`.
+    """
+    response = None
+
+    def __init__(self, message, limit):
+        SecurityError.__init__(self, message)
+        self.limit = limit
+
+
+class _RenderBudget(object):
+    # Resources used by one render of a sandboxed template
+    def __init__(self, environment):
+        self.environment = environment
+        if environment.max_render_time is not None:
+            self.deadline = time() + environment.max_render_time
+        else:
+            self.deadline = None
+        self.operations = 0
+        self.output_size = 0
+        self.depth = 0
+        self.paused = None
+
+    def pause(self):
+        if self.deadline is not None:
+            self.paused = time()
+
+    def resume(self):
+        # Time spent paused, as while a streamed render waits on the client,
+        # doesn't count
+        if self.deadline is not None:
+            self.deadline += time() - self.paused
+
+    def exceeded(self, limit):
+        environment = self.environment
+        with environment._budget_stats_lock:
+            environment.budget_stats[limit] += 1
+        environment.app.logger.warning("Sandboxed template exceeded its %s limit" % limit)
+        raise SandboxBudgetExceeded("Template exceeded its %s limit" % limit, limit)
+
+    def check_time(self):
+        if self.deadline is not None and time() > self.deadline:
+            self.exceeded('time')
+
+    def tick(self):
+        self.operations += 1
+        max_operations = self.environment.max_operations
+        if max_operations is not None and self.operations > max_operations:
+            self.exceeded('operations')
+        if not self.operations & 0x3f:
+            self.check_time()
+
+    def output(self, size):
+        self.output_size += size
+        max_output_size = self.environment.max_output_size
+        if max_output_size is not None and self.output_size > max_output_size:
+            self.exceeded('output')
+        self.check_time()
+
+    def iterate(self, iterable):
+        for item in iterable:
+            self.tick()
+            yield item
+
+
+class SandboxedTemplate(Template):
+    """
+    Template for :class:`SandboxedEnvironment` that renders within the
+    environment's limits.
+    """
+    @classmethod
+    def _from_namespace(cls, environment, namespace, globals):
+        template = super(SandboxedTemplate, cls)._from_namespace(environment, namespace, globals)
+        if environment.budgeted:
+            root_render_func = template.root_render_func
+            template.root_render_func = lambda context: environment._budgeted(
+                root_render_func(context))
+        return template
+
+
 class SandboxedEnvironment(BaseSandboxedEnvironment):
     """
     Works like a regular Jinja2 sandboxed environment but has some
     additional knowledge of how Flask's blueprint works so that it can
     prepend the name of the blueprint to referenced templates if necessary.
+
+    Renders can be limited so that an untrusted template can't hold up a worker.
+    A render that exceeds a limit is aborted with :exc:`SandboxBudgetExceeded`,
+    which is also a 500 Internal Server Error, and is counted in
+    :attr:`budget_stats`. Limits are checked as the template runs, so a single
+    slow function call can't be interrupted. Limits must be set before templates
+    are loaded. :class:`SandboxedFlask` sets them from the app's config.
+
+    Attributes of particular classes, such as models, can be declared safe with
+    :meth:`allow_attributes`, which skips the sandbox's checks for them. Access
+    to other attributes is checked as in Jinja2's sandbox. Either way, the result
+    is remembered per type and attribute name.
     """
+    template_class = SandboxedTemplate
+
+    #: Time in seconds a render may take, not counting time a streamed render
+    #: waits on the client (config key ``SANDBOX_MAX_RENDER_TIME``)
+    max_render_time = None
+    #: Number of loop iterations and function calls in a render
+    #: (``SANDBOX_MAX_OPERATIONS``)
+    max_operations = None
+    #: Characters of output from a render (``SANDBOX_MAX_OUTPUT_SIZE``)
+    max_output_size = None
+    #: Depth of nested macro and function calls (``SANDBOX_MAX_DEPTH``)
+    max_depth = None
 
     def __init__(self, app, **options):
         if 'loader' not in options:
             options['loader'] = app.create_global_jinja_loader()
         BaseSandboxedEnvironment.__init__(self, **options)
         self.app = app
+        self._budgets = local()
+        #: Number of renders aborted for each limit
+        self.budget_stats = {'time': 0, 'operations': 0, 'output': 0, 'depth': 0}
+        self._budget_stats_lock = Lock()
+        self._allowed_attributes = {}
+        self._attribute_safety = {}
+
+    def allow_attributes(self, cls, names=None):
+        """
+        Declare attributes of a class that templates may access. These attributes
+        of instances of the class and its subclasses are allowed without the
+        sandbox's checks. Other attributes are checked as usual.
+
+        :param cls: Class, such as a model or mixin
+        :param names: Attribute names, which must not be private. For SQLAlchemy
+            models and mixins, defaults to the columns
+        """
+        if names is None:
+            from sqlalchemy import Column, inspect as sqlalchemy_inspect
+            mapper = sqlalchemy_inspect(cls, raiseerr=False)
+            if mapper is not None:
+                names = [prop.key for prop in mapper.column_attrs]
+            else:
+                names = [name for base in getmro(cls) for name, value in vars(base).items()
+                    if isinstance(value, Column)]
+        names = frozenset(names)
+        for name in names:
+            if name.startswith('_'):
+                raise ValueError("Private attribute %s can't be allowed" % name)
+        self._allowed_attributes[cls] = names
+        self._attribute_safety.clear()
+
+    def is_safe_attribute(self, obj, attr, value):
+        # Whether an attribute is declared, and the sandbox's own checks, depend
+        # only on the object's type (and its __class__, which proxies may change,
+        # for isinstance) and the attribute's name, so they are cached
+        key = (type(obj), obj.__class__, attr)
+        try:
+            return self._attribute_safety[key]
+        except KeyError:
+            pass
+        safe = any(attr in self._allowed_attributes[base] for base in getmro(type(obj))
+            if base in self._allowed_attributes
+            ) or BaseSandboxedEnvironment.is_safe_attribute(self, obj, attr, value)
+        # Attribute names may come from template data, so don't grow unbounded
+        if len(self._attribute_safety) >= 10000:
+            self._attribute_safety.clear()
+        self._attribute_safety[key] = safe
+        return safe
+
+    @property
+    def budgeted(self):
+        """True if any limit is set"""
+        return (self.max_render_time, self.max_operations, self.max_output_size,
+            self.max_depth) != (None, None, None, None)
+
+    def _budgeted(self, events):
+        # Render the events of a template within a new budget, unless they are
+        # part of a render already in progress, as with included templates. The
+        # budget is current only while the template runs, and not while a
+        # streamed render is suspended between events
+        budgets = self._budgets
+        if getattr(budgets, 'current', None) is not None:
+            for event in events:
+                yield event
+            return
+        budget = _RenderBudget(self)
+        events = iter(events)
+        while True:
+            budgets.current = budget
+            try:
+                event = next(events)
+                budget.output(len(event))
+            except StopIteration:
+                return
+            finally:
+                budgets.current = None
+            budget.pause()
+            yield event
+            budget.resume()
+
+    def _generate(self, source, name, filename, defer_init=False):
+        # Count loop iterations towards the budget
+        if self.budgeted and isinstance(source, nodes.Template):
+            for node in source.find_all(nodes.For):
+                node.iter = nodes.Call(nodes.EnvironmentAttribute('budget_iterate'),
+                    [node.iter], [], None, None).set_lineno(node.lineno).set_environment(self)
+        return BaseSandboxedEnvironment._generate(self, source, name, filename, defer_init)
+
+    def budget_iterate(self, iterable):
+        budget = getattr(self._budgets, 'current', None)
+        if budget is None:
+            return iterable
+        return budget.iterate(iterable)
+
+    def call(__self, __context, __obj, *args, **kwargs):
+        budget = getattr(__self._budgets, 'current', None)
+        if budget is None:
+            return BaseSandboxedEnvironment.call(__self, __context, __obj, *args, **kwargs)
+        budget.tick()
+        budget.depth += 1
+        try:
+            if __self.max_depth is not None and budget.depth > __self.max_depth:
+                budget.exceeded('depth')
+            return BaseSandboxedEnvironment.call(__self, __context, __obj, *args, **kwargs)
+        finally:
+            budget.depth -= 1
 
 
 class SandboxedFlask(Flask):
@@ -51,6 +281,10 @@ class SandboxedFlask(Flask):
         if 'autoescape' not in options:
             options['autoescape'] = self.select_jinja_autoescape
         rv = SandboxedEnvironment(self, **options)
+        rv.max_render_time = self.config.get('SANDBOX_MAX_RENDER_TIME')
+        rv.max_operations = self.config.get('SANDBOX_MAX_OPERATIONS')
+        rv.max_output_size = self.config.get('SANDBOX_MAX_OUTPUT_SIZE')
+        rv.max_depth = self.config.get('SANDBOX_MAX_DEPTH')
         rv.globals.update(
             url_for=url_for,
             get_flashed_messages=get_flashed_messages,
@@ -66,6 +300,158 @@ class SandboxedFlask(Flask):
         return rv
 
 
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    """
+    Stores compiled templates on the filesystem, so that new worker processes
+    don't have to compile them again. Entries are kept in a subdirectory for the
+    installed version of Jinja2 and are keyed by the template's modification time,
+    so that upgrades and edits are never served stale bytecode. Templates compiled
+    by a :class:`SandboxedEnvironment` with limits are cached separately. Entries for earlier
+    versions of a template are removed when it is compiled again, as are the
+    subdirectories for other versions of Jinja2 if ``directory`` is given. Files are
+    written atomically, as workers may be compiling the same template at the same
+    time.
+
+    :param str directory: Base directory for the cache, which should be specific to
+        the app. Defaults to a directory for the current user in the system's
+        temporary directory
+    """
+    def __init__(self, directory=None):
+        FileSystemBytecodeCache.__init__(self, directory)
+        base = self.directory
+        self.directory = os.path.join(base, 'jinja2-%s' % jinja2.__version__)
+        try:
+            os.makedirs(self.directory, 0700)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        if directory is not None:
+            for name in os.listdir(base):
+                path = os.path.join(base, name)
+                if name.startswith('jinja2-') and path != self.directory:
+                    shutil.rmtree(path, ignore_errors=True)
+
+    def get_bucket(self, environment, name, filename, source):
+        # Sandboxed environments with limits compile templates with budget checks,
+        # so their bytecode is kept apart from that compiled without
+        if getattr(environment, 'budgeted', False):
+            name = 'budgeted:' + name
+        return FileSystemBytecodeCache.get_bucket(self, environment, name, filename, source)
+
+    def get_cache_key(self, name, filename=None):
+        key = FileSystemBytecodeCache.get_cache_key(self, name, filename)
+        if filename is not None:
+            try:
+                key = '%s-%d' % (key, os.stat(filename).st_mtime)
+            except OSError:
+                pass
+        return key
+
+    def dump_bytecode(self, bucket):
+        filename = self._get_cache_filename(bucket)
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.rename(tmpname, filename)
+        except:
+            os.remove(tmpname)
+            raise
+        if '-' in bucket.key:
+            # Remove entries for earlier modification times of the template
+            pattern = self.pattern % (bucket.key.rsplit('-', 1)[0] + '-*')
+            for superseded in glob(os.path.join(self.directory, pattern)):
+                if superseded != filename:
+                    try:
+                        os.remove(superseded)
+                    except OSError:
+                        pass
+
+
+def precompile_templates(app):
+    """
+    Compile all of an app's templates into its bytecode cache, such as during a
+    deploy, so that workers don't have to. Returns a list of template names that
+    were compiled and a list of (name, exception) for templates that could not be.
+    """
+    compiled = []
+    errors = []
+    for name in app.jinja_env.list_templates():
+        try:
+            app.jinja_env.get_template(name)
+        except (TemplateError, UnicodeDecodeError), e:
+            errors.append((name, e))
+        else:
+            compiled.append(name)
+    return compiled, errors
+
+
+def _warmup_markdown(app):
+    # Loads Markdown extensions, Pygments lexers for codehilite, and bleach
+    from coaster.gfm import markdown
+    markdown(u'```python\nwarmup = True\n```')
+    markdown(u'<b>warmup</b>', html=True)
+
+
+def _warmup_tldextract(app):
+    # Loads the Public Suffix List
+    from coaster.utils import base_domain_matches
+    base_domain_matches('www.example.com', 'example.com')
+
+
+def _warmup_bcrypt(app):
+    # Loads the bcrypt extension module
+    import bcrypt
+    bcrypt.hashpw('warmup', bcrypt.gensalt(4))
+
+
+def _warmup_templates(app):
+    precompile_templates(app)
+
+
+def _warmup_timezones(app):
+    from coaster.utils import sorted_timezones
+    sorted_timezones()
+
+
+#: Steps run by :func:`warmup`, as (name, function) pairs. Functions are called
+#: with the app. Apps may add their own steps
+warmup_steps = [
+    ('markdown', _warmup_markdown),
+    ('tldextract', _warmup_tldextract),
+    ('bcrypt', _warmup_bcrypt),
+    ('templates', _warmup_templates),
+    ('timezones', _warmup_timezones),
+    ]
+
+
+def warmup(app, steps=None):
+    """
+    Perform the initialisation that would otherwise slow down the first requests
+    in each worker process: loading Markdown and Pygments, the Public Suffix List
+    and bcrypt, compiling templates and listing timezones. When called in the
+    server's master process before workers are forked (such as with Gunicorn's
+    ``preload_app`` setting), workers share this memory instead of repeating it.
+    :func:`init_app` calls this if the ``WARMUP`` config key is True.
+
+    A step that fails is logged and skipped. Returns an ordered dictionary of step
+    names to the time taken in seconds, which is also logged.
+
+    :param steps: List of (name, function) pairs, defaulting to :data:`warmup_steps`
+    """
+    timings = OrderedDict()
+    for name, step in (warmup_steps if steps is None else steps):
+        start = time()
+        try:
+            step(app)
+        except Exception:
+            app.logger.exception("Warmup step %s failed" % name)
+        timings[name] = time() - start
+    app.logger.info("Warmup completed: %s" % ', '.join(
+        '%s %.3fs' % (name, timing) for name, timing in timings.items()))
+    return timings
+
+
 def configure(app, env):
     """
     Configure an app depending on the environment.
@@ -77,6 +463,19 @@ def configure(app, env):
 def init_app(app, env):
     """
     Configure an app depending on the environment.
+
+    This also adds the ``{% cache %}`` tag for template fragment caching (see
+    :class:`~coaster.cache.FragmentCacheExtension`), with fragments held in memory
+    under the ``FRAGMENT_CACHE_NAMESPACE`` key prefix for
+    ``FRAGMENT_CACHE_TIMEOUT`` seconds (default 300). If ``TEMPLATE_CACHE_DIR`` is
+    set, compiled templates are cached in that directory (see
+    :class:`TemplateBytecodeCache`), or in the app's instance folder if it is
+    ``True``; otherwise the app's own bytecode cache, if any, is left in place.
+    These are added to the app's ``jinja_options``, so the
+    Jinja environment is still created on first use and configuration made after
+    this call (such as :class:`SandboxedFlask`'s limits) takes effect. If the
+    ``WARMUP`` config key is True, :func:`warmup` is called last, which creates the
+    environment.
     """
     load_config_from_file(app, 'settings.py')
 
@@ -86,6 +485,28 @@ def init_app(app, env):
 
     coaster.logging.init_app(app)
 
+    # The extension reads the app's config when the environment is created
+    extension = type('FragmentCacheExtension', (FragmentCacheExtension,), {
+        '__module__': FragmentCacheExtension.__module__, 'config': app.config})
+    cache_dir = app.config.get('TEMPLATE_CACHE_DIR')
+    if cache_dir is True:
+        cache_dir = os.path.join(app.instance_path, 'template_cache')
+    bytecode_cache = TemplateBytecodeCache(cache_dir) if cache_dir else None
+    if 'jinja_env' in app.__dict__:
+        # The environment was already created, so it can't be configured with options
+        app.jinja_env.add_extension(extension)
+        if bytecode_cache is not None:
+            app.jinja_env.bytecode_cache = bytecode_cache
+    else:
+        options = dict(app.jinja_options)
+        options['extensions'] = list(options.get('extensions', [])) + [extension]
+        if bytecode_cache is not None:
+            options['bytecode_cache'] = bytecode_cache
+        app.jinja_options = ImmutableDict(options)
+
+    if app.config.get('WARMUP'):
+        warmup(app)
+
 
 def load_config_from_file(app, filepath):
     try:
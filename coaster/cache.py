@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from collections import OrderedDict
+from hashlib import sha1
+from threading import Lock
+from time import time
+from markupsafe import Markup
+from jinja2 import nodes
+from jinja2.ext import Extension
+from werkzeug.contrib.cache import BaseCache
+
+__all__ = ['LRUCache', 'FragmentCache', 'FragmentCacheExtension']
+
+
+class LRUCache(BaseCache):
+    """
+    In-memory cache that evicts the least recently used entries once it holds
+    ``maxsize`` entries. This implements Werkzeug's cache interface, so a shared
+    cache such as :class:`~werkzeug.contrib.cache.MemcachedCache` or
+    :class:`~werkzeug.contrib.cache.RedisCache` can be used wherever Coaster accepts
+    a cache backend. A timeout of ``0`` means the entry never expires. This class
+    is thread-safe.
+
+    :param int maxsize: Maximum number of entries held
+    :param int default_timeout: Timeout in seconds for entries set without one
+    """
+    def __init__(self, maxsize=1000, default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
+    def _get(self, key):
+        # Must be called with the lock held
+        try:
+            expires, value = self._cache.pop(key)
+        except KeyError:
+            return None
+        if expires is not None and expires <= time():
+            return None
+        self._cache[key] = (expires, value)  # Move to the most recently used end
+        return value
+
+    def _set(self, key, value, timeout):
+        # Must be called with the lock held
+        if timeout is None:
+            timeout = self.default_timeout
+        self._cache.pop(key, None)
+        self._cache[key] = (time() + timeout if timeout else None, value)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._set(key, value, timeout)
+        return True
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            if self._get(key) is not None:
+                return False
+            self._set(key, value, timeout)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            return self._cache.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+        return True
+
+    def __len__(self):
+        return len(self._cache)
+
+
+def _model_tag(obj):
+    # Return (identity, version) for a model instance, or None for other objects
+    tablename = getattr(obj, '__tablename__', None)
+    if tablename is None:
+        return None
+    updated_at = getattr(obj, 'updated_at', None)
+    return (u'%s/%s' % (tablename, obj.id),
+        updated_at.isoformat() if updated_at is not None else u'')
+
+
+class FragmentCache(object):
+    """
+    Cache for rendered template fragments, used by the ``{% cache %}`` tag from
+    :class:`FragmentCacheExtension`. Fragments are cached under a key and a list of
+    tags. A tag is a string or a model instance, and calling :meth:`invalidate`
+    with a tag discards all fragments cached with it. Fragments tagged with a model
+    instance are also discarded when its ``updated_at`` timestamp changes.
+
+    Keys are prefixed with the namespace and hashed, so they are safe to use with a
+    shared cache such as :class:`~werkzeug.contrib.cache.MemcachedCache`. Fragments
+    are cached separately for each template. Templates that are not loaded by name,
+    such as those of different tenants in a :class:`~coaster.app.SandboxedFlask`
+    app, should be told apart with ``vary``.
+
+    :param backend: Werkzeug cache to store fragments in. Defaults to an
+        :class:`LRUCache` holding 1000 fragments
+    :param str namespace: Prefix for cache keys, to share a cache between apps
+    :param int default_timeout: Timeout in seconds for fragments cached without one
+    :param vary: Optional callable that returns additional key data, such as the
+        current tenant
+    """
+    def __init__(self, backend=None, namespace='', default_timeout=300, vary=None):
+        if backend is None:
+            backend = LRUCache(maxsize=1000, default_timeout=default_timeout)
+        self.backend = backend
+        self.namespace = namespace
+        self.default_timeout = default_timeout
+        self.vary = vary
+
+    def _tag_key(self, identity):
+        return '%stag:%s' % (self.namespace, sha1(identity.encode('utf-8')).hexdigest())
+
+    def _tag_identities(self, tags):
+        # Return a list of (identity, model version) for tags
+        identities = []
+        for tag in tags:
+            model_tag = _model_tag(tag)
+            if model_tag is None:
+                identities.append((unicode(tag), u''))
+            else:
+                identities.append(model_tag)
+        return identities
+
+    def key(self, key, tags=(), template=None):
+        """
+        Return the cache key for a fragment in the named template, which includes
+        the current versions of its tags.
+        """
+        parts = [template or u'', unicode(key)]
+        if self.vary is not None:
+            parts.append(unicode(self.vary()))
+        identities = self._tag_identities(tags)
+        if identities:
+            tag_keys = [self._tag_key(identity) for identity, version in identities]
+            versions = self.backend.get_many(*tag_keys)
+            for (identity, model_version), tag_key, version in zip(identities, tag_keys, versions):
+                if version is None:
+                    version = '%x' % int(time() * 1000000)
+                    self.backend.set(tag_key, version, timeout=0)
+                parts.extend((identity, model_version, version))
+        return '%sfragment:%s' % (self.namespace,
+            sha1(u'\x00'.join(parts).encode('utf-8')).hexdigest())
+
+    def invalidate(self, *tags):
+        """
+        Discard all fragments cached with any of the given tags.
+        """
+        for identity, model_version in self._tag_identities(tags):
+            self.backend.delete(self._tag_key(identity))
+
+    def fetch(self, key, timeout, tags, render, template=None):
+        """
+        Return the cached fragment, or call ``render`` and cache its result.
+        """
+        cache_key = self.key(key, tags, template)
+        fragment = self.backend.get(cache_key)
+        if fragment is None:
+            fragment = unicode(render())
+            self.backend.set(cache_key, fragment,
+                timeout=self.default_timeout if timeout is None else timeout)
+        # The fragment was rendered by Jinja and is safe for autoescaped output
+        return Markup(fragment)
+
+
+class FragmentCacheExtension(Extension):
+    """
+    Jinja extension that provides a ``cache`` tag for caching rendered fragments
+    of a template between requests::
+
+        {% cache 'sidebar', 600 %}...{% endcache %}
+        {% cache 'schedule', 0, project, 'sessions' %}...{% endcache %}
+
+    The first argument is the key, the optional second argument is the timeout in
+    seconds (``None`` for the default, ``0`` to never expire) and further arguments
+    are tags (see :class:`FragmentCache`). The key must include any variable the
+    fragment depends on, such as the current user. The cache is available as
+    ``environment.fragment_cache`` and may be replaced, such as with one that uses
+    a shared backend. It is configured with the ``FRAGMENT_CACHE_NAMESPACE`` and
+    ``FRAGMENT_CACHE_TIMEOUT`` keys of :attr:`config`.
+    :func:`coaster.app.init_app` adds this extension to the app's Jinja environment.
+    """
+    tags = set(['cache'])
+    #: Configuration to read when the environment is created. :func:`coaster.app.init_app`
+    #: sets this to the app's config in a subclass
+    config = {}
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache=FragmentCache(
+            namespace=self.config.get('FRAGMENT_CACHE_NAMESPACE', ''),
+            default_timeout=self.config.get('FRAGMENT_CACHE_TIMEOUT', 300)))
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache', [nodes.List(args), nodes.Const(parser.name)]),
+            [], [], body).set_lineno(lineno)
+
+    def _cache(self, args, template, caller):
+        timeout = args[1] if len(args) > 1 else None
+        return self.environment.fragment_cache.fetch(args[0], timeout, args[2:], caller, template)
@@ -11,7 +11,6 @@ https://gist.github.com/Wilfred/901706
 """
 
 from markupsafe import Markup
-from markdown import Markdown
 import re
 from .utils import sanitize_html, VALID_TAGS
 
@@ -33,18 +32,32 @@ GFM_TAGS['th'] = ['align', 'char', 'charoff', 'colspan', 'rowspan', 'valign']
 GFM_TAGS['thead'] = ['align', 'char', 'charoff', 'valign']
 GFM_TAGS['tr'] = ['align', 'char', 'charoff', 'valign']
 
-markdown_convert_text = Markdown(safe_mode='escape', output_format='html5',
-    enable_attributes=False,
-    extensions=['codehilite', 'smarty'],
-    extension_configs={'codehilite': {'css_class': 'syntax'}}
-    ).convert
+_markdown_options = {
+    'text': {'safe_mode': 'escape', 'enable_attributes': False},
+    'html': {'safe_mode': False, 'enable_attributes': True},
+    }
+_markdown_converters = {}
 
 
-markdown_convert_html = Markdown(safe_mode=False, output_format='html5',
-    enable_attributes=True,
-    extensions=['codehilite', 'smarty'],
-    extension_configs={'codehilite': {'css_class': 'syntax'}}
-    ).convert
+def _markdown_converter(mode):
+    # Markdown and its extensions are slow to import, so the processors are
+    # made when first used
+    convert = _markdown_converters.get(mode)
+    if convert is None:
+        from markdown import Markdown
+        convert = _markdown_converters[mode] = Markdown(output_format='html5',
+            extensions=['codehilite', 'smarty'],
+            extension_configs={'codehilite': {'css_class': 'syntax'}},
+            **_markdown_options[mode]).convert
+    return convert
+
+
+def markdown_convert_text(text):
+    return _markdown_converter('text')(text)
+
+
+def markdown_convert_html(text):
+    return _markdown_converter('html')(text)
 
 
 def remove_pre_blocks(markdown_source):
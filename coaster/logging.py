@@ -1,18 +1,51 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import absolute_import
+import os
 import logging.handlers
 import cStringIO
 import traceback
+import linecache
+import hashlib
+from repr import Repr
+from copy import copy
+from collections import OrderedDict
+from datetime import datetime
+from operator import attrgetter
+from threading import Thread, Lock, Event
+from time import time
+from Queue import Queue, Full
+
+# Limits for the values of local variables in tracebacks
+_repr = Repr()
+_repr.maxlevel = 3
+_repr.maxtuple = _repr.maxlist = _repr.maxarray = _repr.maxdict = _repr.maxset = \
+    _repr.maxfrozenset = _repr.maxdeque = 20
+_repr.maxstring = _repr.maxother = _repr.maxlong = 1000
 
 
 class LocalVarFormatter(logging.Formatter):
     """
     Custom log formatter that logs the contents of local variables in the stack frame.
+
+    Exceptions are formatted in two steps, so that the second can be done in
+    another thread: :meth:`captureException` copies the traceback and the values
+    of local variables, which are shown with the limits of :mod:`repr` so that
+    large values are quick to copy, and :meth:`formatCaptured` formats them.
     """
     def formatException(self, ei):
+        return self.formatCaptured(self.captureException(ei))
+
+    def captureException(self, ei):
+        """
+        Copy what :meth:`formatCaptured` needs from the exception ``ei``, as
+        returned by :func:`sys.exc_info`, without holding on to the stack frames.
+        """
+        entries = []
         tb = ei[2]
         while 1:
+            code = tb.tb_frame.f_code
+            entries.append((code.co_filename, tb.tb_lineno, code.co_name))
             if not tb.tb_next:
                 break
             tb = tb.tb_next
@@ -23,20 +56,35 @@ class LocalVarFormatter(logging.Formatter):
             f = f.f_back
         stack.reverse()
 
-        sio = cStringIO.StringIO()
-        traceback.print_exception(ei[0], ei[1], ei[2], None, sio)
-
+        frames = []
         for frame in stack:
-            print >> sio
-            print >> sio, "Frame %s in %s at line %s" % (frame.f_code.co_name,
-                                                         frame.f_code.co_filename,
-                                                         frame.f_lineno)
+            values = []
             for key, value in frame.f_locals.items():
-                print >> sio, "\t%20s = " % key,
                 try:
-                    print >> sio, repr(value)
+                    values.append((key, _repr.repr(value)))
                 except:
-                    print >> sio, "<ERROR WHILE PRINTING VALUE>"
+                    values.append((key, "<ERROR WHILE PRINTING VALUE>"))
+            frames.append((frame.f_code.co_name, frame.f_code.co_filename, frame.f_lineno, values))
+        return ei[0], ei[1], entries, frames
+
+    def formatCaptured(self, captured):
+        """
+        Format an exception copied by :meth:`captureException`.
+        """
+        exc_type, exc_value, entries, frames = captured
+        sio = cStringIO.StringIO()
+        print >> sio, "Traceback (most recent call last):"
+        sio.write(''.join(traceback.format_list([(filename, lineno, name,
+            linecache.getline(filename, lineno).strip() or None)
+            for filename, lineno, name in entries])))
+        sio.write(''.join(traceback.format_exception_only(exc_type, exc_value)))
+
+        for name, filename, lineno, values in frames:
+            print >> sio
+            print >> sio, "Frame %s in %s at line %s" % (name, filename, lineno)
+            for key, value in values:
+                print >> sio, "\t%20s = " % key,
+                print >> sio, value
 
         s = sio.getvalue()
         sio.close()
@@ -45,6 +93,265 @@ class LocalVarFormatter(logging.Formatter):
         return s
 
 
+class QueueHandler(logging.Handler):
+    """
+    Log handler that passes records to other handlers in a background thread, so
+    that logging never makes the caller wait on disk or network I/O. Records are
+    held in a queue of ``maxsize`` records, and records that arrive when the queue
+    is full are dropped and counted in :attr:`dropped`, with a warning logged once
+    there is room. Pending records are handled when the process exits.
+
+    Exception tracebacks are formatted with this handler's formatter. If it has a
+    ``captureException`` method, as :class:`LocalVarFormatter` does, the values
+    of local variables are copied before the record is queued, while the stack
+    frames still hold the values at the time of the error, and are formatted in
+    the listener thread. Other formatters format the traceback before the record
+    is queued.
+
+    :param handlers: Handlers to pass records to
+    :param int maxsize: Number of records the queue can hold
+    """
+    _sentinel = None
+
+    def __init__(self, handlers, maxsize=1000):
+        logging.Handler.__init__(self)
+        self.handlers = list(handlers)
+        self.maxsize = maxsize
+        #: Number of records dropped because the queue was full
+        self.dropped = 0
+        self._reported = 0
+        self._pid = None
+        self._thread = None
+        self._starting = Lock()
+
+    def _start(self):
+        # Threads don't survive a fork, so each process starts its own listener
+        with self._starting:
+            if self._pid != os.getpid():
+                self.queue = Queue(self.maxsize)
+                self._thread = Thread(target=self._listen, name='coaster.logging')
+                self._thread.daemon = True
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _listen(self):
+        queue = self.queue
+        while True:
+            record = queue.get()
+            if record is self._sentinel:
+                break
+            self.handle_queued(record)
+            if self.dropped > self._reported and queue.empty():
+                dropped = self.dropped
+                self.handle_queued(logging.LogRecord(record.name, logging.WARNING, __file__, 0,
+                    "%d log records were dropped because the queue was full",
+                    (dropped - self._reported,), None))
+                self._reported = dropped
+
+    def handle_queued(self, record):
+        """
+        Pass a record from the queue to the handlers. Called in the listener thread.
+        """
+        captured = getattr(record, 'exc_captured', None)
+        if captured is not None:
+            record.exc_text = self.formatter.formatCaptured(captured)
+            record.exc_captured = None
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                try:
+                    handler.handle(record)
+                except Exception:
+                    handler.handleError(record)
+
+    def prepare(self, record):
+        """
+        Format the message of a record and capture or format its exception, so
+        that it can be handled in another thread.
+        """
+        record.fingerprint = _fingerprint(record)
+        if record.exc_info:
+            formatter = self.formatter or logging.Formatter()
+            if hasattr(formatter, 'captureException'):
+                record.exc_captured = formatter.captureException(record.exc_info)
+            else:
+                record.exc_text = formatter.formatException(record.exc_info)
+            # The traceback holds the stack frames, which may not be used in
+            # another thread
+            record.exc_info = record.exc_info[:2] + (None,)
+        record.msg = record.getMessage()
+        record.args = None
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        if self.queue.full():
+            self.dropped += 1
+            return
+        try:
+            # Other handlers may receive the same record, so change a copy
+            record = copy(record)
+            self.prepare(record)
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def stop(self, timeout=5):
+        """
+        Handle pending records and stop the listener thread. Called by
+        :meth:`close`, which :mod:`logging` calls for all handlers when the
+        process exits.
+        """
+        if self._pid == os.getpid() and self._thread.is_alive():
+            try:
+                self.queue.put(self._sentinel, timeout=timeout)
+            except Full:
+                pass
+            else:
+                self._thread.join(timeout)
+        self._pid = None
+
+    def close(self):
+        self.stop()
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close(self)
+
+
+def _fingerprint(record):
+    # Identify repeated occurrences of an error by the exception type and the
+    # functions in the traceback, without line numbers, which change as code is
+    # edited. Records without an exception are identified by their unformatted
+    # message and where they were logged
+    if record.exc_info and record.exc_info[0] is not None:
+        exc_type, exc_value, tb = record.exc_info
+        parts = ['%s.%s' % (exc_type.__module__, exc_type.__name__)]
+        while tb is not None:
+            code = tb.tb_frame.f_code
+            parts.append('%s:%s' % (code.co_filename, code.co_name))
+            tb = tb.tb_next
+    else:
+        parts = [record.name, record.pathname, record.funcName, unicode(record.msg)]
+    return hashlib.sha1(u'\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+class _Occurrences(object):
+    # Occurrences of an error since the last email about it
+    def __init__(self, summary, now):
+        self.summary = summary
+        self.count = 0
+        self.first_seen = now
+        self.last_seen = now
+        self.last_sent = None
+
+
+class DigestSMTPHandler(logging.handlers.SMTPHandler):
+    """
+    SMTP log handler that emails each distinct error at most once per interval.
+    Further occurrences are counted and summarised in a digest email, sent once
+    per interval, with the number of occurrences of each error and when it was
+    first and last seen. Errors are distinguished by the type of exception and the
+    functions in the traceback, or by the message if there is no exception.
+
+    Takes the same parameters as :class:`~logging.handlers.SMTPHandler`, and:
+
+    :param int interval: Seconds between emails about the same error, and between
+        digests
+    :param int maxsize: Number of distinct errors to track. When exceeded, the
+        error seen least recently is forgotten, and its occurrences awaiting a
+        digest are counted in a line for errors no longer tracked
+    :param clock: Function that returns the current time (default
+        :func:`time.time`)
+    """
+    def __init__(self, *args, **kwargs):
+        self.interval = kwargs.pop('interval', 600)
+        self.maxsize = kwargs.pop('maxsize', 1000)
+        self.clock = kwargs.pop('clock', time)
+        logging.handlers.SMTPHandler.__init__(self, *args, **kwargs)
+        self.errors = OrderedDict()
+        self.overflow = 0
+        self._pid = None
+        self._stopped = Event()
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._stopped.clear()
+        thread = Thread(target=self._send_digests, name='coaster.logging.digest')
+        thread.daemon = True
+        thread.start()
+
+    def _send_digests(self):
+        while not self._stopped.wait(self.interval):
+            self.send_digest()
+
+    def getSubject(self, record):
+        if getattr(record, 'digest', False):
+            return '%s (digest)' % self.subject
+        return self.subject
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        fingerprint = getattr(record, 'fingerprint', None) or _fingerprint(record)
+        now = self.clock()
+        errors = self.errors
+        # Errors are kept in the order they were last seen
+        occurrences = errors.pop(fingerprint, None)
+        if occurrences is not None:
+            errors[fingerprint] = occurrences
+        else:
+            if len(errors) >= self.maxsize:
+                key, forgotten = errors.popitem(last=False)
+                self.overflow += forgotten.count
+            summary = record.getMessage().split('\n', 1)[0]
+            if record.exc_info and record.exc_info[0] is not None:
+                summary = '%s (%s: %s)' % (summary, record.exc_info[0].__name__, record.exc_info[1])
+            occurrences = errors[fingerprint] = _Occurrences(summary, now)
+        if occurrences.last_sent is not None and now - occurrences.last_sent < self.interval:
+            if not occurrences.count:
+                occurrences.first_seen = now
+            occurrences.count += 1
+            occurrences.last_seen = now
+            return
+        occurrences.last_sent = now
+        logging.handlers.SMTPHandler.emit(self, record)
+
+    def send_digest(self):
+        """
+        Email a digest of errors that weren't emailed since the last digest. Called
+        periodically and by :meth:`close`, which :mod:`logging` calls for all
+        handlers when the process exits.
+        """
+        self.acquire()
+        try:
+            pending = sorted([occurrences for occurrences in self.errors.values()
+                if occurrences.count], key=attrgetter('first_seen'))
+            lines = ["These errors occurred again and were not emailed individually:", ""]
+            for occurrences in pending:
+                lines.append("%d times between %s and %s: %s" % (occurrences.count,
+                    datetime.fromtimestamp(occurrences.first_seen).strftime('%Y-%m-%d %H:%M:%S'),
+                    datetime.fromtimestamp(occurrences.last_seen).strftime('%Y-%m-%d %H:%M:%S'),
+                    occurrences.summary))
+                occurrences.count = 0
+            overflow = self.overflow
+            if overflow:
+                lines.append("%d times: errors that are no longer tracked" % overflow)
+                self.overflow = 0
+        finally:
+            self.release()
+        if pending or overflow:
+            record = logging.LogRecord(self.__class__.__name__, logging.ERROR, __file__, 0,
+                '\n'.join(lines), None, None)
+            record.digest = True
+            logging.handlers.SMTPHandler.emit(self, record)
+
+    def close(self):
+        self._stopped.set()
+        self.send_digest()
+        logging.handlers.SMTPHandler.close(self)
+
+
 def init_app(app):
     """
     Enables logging for an app using :class:`LocalVarFormatter`.
@@ -58,14 +365,19 @@ def init_app(app):
     * ``MAIL_DEFAULT_SENDER``: From address of email. Can be an address or a tuple with name and address
     * ``MAIL_SERVER``: SMTP server to send with (default ``localhost``)
     * ``MAIL_USERNAME`` and ``MAIL_PASSWORD``: SMTP credentials, if required
+    * ``LOG_MAIL_INTERVAL``: Seconds between emails about the same error, with
+      repeats sent as a digest (default 600; see :class:`DigestSMTPHandler`)
     * ``FLUENTD_SERVER``: If specified, will enable logging to fluentd
+    * ``LOG_QUEUE_SIZE``: Number of records held for logging in the background
+      (default 1000; see :class:`QueueHandler`)
     """
     formatter = LocalVarFormatter()
+    handlers = []
 
     file_handler = logging.FileHandler(app.config.get('LOGFILE', 'error.log'))
     file_handler.setFormatter(formatter)
     file_handler.setLevel(logging.WARNING)
-    app.logger.addHandler(file_handler)
+    handlers.append(file_handler)
     if app.config.get('ADMINS'):
         # MAIL_DEFAULT_SENDER is the new setting for default mail sender in Flask-Mail
         # DEFAULT_MAIL_SENDER is the old setting. We look for both
@@ -77,13 +389,19 @@ def init_app(app):
             credentials = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
         else:
             credentials = None
-        mail_handler = logging.handlers.SMTPHandler(app.config.get('MAIL_SERVER', 'localhost'),
+        mail_handler = DigestSMTPHandler(app.config.get('MAIL_SERVER', 'localhost'),
             mail_sender,
             app.config['ADMINS'],
             '%s failure' % app.name,
-            credentials=credentials)
+            credentials=credentials,
+            interval=app.config.get('LOG_MAIL_INTERVAL', 600))
         mail_handler.setFormatter(formatter)
         mail_handler.setLevel(logging.ERROR)
-        app.logger.addHandler(mail_handler)
+        handlers.append(mail_handler)
+
+    queue_handler = QueueHandler(handlers, maxsize=app.config.get('LOG_QUEUE_SIZE', 1000))
+    queue_handler.setFormatter(formatter)
+    queue_handler.setLevel(logging.WARNING)
+    app.logger.addHandler(queue_handler)
 
 configure = init_app
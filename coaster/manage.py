@@ -9,6 +9,7 @@ from alembic.util import CommandError
 from flask.ext.script import Manager, prompt_bool, Shell
 from flask.ext.script.commands import Clean, ShowUrls
 from flask.ext.alembic import ManageMigrations
+from coaster.app import precompile_templates
 
 
 manager = Manager()
@@ -93,6 +94,16 @@ def sync_resources(env):
     print "Resources synced..."
 
 
+@manager.option('-e', '--env', default='dev', help="runtime environment [default 'dev']")
+def compile_templates(env):
+    """Compile templates into the bytecode cache"""
+    manager.init_for(env)
+    compiled, errors = precompile_templates(manager.app)
+    for name, error in errors:
+        print "Error in %s: %s" % (name, error)
+    print "Compiled %d templates" % len(compiled)
+
+
 @manager.option('-e', '--env', default='dev', help="shell environment [default dev]")
 def shell(env, no_ipython=False, no_bpython=False):
     """Initiate a Python shell"""
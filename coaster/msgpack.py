@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+"""
+MessagePack serialization, a compact binary alternative to JSON for API clients
+that support it. The C extension from the ``msgpack-python`` package is used if
+installed, with a pure-Python implementation as fallback that produces the same
+output.
+
+Types are encoded as in Coaster's JSON responses: ``str`` and ``unicode`` (and
+:class:`~markupsafe.Markup`) are strings, :class:`~decimal.Decimal` is a float,
+iterators and SQLAlchemy queries are arrays (with named tuple rows as maps), and
+other types (such as datetimes) are converted with the Flask app's JSON encoder.
+``msgpack-python`` 0.5.2 or later is required for the C extension to be used.
+"""
+
+from __future__ import absolute_import
+from collections import Iterator
+from decimal import Decimal
+import struct
+from flask import current_app
+from sqlalchemy.orm import Query
+
+try:
+    import msgpack as _msgpack
+except ImportError:  # pragma: no cover
+    _msgpack = None
+else:
+    # Older versions can't decode strings as Unicode with raw=False
+    if _msgpack.version < (0, 5, 2):  # pragma: no cover
+        _msgpack = None
+
+_query_batchsize = 1000
+
+__all__ = ['packb', 'unpackb']
+
+
+def _make_default():
+    # Return a function that converts objects that MessagePack can't encode
+    encoder = []
+
+    def default(obj):
+        if isinstance(obj, Decimal):
+            return float(obj)
+        elif isinstance(obj, Query):
+            # As in JSON, rows of named columns are encoded as maps
+            return [row._asdict() if hasattr(row, '_asdict') else row
+                for row in obj.yield_per(_query_batchsize)]
+        elif isinstance(obj, Iterator):
+            return list(obj)
+        elif isinstance(obj, (int, long)):
+            raise OverflowError("Integer out of range for MessagePack: %d" % obj)
+        if not encoder:
+            encoder.append(current_app.json_encoder())
+        return encoder[0].default(obj)
+    return default
+
+
+_uint8 = struct.Struct('>BB').pack
+_uint16 = struct.Struct('>BH').pack
+_uint32 = struct.Struct('>BI').pack
+_uint64 = struct.Struct('>BQ').pack
+_int8 = struct.Struct('>Bb').pack
+_int16 = struct.Struct('>Bh').pack
+_int32 = struct.Struct('>Bi').pack
+_int64 = struct.Struct('>Bq').pack
+_float64 = struct.Struct('>Bd').pack
+_fixints = [chr(code) for code in range(0x80)] + [chr(code) for code in range(0xe0, 0x100)]
+_fixstrs = [chr(0xa0 | length) for length in range(0x20)]
+_constants = {None: '\xc0', True: '\xc3', False: '\xc2'}
+
+
+def _pack_int(obj, default, append):
+    if -0x20 <= obj < 0x80:
+        append(_fixints[obj])
+    elif 0 <= obj <= 0xff:
+        append(_uint8(0xcc, obj))
+    elif 0 <= obj <= 0xffff:
+        append(_uint16(0xcd, obj))
+    elif 0 <= obj <= 0xffffffff:
+        append(_uint32(0xce, obj))
+    elif 0 <= obj <= 0xffffffffffffffff:
+        append(_uint64(0xcf, obj))
+    elif -0x80 <= obj < 0:
+        append(_int8(0xd0, obj))
+    elif -0x8000 <= obj < 0:
+        append(_int16(0xd1, obj))
+    elif -0x80000000 <= obj < 0:
+        append(_int32(0xd2, obj))
+    elif -0x8000000000000000 <= obj < 0:
+        append(_int64(0xd3, obj))
+    else:
+        raise OverflowError("Integer out of range for MessagePack: %d" % obj)
+
+
+def _pack_float(obj, default, append):
+    append(_float64(0xcb, obj))
+
+
+def _pack_str(obj, default, append):
+    if isinstance(obj, unicode):
+        obj = obj.encode('utf-8')
+    length = len(obj)
+    # str8 is not used, for compatibility with older decoders, as in the C extension
+    if length < 0x20:
+        append(_fixstrs[length])
+    elif length <= 0xffff:
+        append(_uint16(0xda, length))
+    else:
+        append(_uint32(0xdb, length))
+    append(obj)
+
+
+def _pack_list(obj, default, append):
+    length = len(obj)
+    if length < 0x10:
+        append(chr(0x90 | length))
+    elif length <= 0xffff:
+        append(_uint16(0xdc, length))
+    else:
+        append(_uint32(0xdd, length))
+    for item in obj:
+        _packers.get(type(item), _pack_other)(item, default, append)
+
+
+def _pack_dict(obj, default, append):
+    length = len(obj)
+    if length < 0x10:
+        append(chr(0x80 | length))
+    elif length <= 0xffff:
+        append(_uint16(0xde, length))
+    else:
+        append(_uint32(0xdf, length))
+    for key, value in obj.iteritems():
+        _packers.get(type(key), _pack_other)(key, default, append)
+        _packers.get(type(value), _pack_other)(value, default, append)
+
+
+def _pack_constant(obj, default, append):
+    append(_constants[obj])
+
+# Packers for exact types, for speed. Subclasses are matched in _pack_other
+_packers = {
+    type(None): _pack_constant,
+    bool: _pack_constant,
+    int: _pack_int,
+    long: _pack_int,
+    float: _pack_float,
+    str: _pack_str,
+    unicode: _pack_str,
+    list: _pack_list,
+    tuple: _pack_list,
+    dict: _pack_dict,
+    }
+
+
+def _pack_other(obj, default, append):
+    for types, packer in (
+            (bool, _pack_constant),
+            ((int, long), _pack_int),
+            (float, _pack_float),
+            (basestring, _pack_str),
+            ((list, tuple), _pack_list),
+            (dict, _pack_dict)):
+        if isinstance(obj, types):
+            return packer(obj, default, append)
+    obj = default(obj)
+    _packers.get(type(obj), _pack_other)(obj, default, append)
+
+
+def packb(obj):
+    """
+    Serialize an object to MessagePack bytes. Must be called within a Flask app
+    context if the object contains types that need the app's JSON encoder.
+    """
+    if _msgpack is not None:
+        return _msgpack.packb(obj, default=_make_default(), use_bin_type=False)
+    parts = []
+    _packers.get(type(obj), _pack_other)(obj, _make_default(), parts.append)
+    return ''.join(parts)
+
+
+def _unpack(data, offset):
+    code = ord(data[offset])
+    offset += 1
+    if code < 0x80:
+        return code, offset
+    elif code >= 0xe0:
+        return code - 0x100, offset
+    elif code & 0xe0 == 0xa0:
+        return _unpack_raw(data, offset, code & 0x1f)
+    elif code & 0xf0 == 0x90:
+        return _unpack_array(data, offset, code & 0x0f)
+    elif code & 0xf0 == 0x80:
+        return _unpack_map(data, offset, code & 0x0f)
+    elif code == 0xc0:
+        return None, offset
+    elif code == 0xc2:
+        return False, offset
+    elif code == 0xc3:
+        return True, offset
+    elif code in _formats:
+        fmt, handler = _formats[code]
+        size = struct.calcsize(fmt)
+        value = struct.unpack(fmt, data[offset:offset + size])[0]
+        offset += size
+        if handler is None:
+            return value, offset
+        return handler(data, offset, value)
+    else:
+        raise ValueError("Unsupported MessagePack type 0x%02x" % code)
+
+
+def _unpack_raw(data, offset, length):
+    return data[offset:offset + length].decode('utf-8'), offset + length
+
+
+def _unpack_bin(data, offset, length):
+    return data[offset:offset + length], offset + length
+
+
+def _unpack_array(data, offset, length):
+    result = []
+    for index in xrange(length):
+        item, offset = _unpack(data, offset)
+        result.append(item)
+    return result, offset
+
+
+def _unpack_map(data, offset, length):
+    result = {}
+    for index in xrange(length):
+        key, offset = _unpack(data, offset)
+        result[key], offset = _unpack(data, offset)
+    return result, offset
+
+
+_formats = {
+    0xc4: ('>B', _unpack_bin),
+    0xc5: ('>H', _unpack_bin),
+    0xc6: ('>I', _unpack_bin),
+    0xca: ('>f', None),
+    0xcb: ('>d', None),
+    0xcc: ('>B', None),
+    0xcd: ('>H', None),
+    0xce: ('>I', None),
+    0xcf: ('>Q', None),
+    0xd0: ('>b', None),
+    0xd1: ('>h', None),
+    0xd2: ('>i', None),
+    0xd3: ('>q', None),
+    0xd9: ('>B', _unpack_raw),
+    0xda: ('>H', _unpack_raw),
+    0xdb: ('>I', _unpack_raw),
+    0xdc: ('>H', _unpack_array),
+    0xdd: ('>I', _unpack_array),
+    0xde: ('>H', _unpack_map),
+    0xdf: ('>I', _unpack_map),
+    }
+
+
+def unpackb(data):
+    """
+    Deserialize MessagePack bytes, decoding strings as Unicode. Extension types are
+    not supported.
+    """
+    if _msgpack is not None:
+        return _msgpack.unpackb(data, raw=False)
+    value, offset = _unpack(data, 0)
+    return value
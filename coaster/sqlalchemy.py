@@ -2,15 +2,27 @@
 
 from __future__ import absolute_import
 from datetime import datetime
+from itertools import izip
+from operator import attrgetter
+from threading import local
 import simplejson
-from sqlalchemy import Column, Integer, DateTime, Unicode, UnicodeText
+from sqlalchemy import Column, Integer, DateTime, Unicode, UnicodeText, event, literal
 from sqlalchemy.sql import select, func
 from sqlalchemy.types import UserDefinedType, TypeDecorator, TEXT
-from sqlalchemy.orm import composite
+from sqlalchemy import inspect as sqlalchemy_inspect
+from sqlalchemy.orm import (composite, aliased, object_session, load_only, RelationshipProperty,
+    SynonymProperty, ColumnProperty, CompositeProperty)
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
+try:
+    from sqlalchemy.orm import selectinload as _parentload
+except ImportError:  # SQLAlchemy < 1.2
+    from sqlalchemy.orm import subqueryload as _parentload
+from sqlalchemy.exc import InvalidRequestError
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.ext.mutable import Mutable, MutableComposite
-from flask import Markup
+from flask import Markup, _request_ctx_stack
 from flask.ext.sqlalchemy import BaseQuery
 from .utils import make_name
 from .gfm import markdown
@@ -18,7 +30,7 @@ from .gfm import markdown
 
 __all_mixins = ['IdMixin', 'TimestampMixin', 'PermissionMixin', 'UrlForMixin',
     'BaseMixin', 'BaseNameMixin', 'BaseScopedNameMixin', 'BaseIdNameMixin',
-    'BaseScopedIdMixin', 'BaseScopedIdNameMixin']
+    'BaseScopedIdMixin', 'BaseScopedIdNameMixin', 'AncestorPathMixin']
 
 
 class Query(BaseQuery):
@@ -39,6 +51,64 @@ class Query(BaseQuery):
     def notempty(self):
         return self.session.query(self.exists()).first()[0]
 
+    def with_parents(self, depth=1):
+        """
+        Eagerly load the ``parent`` of each result, up to ``depth`` levels up the
+        chain of parents, so that iterating over scoped models (such as
+        :class:`BaseScopedNameMixin` and :class:`BaseScopedIdMixin`) and calling
+        :meth:`~BaseScopedNameMixin.short_title`, :meth:`~BaseScopedNameMixin.make_name`
+        or :meth:`~BaseScopedNameMixin.permissions` does not lazy load each parent
+        separately. Each level is loaded with one additional query (SELECT IN loading
+        with SQLAlchemy 1.2+, subquery loading otherwise), no matter how many results
+        there are. Loading stops at a model that has no ``parent`` relationship.
+        """
+        model = self.column_descriptions[0]['type']
+        loader = None
+        for level in range(depth):
+            prop = _parent_relationship(model)
+            if prop is None:
+                break
+            attr = getattr(model, prop.key)
+            if loader is None:
+                loader = _parentload(attr)
+            else:
+                loader = getattr(loader, _parentload.__name__)(attr)
+            model = prop.mapper.class_
+        if loader is None:
+            return self
+        return self.options(loader)
+
+    def serialized(self):
+        """
+        Return an iterator of dictionaries of the results, as from
+        :meth:`BaseMixin.serialize`. If all of the model's
+        :attr:`~BaseMixin.serialize_fields` are columns, only those columns are
+        queried and no instances are loaded. Otherwise instances are loaded with only
+        the columns in :meth:`~BaseMixin.serialize_columns`.
+        """
+        model = self.column_descriptions[0]['type']
+        serializer = _serializer(model)
+        if serializer.columns is not None:
+            return (serializer.from_row(row) for row in self.with_entities(*serializer.columns))
+        return (serializer.from_object(item) for item in
+            self.options(load_only(*model.serialize_columns())))
+
+
+def _parent_relationship(model):
+    """
+    Return the relationship property that ``parent`` refers to (directly or as a
+    synonym) on the given model, or ``None`` if it isn't a relationship.
+    """
+    try:
+        mapper = sqlalchemy_inspect(model)
+        prop = mapper.get_property('parent')
+        if isinstance(prop, SynonymProperty):
+            prop = mapper.get_property(prop.name)
+    except InvalidRequestError:
+        return None
+    if isinstance(prop, RelationshipProperty):
+        return prop
+
 
 class IdMixin(object):
     """
@@ -89,6 +159,62 @@ class PermissionMixin(object):
             return set()
 
 
+# Permissions cache used by permissions_for outside a request context
+_permissions_local = local()
+
+
+def _permissions_cache():
+    """
+    Return the permissions cache for the current request, or for the current
+    :func:`permissions_for` call outside a request. Returns ``None`` if neither is active.
+    """
+    ctx = _request_ctx_stack.top
+    if ctx is not None:
+        cache = getattr(ctx, 'coaster_permissions_cache', None)
+        if cache is None:
+            cache = ctx.coaster_permissions_cache = {}
+        return cache
+    return getattr(_permissions_local, 'cache', None)
+
+
+def cached_permissions(obj, user, inherited=None):
+    """
+    Return permissions available to the given user on the given object, like
+    ``obj.permissions(user, inherited)``, but memoized for the duration of the request.
+    The memo is keyed by object identity, user and the inherited permissions, and is
+    discarded when the request context is torn down. A new set is returned on each
+    call, so callers may modify it.
+
+    :class:`BaseScopedNameMixin` and :class:`BaseScopedIdMixin` use this to look up
+    permissions inherited from the parent, so the parent's permissions are evaluated
+    once per request no matter how many of its children are checked.
+    """
+    cache = _permissions_cache()
+    if cache is None:
+        return obj.permissions(user, inherited=inherited)
+    frozen = frozenset(inherited) if inherited is not None else None
+    key = (id(obj), id(user), frozen)
+    if key not in cache:
+        # The object and user are stored with the result so that their ids
+        # can't be reused by other objects while the cache is alive
+        cache[key] = (obj, user, frozenset(obj.permissions(user, inherited=inherited)))
+    return set(cache[key][2])
+
+
+def permissions_for(items, user, inherited=None):
+    """
+    Return a dictionary of permissions available to the given user on each of the
+    given items. Permissions of ancestors shared by the items are evaluated only once.
+    """
+    if _permissions_cache() is not None:
+        return dict((item, cached_permissions(item, user, inherited)) for item in items)
+    _permissions_local.cache = {}
+    try:
+        return dict((item, cached_permissions(item, user, inherited)) for item in items)
+    finally:
+        del _permissions_local.cache
+
+
 class UrlForMixin(object):
     """
     Provides a placeholder :meth:`url_for` method used by BaseMixin-derived classes
@@ -107,6 +233,79 @@ class BaseMixin(IdMixin, TimestampMixin, PermissionMixin, UrlForMixin):
     """
     query_class = Query
 
+    #: Names of attributes included in :meth:`serialize`, such as for JSON output.
+    #: Defaults to all columns that aren't deferred. When set, :func:`~coaster.views.load_models`
+    #: with ``load_only=True`` and :meth:`Query.serialized` load only these columns.
+    #: Attributes that aren't columns (such as relationships and properties) are allowed,
+    #: but columns they need must be loaded separately
+    serialize_fields = None
+
+    def serialize(self):
+        """
+        Return a dictionary of :attr:`serialize_fields` and their values
+        """
+        return _serializer(type(self)).from_object(self)
+
+    @classmethod
+    def serialize_columns(cls):
+        """
+        Return the names of the column attributes to load for :meth:`serialize`. In
+        addition to the columns in :attr:`serialize_fields`, these include primary and
+        foreign keys, ``name``, ``url_id`` and ``updated_at``, which are used for
+        loading parents, URLs and conditional requests
+        """
+        return _serializer(cls).load_columns
+
+
+class _Serializer(object):
+    """
+    Compiled serializer for a model, with functions to convert instances and rows
+    to dictionaries
+    """
+    def __init__(self, model):
+        mapper = sqlalchemy_inspect(model)
+        names = model.serialize_fields
+        if names is None:
+            names = [prop.key for prop in mapper.column_attrs if not prop.deferred]
+        names = tuple(names)
+        props = [mapper.attrs[name] if name in mapper.attrs else None for name in names]
+
+        getter = attrgetter(*names)
+        if len(names) == 1:
+            self.from_object = lambda item: {names[0]: getter(item)}
+        else:
+            self.from_object = lambda item: dict(izip(names, getter(item)))
+        self.from_row = lambda row: dict(izip(names, row))
+
+        load_columns = set()
+        for prop in props:
+            if isinstance(prop, ColumnProperty):
+                load_columns.add(prop.key)
+            elif isinstance(prop, CompositeProperty):
+                load_columns.update(mapper.get_property_by_column(column).key for column in prop.columns)
+        for prop in mapper.column_attrs:
+            if prop.key in ('name', 'url_id', 'updated_at') or [column for column in prop.columns
+                    if column.primary_key or column.foreign_keys]:
+                load_columns.add(prop.key)
+        self.load_columns = sorted(load_columns)
+
+        if [prop for prop in props if not isinstance(prop, (ColumnProperty, CompositeProperty))]:
+            self.columns = None
+        else:
+            self.columns = [getattr(model, name) for name in names]
+
+
+_serializers = {}
+
+
+def _serializer(model):
+    """Return the compiled serializer for a model"""
+    try:
+        return _serializers[model]
+    except KeyError:
+        serializer = _serializers[model] = _Serializer(model)
+        return serializer
+
 
 class BaseNameMixin(BaseMixin):
     """
@@ -214,7 +413,7 @@ class BaseScopedNameMixin(BaseMixin):
         if inherited is not None:
             return inherited | super(BaseScopedNameMixin, self).permissions(user)
         elif self.parent is not None and isinstance(self.parent, PermissionMixin):
-            return self.parent.permissions(user) | super(BaseScopedNameMixin, self).permissions(user)
+            return cached_permissions(self.parent, user) | super(BaseScopedNameMixin, self).permissions(user)
         else:
             return super(BaseScopedNameMixin, self).permissions(user)
 
@@ -297,7 +496,7 @@ class BaseScopedIdMixin(BaseMixin):
         if inherited is not None:
             return inherited | super(BaseScopedIdMixin, self).permissions(user)
         else:
-            return self.parent.permissions(user) | super(BaseScopedIdMixin, self).permissions(user)
+            return cached_permissions(self.parent, user) | super(BaseScopedIdMixin, self).permissions(user)
 
 
 class BaseScopedIdNameMixin(BaseScopedIdMixin):
@@ -342,6 +541,182 @@ class BaseScopedIdNameMixin(BaseScopedIdMixin):
         return '%d-%s' % (self.url_id, self.name)
 
 
+class AncestorPathMixin(object):
+    """
+    Opt-in mixin for scoped models in deep hierarchies (such as organization →
+    project → proposal → comment) that maintains a materialized path of each
+    instance's ancestors in :attr:`ancestor_path`. All ancestors can then be loaded
+    in a single query with :meth:`ancestors`, and all descendants of a given model
+    with :meth:`descendants`, instead of walking ``parent`` one query per level.
+    :meth:`permissions` loads all ancestors in one query before inheriting
+    permissions from them, so :func:`~coaster.views.load_models` and other
+    permission checks on deeply nested instances cost one query for the hierarchy.
+
+    The mixin must appear before the scoped mixin in the model's base classes, and
+    ancestors must have an ``id`` primary key, as all :class:`BaseMixin` models do::
+
+        class Comment(AncestorPathMixin, BaseScopedIdMixin, db.Model):
+            __tablename__ = 'comment'
+            proposal_id = db.Column(db.Integer, db.ForeignKey('proposal.id'))
+            proposal = db.relationship(Proposal)
+            parent = db.synonym('proposal')
+            __table_args__ = (db.UniqueConstraint('proposal_id', 'url_id'),)
+
+    The path is set on insert and updated on reparenting, along with the paths of
+    all descendants in tables that use this mixin. Paths are not updated when an
+    ancestor in a table that doesn't use this mixin is reparented, so all models
+    in a hierarchy should use it. :meth:`ancestors` falls back to walking
+    ``parent`` when the path is out of date or the instance is not in a session.
+    """
+    @declared_attr
+    def ancestor_path(cls):
+        """Path of ancestors of this instance, as ``table:id/`` segments starting from the root"""
+        return Column(Unicode(1000), nullable=True, index=True)
+
+    @property
+    def node_path(self):
+        """Path of this instance, which is the prefix of the paths of all its descendants"""
+        return _node_path(self)
+
+    def ancestors(self):
+        """
+        Return a list of ancestors of this instance, starting from the root. Ancestors
+        not already in the session are loaded in a single query.
+        """
+        tokens = [token.split(':') for token in (self.ancestor_path or u'').split('/') if token]
+        if not tokens:
+            return []
+        session = object_session(self)
+        if session is None:
+            return self._walk_parents()
+        models = [_path_model(type(self), tablename) for tablename, id in tokens]
+        keys = [identity_key(model, int(id)) for model, (tablename, id) in zip(models, tokens)]
+        found = [session.identity_map.get(key) for key in keys]
+        if None in found:
+            entities = [aliased(model) for model in models]
+            found = session.query(*entities).filter(*[entity.id == key[1][0]
+                for entity, key in zip(entities, keys)]).first()
+            if found is None:
+                # The path is out of date. Walk up the parents instead
+                return self._walk_parents()
+            elif len(entities) == 1:
+                found = [found]
+        return list(found)
+
+    def _walk_parents(self):
+        ancestors = []
+        parent = self.parent
+        while parent is not None:
+            ancestors.insert(0, parent)
+            parent = getattr(parent, 'parent', None)
+        return ancestors
+
+    def descendants(self, model):
+        """
+        Return a query for all instances of the given model (which must also use this
+        mixin) that are descendants of this instance, at any depth.
+        """
+        return model.query.filter(_path_startswith(model.ancestor_path, self.node_path))
+
+    def permissions(self, user, inherited=None):
+        """
+        Permissions for this model, plus permissions inherited from ancestors, which
+        are loaded in a single query.
+        """
+        if inherited is None:
+            self.ancestors()
+        return super(AncestorPathMixin, self).permissions(user, inherited)
+
+
+def _node_path(obj):
+    """Return the materialized path of an instance, including the instance itself"""
+    mapper = sqlalchemy_inspect(obj).mapper
+    if isinstance(obj, AncestorPathMixin) and obj.ancestor_path is not None:
+        path = obj.ancestor_path
+    else:
+        parent = getattr(obj, 'parent', None)
+        path = _node_path(parent) if parent is not None else u''
+    return path + u'%s:%d/' % (mapper.base_mapper.local_table.name, obj.id)
+
+
+# Map of table names to models for resolving ancestor paths
+_path_models = {}
+
+
+def _path_model(cls, tablename):
+    """Return the model for a table name in an ancestor path"""
+    if tablename not in _path_models:
+        for model in cls._decl_class_registry.values():
+            mapper = getattr(model, '__mapper__', None)
+            if mapper is not None:
+                _path_models.setdefault(mapper.base_mapper.local_table.name, mapper.base_mapper.class_)
+    return _path_models[tablename]
+
+
+def _path_startswith(column, prefix):
+    """Return a LIKE expression matching paths that start with the prefix"""
+    escaped = prefix.replace(u'\\', u'\\\\').replace(u'%', u'\\%').replace(u'_', u'\\_')
+    return column.like(escaped + u'%', escape=u'\\')
+
+
+def _ancestor_path_tables(cls=AncestorPathMixin):
+    """Return the tables of all mapped models that use :class:`AncestorPathMixin`"""
+    tables = set()
+    for subclass in cls.__subclasses__():
+        mapper = getattr(subclass, '__mapper__', None)
+        if mapper is not None:
+            tables.add(mapper.local_table)
+        tables.update(_ancestor_path_tables(subclass))
+    return tables
+
+
+def _parent_changed(target):
+    """Check if the parent of an instance has changed since it was loaded"""
+    prop = _parent_relationship(type(target))
+    if prop is None:
+        return False
+    state = sqlalchemy_inspect(target)
+    keys = [prop.key] + [state.mapper.get_property_by_column(column).key
+        for column in prop.local_columns]
+    return bool([key for key in keys if state.attrs[key].history.has_changes()])
+
+
+def _set_ancestor_path(mapper, connection, target):
+    parent = target.parent
+    target.ancestor_path = _node_path(parent) if parent is not None else u''
+
+
+def _update_ancestor_path(mapper, connection, target):
+    if _parent_changed(target):
+        target._old_node_path = _node_path(target)
+        _set_ancestor_path(mapper, connection, target)
+
+
+def _update_descendant_paths(mapper, connection, target):
+    old = target.__dict__.pop('_old_node_path', None)
+    if old is None:
+        return
+    new = _node_path(target)
+    if old == new:
+        return
+    for table in _ancestor_path_tables():
+        connection.execute(table.update().where(_path_startswith(table.c.ancestor_path, old)).values(
+            ancestor_path=literal(new, Unicode) + func.substr(table.c.ancestor_path, len(old) + 1,
+                type_=Unicode)))
+    # Update descendants already loaded in the session
+    session = object_session(target)
+    if session is not None:
+        for obj in session.identity_map.values():
+            if (isinstance(obj, AncestorPathMixin) and 'ancestor_path' in obj.__dict__
+                    and obj.ancestor_path and obj.ancestor_path.startswith(old)):
+                set_committed_value(obj, 'ancestor_path', new + obj.ancestor_path[len(old):])
+
+
+event.listen(AncestorPathMixin, 'before_insert', _set_ancestor_path, propagate=True)
+event.listen(AncestorPathMixin, 'before_update', _update_ancestor_path, propagate=True)
+event.listen(AncestorPathMixin, 'after_update', _update_descendant_paths, propagate=True)
+
+
 # --- Column types ------------------------------------------------------------
 
 __all_columns = ['JsonDict', 'MarkdownComposite', 'MarkdownColumn']
@@ -13,11 +13,8 @@ from urlparse import urlparse
 
 from collections import namedtuple, OrderedDict
 
-import bcrypt
-import pytz
-import tldextract
-from unidecode import unidecode
-import bleach
+# bcrypt, pytz, tldextract, unidecode and bleach are slow to import and are
+# imported where used, so that importing coaster doesn't load them
 
 from ._version import *
 
@@ -136,6 +133,7 @@ def make_name(text, delim=u'-', maxlength=50, checkused=None, counter=2):
     >>> make_name(u'example@example.com')
     'example-example-com'
     """
+    from unidecode import unidecode
     name = unicode(delim.join([_strip_re.sub('', x) for x in _punctuation_re.split(text.lower()) if x != '']))
     name = unidecode(name).replace('@', 'a')  # We don't know why unidecode uses '@' for 'a'-like chars
     if checkused is None:
@@ -196,6 +194,7 @@ def make_password(password, encoding=u'BCRYPT'):
         return u'{SSHA}%s' % b64encode(hashlib.sha1(password + salt).digest() + salt)
     elif encoding == u'BCRYPT':
         # BCRYPT is the recommended hash for secure passwords
+        import bcrypt
         return u'{BCRYPT}%s' % bcrypt.hashpw(
             password.encode('utf-8') if isinstance(password, unicode) else password,
             bcrypt.gensalt())
@@ -232,6 +231,7 @@ def check_password(reference, attempt):
         compare = unicode('{SSHA}%s' % b64encode(hashlib.sha1(attempt + salt).digest() + salt))
         return (compare == reference)
     elif reference.startswith(u'{BCRYPT}'):
+        import bcrypt
         return bcrypt.hashpw(
             attempt.encode('utf-8') if isinstance(attempt, unicode) else attempt,
             reference[8:]) == reference[8:]
@@ -430,6 +430,7 @@ def sanitize_html(value, valid_tags=VALID_TAGS, strip=True):
     """
     Strips unwanted markup out of HTML.
     """
+    import bleach
     return bleach.clean(value, tags=VALID_TAGS.keys(), attributes=VALID_TAGS, strip=strip)
 
 
@@ -471,10 +472,28 @@ def valid_username(candidate):
     return not _username_valid_re.search(candidate) is None
 
 
+_sorted_timezones_cache = {}
+
+
 def sorted_timezones():
     """
-    Return a list of timezones sorted by offset from UTC.
+    Return a list of timezones sorted by offset from UTC. The list is computed
+    once every 15 minutes, as offsets only change with daylight saving time,
+    which starts and ends on a quarter hour in every timezone.
     """
+    now = datetime.utcnow()
+    quarter = now.replace(minute=now.minute - now.minute % 15, second=0, microsecond=0)
+    result = _sorted_timezones_cache.get(quarter)
+    if result is None:
+        result = _sorted_timezones(quarter)
+        _sorted_timezones_cache.clear()
+        _sorted_timezones_cache[quarter] = result
+    return list(result)
+
+
+def _sorted_timezones(now):
+    import pytz
+
     def hourmin(delta):
         if delta.days < 0:
             hours, remaining = divmod(86400 - delta.seconds, 3600)
@@ -483,7 +502,6 @@ def sorted_timezones():
         minutes, remaining = divmod(remaining, 60)
         return hours, minutes
 
-    now = datetime.utcnow()
     # Make a list of country code mappings
     timezone_country = {}
     for countrycode in pytz.country_timezones:
@@ -491,17 +509,20 @@ def sorted_timezones():
             timezone_country[timezone] = countrycode
 
     # Make a list of timezones, discarding the US/* and Canada/* zones since they aren't reliable for
-    # DST, and discarding UTC and GMT since timezones in that zone have their own names
-    timezones = [(pytz.timezone(tzname).utcoffset(now, is_dst=False), tzname) for tzname in pytz.common_timezones
-        if not tzname.startswith('US/') and not tzname.startswith('Canada/') and tzname not in ('GMT', 'UTC')]
+    # DST, and discarding UTC and GMT since timezones in that zone have their own names.
+    # Offsets are those in effect at ``now``, which is in UTC
+    now = pytz.utc.localize(now)
+    timezones = [(local.utcoffset(), local.tzname(), tzname) for local, tzname in (
+        (now.astimezone(pytz.timezone(tzname)), tzname) for tzname in pytz.common_timezones
+        if not tzname.startswith('US/') and not tzname.startswith('Canada/') and tzname not in ('GMT', 'UTC'))]
     # Sort timezones by offset from UTC and their human-readable name
     presorted = [(delta, '%s%s - %s%s (%s)' % (
             (delta.days < 0 and '-') or (delta.days == 0 and delta.seconds == 0 and ' ') or '+',
             '%02d:%02d' % hourmin(delta),
             (pytz.country_names[timezone_country[name]] + ': ') if name in timezone_country else '',
             name.replace('_', ' '),
-            pytz.timezone(name).tzname(now, is_dst=False)),
-        name) for delta, name in timezones]
+            abbreviation),
+        name) for delta, abbreviation, name in timezones]
     presorted.sort()
     # Return a list of (timezone, label) with the timezone offset included in the label.
     return [(name, label) for (delta, label, name) in presorted]
@@ -542,6 +563,7 @@ def base_domain_matches(d1, d2):
     >>> base_domain_matches('example@example.com', 'example.com')
     True
     """
+    import tldextract
     r1 = tldextract.extract(d1)
     r2 = tldextract.extract(d2)
     # r1 and r2 contain subdomain, domain and suffix.
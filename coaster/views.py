@@ -2,13 +2,51 @@
 
 from __future__ import absolute_import
 from functools import wraps
+import os
+import sys
+import errno
+import inspect
+import base64
 import urlparse
 import re
+import hashlib
+import stat
+import csv
+from collections import Iterator
+from cStringIO import StringIO
+import itertools
+from operator import attrgetter, itemgetter
+from math import ceil
+from threading import Thread, Lock, Event
+from Queue import Queue, Empty
+from time import time
 from flask import (session as request_session, request, url_for, json, Response,
-    redirect, abort, g, current_app, render_template)
+    redirect, abort, g, current_app, render_template,
+    stream_with_context, _request_ctx_stack)
 from werkzeug.routing import BuildError
-from werkzeug.exceptions import BadRequest
+from werkzeug.exceptions import BadRequest, HTTPException, InternalServerError
+from werkzeug.datastructures import Headers
+from werkzeug.test import EnvironBuilder
 from werkzeug.wrappers import Response as WerkzeugResponse
+from sqlalchemy import inspect as sqlalchemy_inspect, and_, bindparam
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.orm import Query, Load, configure_mappers, RelationshipProperty, SynonymProperty
+from sqlalchemy.orm.interfaces import MANYTOONE
+try:
+    from sqlalchemy.ext import baked
+except ImportError:  # SQLAlchemy < 1.0
+    baked = None
+    __bakery = None
+else:
+    # Queries compiled by load_models. Each chain adds a few, so this holds those of
+    # a large app
+    __bakery = baked.bakery(size=2000)
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+from .cache import LRUCache
+from .msgpack import packb
 
 __jsoncallback_re = re.compile(r'^[a-z$_][0-9a-z$_]*$', re.I)
 
@@ -48,6 +86,7 @@ def get_current_url():
 
 
 __marker = []
+__unbaked = []
 
 
 def get_next_url(referrer=False, external=False, session=False, default=__marker):
@@ -85,21 +124,208 @@ def get_next_url(referrer=False, external=False, session=False, default=__marker
         return (default if usedefault else __index_url())
 
 
+__json_chunksize = 8192
+__query_batchsize = 1000
+
+
+def __json_items(value):
+    # Stream query results in batches instead of loading all rows first
+    if isinstance(value, Query):
+        value = value.yield_per(__query_batchsize)
+    yield u'['
+    for index, item in enumerate(value):
+        yield (u',' if index else u'') + json.dumps(item, separators=(',', ':'))
+    yield u']'
+
+
+def __json_key(key):
+    # Coerce a dictionary key to a string the way json.dumps does
+    if isinstance(key, basestring):
+        return key
+    elif key is True:
+        return u'true'
+    elif key is False:
+        return u'false'
+    elif key is None:
+        return u'null'
+    elif isinstance(key, float):
+        return json.dumps(key)
+    elif isinstance(key, (int, long)):
+        return unicode(key)
+    raise TypeError("key %r is not a string" % (key,))
+
+
+def __json_stream(data, callback):
+    # Generate the JSON document in chunks of at least __json_chunksize characters
+    def pieces():
+        if callback:
+            yield u'%s(' % callback
+        yield u'{'
+        for index, key in enumerate(sorted(data)):
+            yield (u',' if index else u'') + json.dumps(__json_key(key)) + u':'
+            value = data[key]
+            if isinstance(value, (Iterator, Query)):
+                for piece in __json_items(value):
+                    yield piece
+            else:
+                yield json.dumps(value, separators=(',', ':'))
+        yield u'}'
+        if callback:
+            yield u');'
+
+    chunk = []
+    size = 0
+    for piece in pieces():
+        chunk.append(piece)
+        size += len(piece)
+        if size >= __json_chunksize:
+            yield u''.join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield u''.join(chunk)
+
+
 def jsonp(*args, **kw):
     """
-    Returns a JSON response with a callback wrapper, if asked for.
+    Returns a JSON response with a callback wrapper, if asked for. The JSON is
+    indented for readability in debug mode, except for XMLHttpRequests, and compact
+    otherwise.
+
+    Values that are iterators (such as generators) or SQLAlchemy queries are
+    streamed as JSON lists, producing the response in chunks as the items are
+    iterated over instead of holding the entire document in memory. Streamed
+    responses are always compact. Queries are iterated with
+    :meth:`~sqlalchemy.orm.query.Query.yield_per`, which does not support eager
+    loading of collections; pass ``iter(query)`` to load all rows before streaming
+    JSON.
     """
-    data = json.dumps(dict(*args, **kw),
-        indent=None if request.is_xhr else 2)
+    data = dict(*args, **kw)
     callback = request.args.get('callback', request.args.get('jsonp'))
     if callback and __jsoncallback_re.search(callback) is not None:
-        data = u'%s(' % callback + data + u');'
         mimetype = 'application/javascript'
     else:
+        callback = None
         mimetype = 'application/json'
+    if [value for value in data.values() if isinstance(value, (Iterator, Query))]:
+        return Response(stream_with_context(__json_stream(data, callback)), mimetype=mimetype)
+    if current_app.debug and not request.is_xhr:
+        data = json.dumps(data, indent=2)
+    else:
+        data = json.dumps(data, separators=(',', ':'))
+    if callback:
+        data = u'%s(' % callback + data + u');'
     return Response(data, mimetype=mimetype)
 
 
+def msgpackify(*args, **kw):
+    """
+    Returns a MessagePack response, a compact binary alternative to :func:`jsonp`
+    for API clients that support it. Takes the same parameters as :func:`jsonp` and
+    encodes the same types. See :mod:`coaster.msgpack`.
+    """
+    return Response(packb(dict(*args, **kw)), mimetype='application/x-msgpack')
+
+
+__csv_chunksize = 65536
+
+
+def __csv_value(value, encoding):
+    if value is None:
+        return ''
+    elif isinstance(value, unicode):
+        return value.encode(encoding, 'replace')
+    elif isinstance(value, str):
+        return value
+    else:
+        return unicode(value).encode(encoding, 'replace')
+
+
+def __csv_stream(rows, columns, encoding):
+    # Generate the CSV in chunks of at least __csv_chunksize bytes
+    if isinstance(rows, Query):
+        rows = rows.yield_per(__query_batchsize)
+    rows = iter(rows)
+    buf = StringIO()
+    writer = csv.writer(buf)
+    if columns is None:
+        try:
+            first = next(rows)
+        except StopIteration:
+            return
+        rows = itertools.chain([first], rows)
+        fields = getattr(first, '_fields', None)
+        if fields is not None:
+            writer.writerow([__csv_value(field, encoding) for field in fields])
+        itemgetters = attrgetters = None
+    else:
+        headers = [column[0] if isinstance(column, tuple) else column for column in columns]
+        names = [column[1] if isinstance(column, tuple) else column for column in columns]
+        writer.writerow([__csv_value(header, encoding) for header in headers])
+        itemgetters = [itemgetter(name) for name in names]
+        attrgetters = [attrgetter(name) for name in names]
+    # Send the header before fetching rows, so the response starts at once
+    yield buf.getvalue()
+    buf.seek(0)
+    buf.truncate()
+
+    for row in rows:
+        if itemgetters is None:
+            values = row
+        elif isinstance(row, dict):
+            values = [getter(row) for getter in itemgetters]
+        else:
+            values = [getter(row) for getter in attrgetters]
+        writer.writerow([__csv_value(value, encoding) for value in values])
+        if buf.tell() >= __csv_chunksize:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def csvstream(data):
+    """
+    Returns a streamed CSV response. Used as a template in :func:`render_with`,
+    which provides it for the ``text/csv`` mimetype when ``csv=True``. For
+    download links, where the browser's Accept header will not ask for CSV, use
+    it as the only template::
+
+        @app.route('/<event>/participants.csv')
+        @render_with({'*/*': csvstream})
+        def participants_csv(event):
+            return {
+                'rows': Participant.query.filter_by(event=event),
+                'columns': ['fullname', ('Email', 'email'), ('Ticket', 'ticket.title')],
+                'filename': 'participants.csv',
+                }
+
+    :param data: Dictionary with these keys:
+
+        * ``rows``: An iterable of rows, such as a generator, or a SQLAlchemy query,
+          which is iterated in batches with
+          :meth:`~sqlalchemy.orm.query.Query.yield_per`
+        * ``columns``: Optional list of columns. Each column is the name of a key
+          (for rows that are dictionaries) or attribute (for other rows, with dotted
+          names for attributes of attributes), or a tuple of (header, name). If
+          not specified, rows must be sequences of values, and are given a header
+          if they are named tuples, such as rows from a query for columns
+        * ``filename``: Optional filename, which makes the response an attachment
+        * ``encoding``: Encoding of the CSV, defaults to UTF-8. Characters that
+          the encoding can't represent are replaced with ``?``
+
+    The response is produced in chunks of about 64 KB, so exports are streamed
+    with bounded memory.
+    """
+    encoding = data.get('encoding', 'utf-8')
+    headers = {}
+    if data.get('filename'):
+        headers['Content-Disposition'] = 'attachment; filename="%s"' % data['filename'].replace('"', '')
+    return Response(stream_with_context(__csv_stream(data['rows'], data.get('columns'), encoding)),
+        content_type='text/csv; charset=%s' % encoding, headers=headers)
+
+
 class RequestTypeError(BadRequest, TypeError):
     """Exception that combines TypeError with BadRequest. Used by :func:`requestargs`."""
     pass
@@ -110,7 +336,24 @@ class RequestValueError(BadRequest, ValueError):
     pass
 
 
-def requestargs(*vars):
+def __requestargs_source(source):
+    # Return a function that returns the request data to read parameters from, as a
+    # tuple of (data, is_multidict)
+    if source == 'json':
+        def get_source():
+            data = request.get_json(silent=True)
+            return (data if isinstance(data, dict) else {}), False
+    elif source in ('values', 'args', 'form'):
+        getter = attrgetter(source)
+
+        def get_source():
+            return getter(request), True
+    else:
+        raise ValueError("Unknown requestargs source: %r" % source)
+    return get_source
+
+
+def requestargs(*vars, **config):
     """
     Decorator that loads parameters from request.values if not specified in the
     function's keyword arguments. Usage::
@@ -121,16 +364,26 @@ def requestargs(*vars):
 
     requestargs takes a list of parameters to pass to the wrapped function, with
     an optional filter (useful to convert incoming string request data into integers
-    and other common types). If a required parameter is missing and your function does
-    not specify a default value, Python will raise TypeError. requestargs recasts this
-    as :exc:`RequestTypeError`, which returns HTTP 400 Bad Request.
+    and other common types). The wrapped function's signature is inspected once. If a
+    required parameter is missing, or a parameter is not accepted by the function,
+    requestargs raises :exc:`RequestTypeError`, which returns HTTP 400 Bad Request.
+    A :exc:`TypeError` raised inside the function is not caught.
 
     If the parameter name ends in ``[]``, requestargs will attempt to read a list from
     the incoming data. Filters are applied to each member of the list, not to the whole
     list.
 
-    If the filter raises a ValueError, this is recast as a :exc:`RequestValueError`,
-    which also returns HTTP 400 Bad Request.
+    If the filter raises a ValueError or TypeError (as ``int`` does for a JSON
+    ``null``), this is recast as a :exc:`RequestValueError`, which also returns
+    HTTP 400 Bad Request.
+
+    Parameters are read from ``request.values`` (query string and form data combined)
+    by default. To read from only one of these, or from a JSON request body, pass
+    ``source='args'``, ``source='form'`` or ``source='json'``::
+
+        @requestargs('name', ('tags[]', unicode), source='json')
+        def function(name, tags=None):
+            ...
 
     Tests::
 
@@ -156,39 +409,395 @@ def requestargs(*vars):
         ...
         ('1', '2', [1, 2])
     """
+    get_source = __requestargs_source(config.pop('source', 'values'))
+    if config:
+        raise TypeError("Unexpected keyword arguments: %s" % ', '.join(sorted(config)))
+    namefilt = tuple((name[:-2], filt, True) if name.endswith('[]') else (name, filt, False)
+        for name, filt in
+            [(v[0], v[1]) if isinstance(v, (list, tuple)) else (v, None) for v in vars])
+
     def inner(f):
-        namefilt = [(name[:-2], filt, True) if name.endswith('[]') else (name, filt, False)
-            for name, filt in
-                [(v[0], v[1]) if isinstance(v, (list, tuple)) else (v, None) for v in vars]]
+        # Inspect the signature once. Decorated functions that take **kwargs accept
+        # any parameter, leaving the check to the function they wrap
+        try:
+            argspec = inspect.getargspec(f)
+        except TypeError:  # Not a Python function, so we can't check its parameters
+            required = ()
+            accepted = None
+        else:
+            defaults = len(argspec.defaults or ())
+            required = tuple(argspec.args[:len(argspec.args) - defaults])
+            accepted = None if argspec.keywords else frozenset(argspec.args)
 
         @wraps(f)
         def decorated_function(**kw):
-            for name, filt, is_list in namefilt:
-                if name not in kw:
-                    if request and name in request.values:
-                        if filt is None:
-                            if is_list:
-                                kw[name] = request.values.getlist(name)
+            if request:
+                data, multi = get_source()
+                for name, filt, is_list in namefilt:
+                    if name not in kw and name in data:
+                        if is_list:
+                            if multi:
+                                value = data.getlist(name)
                             else:
-                                kw[name] = request.values[name]
+                                value = data[name]
+                                if not isinstance(value, list):
+                                    value = [value]
                         else:
+                            value = data[name]
+                        if filt is not None:
                             try:
                                 if is_list:
-                                    kw[name] = [filt(v) for v in request.values.getlist(name)]
+                                    value = [filt(v) for v in value]
                                 else:
-                                    kw[name] = filt(request.values[name])
-                            except ValueError, e:
+                                    value = filt(value)
+                            except (ValueError, TypeError), e:
+                                # TypeError is raised for unsuitable JSON values, such as null
                                 raise RequestValueError(e)
-            try:
-                return f(**kw)
-            except TypeError, e:
-                raise RequestTypeError(e)
+                        kw[name] = value
+            for name in required:
+                if name not in kw:
+                    raise RequestTypeError("Missing required parameter: %s" % name)
+            if accepted is not None:
+                for name in kw:
+                    if name not in accepted:
+                        raise RequestTypeError("Unexpected parameter: %s" % name)
+            return f(**kw)
         return decorated_function
     return inner
 
 
+def __resolve_property(mapper, attr):
+    """
+    Return the mapper property for an attribute, following synonyms, or ``None``
+    if the attribute isn't a mapped property.
+    """
+    try:
+        prop = mapper.get_property(attr)
+        if isinstance(prop, SynonymProperty):
+            prop = mapper.get_property(prop.name)
+    except InvalidRequestError:
+        return None
+    return prop
+
+
+def __relationship_join(model, attr, target):
+    """
+    Return the join condition between ``model`` and ``target`` if ``attr`` is a
+    many-to-one relationship (or a synonym for one) from ``model`` to ``target``,
+    or ``None`` if the two can't be joined on this attribute.
+    """
+    mapper = sqlalchemy_inspect(model)
+    prop = __resolve_property(mapper, attr)
+    if (isinstance(prop, RelationshipProperty) and prop.direction is MANYTOONE
+            and prop.secondary is None and prop.mapper.local_table is not mapper.local_table
+            and issubclass(target, prop.mapper.class_)):
+        return prop.primaryjoin
+
+
+def __chain_runs(chain, load_only=False):
+    """
+    Split a :func:`load_models` chain into runs of links that can be loaded together
+    in one JOINed query. A link is added to the current run if it refers to earlier
+    links in the run only through many-to-one relationships and does not need their
+    loaded instances to build its filters (as callable and dotted attributes do).
+    A link with alternative models ends its run, as each alternative needs its own
+    query, as does a link with a model that defines ``redirect_view_args``.
+
+    Each run is a tuple of (``links``, ``plans``). Each link is a tuple of
+    (``models``, ``attributes``, ``parameter``, ``joins``, ``plans``), where ``joins``
+    maps attributes to the index of the link in the run they refer to. ``plans`` are
+    the precompiled queries from :func:`__bake_query` for each alternative model,
+    for the run as a whole and for each link by itself.
+
+    If ``load_only`` is True, models that declare
+    :attr:`~coaster.sqlalchemy.BaseMixin.serialize_fields` are loaded with only the
+    columns needed to serialize them.
+    """
+    configure_mappers()
+    runs = []
+    links = None
+    for models, attributes, parameter in chain:
+        if not isinstance(models, (list, tuple)):
+            models = (models,)
+        models = tuple(models)
+        joins = None
+        if links is not None:
+            joins = __run_joins(links, models, attributes)
+        if joins is None:
+            links = []
+            runs.append(links)
+            joins = {}
+        plans = [__bake_query([(model, attributes, {})], load_only) for model in models]
+        links.append((models, attributes, parameter, joins, plans))
+        # Redirect objects are only detected once loaded, so nothing may be joined to them
+        if len(models) > 1 or [m for m in models if hasattr(m, 'redirect_view_args')]:
+            links = None
+
+    compiled = []
+    for links in runs:
+        if len(links) > 1:
+            plans = [__bake_query([(models[0], attributes, joins)
+                for models, attributes, parameter, joins, linkplans in links[:-1]] +
+                [(last, links[-1][1], links[-1][3])], load_only) for last in links[-1][0]]
+        else:
+            plans = None
+        compiled.append((links, plans))
+    return compiled
+
+
+def __run_joins(links, models, attributes):
+    """
+    Return a dictionary of attributes to the index of the link in the run that they
+    refer to, or ``None`` if a link with these models and attributes can't join the run.
+    """
+    run_models = [m for link in links for m in link[0]]
+    if [m for m in models if m in run_models]:
+        return None
+    names = dict((link[2][2:] if link[2].startswith('g.') else link[2], index)
+        for index, link in enumerate(links))
+    joins = {}
+    for k, v in attributes.items():
+        if callable(v) or '.' in v:
+            return None
+        if k == 'url_name' and [m for m in models if hasattr(m, 'url_id_attr')]:
+            continue
+        if v in names:
+            target = links[names[v]][0][0]
+            for model in models:
+                if __relationship_join(model, k, target) is None:
+                    return None
+            joins[k] = names[v]
+    return joins
+
+
+def __bake_query(links, load_only=False):
+    """
+    Compile a query for a list of (``model``, ``attributes``, ``joins``) links, with
+    bound parameters in place of values from the request, so that loading only needs
+    to bind parameters. Returns a tuple of (``baked_query``, ``entities``, ``binds``),
+    or ``None`` if baked queries are not available or the links can't be expressed
+    with bound parameters.
+    """
+    if baked is None:
+        return None
+    entities = []
+    criteria = []
+    binds = []
+    # The bakery keys queries by the code of the function that builds them, which
+    # is the same for all of them, and by this key, which is unique to the query
+    key = (tuple((model, tuple(sorted(attributes.items())), tuple(sorted(joins.items())))
+        for model, attributes, joins in links), load_only)
+    for model, attributes, joins in links:
+        mapper = sqlalchemy_inspect(model)
+        for k, index in joins.items():
+            criteria.append(__relationship_join(model, k, entities[index]))
+        for k, v in attributes.items():
+            if k in joins:
+                continue
+            name = 'p%d' % len(binds)
+            if k == 'url_name' and hasattr(model, 'url_id_attr'):
+                criteria.append(getattr(model, model.url_id_attr) == bindparam(name))
+                binds.append(('url_name', v, name))
+                continue
+            prop = __resolve_property(mapper, k)
+            if isinstance(prop, RelationshipProperty):
+                if prop.direction is not MANYTOONE or prop.secondary is not None:
+                    return None
+                keys = []
+                for index, (local, remote) in enumerate(prop.local_remote_pairs):
+                    keyname = '%s_%d' % (name, index)
+                    criteria.append(local == bindparam(keyname))
+                    keys.append((keyname, prop.mapper.get_property_by_column(remote).key))
+                binds.append(('instance', v, (prop.mapper.class_, keys)))
+            else:
+                criteria.append(getattr(model, k) == bindparam(name))
+                binds.append(('value', v, name))
+        entities.append(model)
+
+    def build(session):
+        query = session.query(*entities).filter(and_(*criteria))
+        if load_only:
+            query = query.options(*__load_only(entities))
+        return query
+
+    return __bakery(build, key), entities, binds
+
+
+def __load_only(entities):
+    """
+    Return query options to load only the columns needed to serialize the entities
+    that declare :attr:`~coaster.sqlalchemy.BaseMixin.serialize_fields`.
+    """
+    return [Load(entity).load_only(*entity.serialize_columns()) for entity in entities
+        if getattr(entity, 'serialize_fields', None) is not None]
+
+
+def __link_value(v, result, kw):
+    """Return the value of a link attribute from the request and previously loaded instances"""
+    if callable(v):
+        return v(result, kw)
+    elif '.' in v:
+        first, attrs = v.split('.', 1)
+        val = result.get(first)
+        for attr in attrs.split('.'):
+            val = getattr(val, attr)
+        return val
+    else:
+        return result.get(v, kw.get(v))
+
+
+def __url_id(url_name):
+    """Return the id from an id-name URL parameter, or ``None`` if it's malformed"""
+    parts = url_name.split('-')
+    try:
+        return int(parts[0])
+    except ValueError:
+        return None
+
+
+def __load_baked(plan, result, kw):
+    """
+    Load the first row for a precompiled query. Returns ``__unbaked`` if there is no
+    plan or the request's values can't be bound to it (such as ``None`` values, which
+    must be tested with ``IS NULL``), in which case the caller must build the query.
+    """
+    if plan is None:
+        return __unbaked
+    bq, entities, binds = plan
+    params = {}
+    for kind, v, name in binds:
+        if kind == 'url_name':
+            val = __url_id(kw.get(v))
+        else:
+            val = __link_value(v, result, kw)
+        if kind == 'instance':
+            cls, keys = name
+            if not isinstance(val, cls):
+                return __unbaked
+            for keyname, key in keys:
+                params[keyname] = getattr(val, key)
+                if params[keyname] is None:
+                    return __unbaked
+        elif val is None:
+            return __unbaked
+        else:
+            params[name] = val
+    return bq(entities[0].query.session).params(**params).first()
+
+
+def __filter_link(query, model, attributes, result, kw, joins={}):
+    """
+    Filter the query for a chain link. Attributes in ``joins`` are skipped, as they
+    are handled by join conditions. Returns ``None`` if the ``url_name`` parameter
+    is malformed.
+    """
+    for k, v in attributes.items():
+        if k == 'url_name' and hasattr(model, 'url_id_attr'):
+            url_id = __url_id(kw.get(v))
+            if url_id is None:
+                return None
+            query = query.filter(getattr(model, model.url_id_attr) == url_id)
+        elif k not in joins:
+            query = query.filter(getattr(model, k) == __link_value(v, result, kw))
+    return query
+
+
+def __load_link(models, attributes, plans, result, kw, load_only=False):
+    """
+    Load a single chain link, trying each model in turn. Aborts with a 404 if
+    no instance is found.
+    """
+    for model, plan in zip(models, plans):
+        item = __load_baked(plan, result, kw)
+        if item is __unbaked:
+            query = model.query
+            if load_only:
+                query = query.options(*__load_only([model]))
+            query = __filter_link(query, model, attributes, result, kw)
+            if query is None:
+                abort(404)
+            item = query.first()
+        if item is not None:
+            # We found it, so don't look in additional models
+            return item
+    abort(404)
+
+
+def __load_run(links, plans, result, kw, load_only=False):
+    """
+    Load all links in a run with a single JOINed query, or one query per alternative
+    model if the last link has alternatives. Returns a list of instances, or ``None``
+    if nothing was found.
+    """
+    for last, plan in zip(links[-1][0], plans):
+        row = __load_baked(plan, result, kw)
+        if row is __unbaked:
+            entities = []
+            query = None
+            for models, attributes, parameter, joins, linkplans in links:
+                model = last if len(entities) == len(links) - 1 else models[0]
+                if query is None:
+                    query = model.query
+                else:
+                    query = query.add_entity(model)
+                for k, index in joins.items():
+                    query = query.filter(__relationship_join(model, k, entities[index]))
+                query = __filter_link(query, model, attributes, result, kw, joins)
+                if query is None:
+                    return None
+                entities.append(model)
+            if load_only:
+                query = query.options(*__load_only(entities))
+            row = query.first()
+        if row is not None:
+            return list(row)
+    return None
+
+
+def __conditional_validators(items, permissions):
+    """
+    Return a weak ETag and Last-Modified date for a response derived from the given
+    instances and permissions.
+    """
+    digest = hashlib.sha1()
+    timestamps = []
+    for item in items:
+        updated_at = getattr(item, 'updated_at', None)
+        if updated_at is not None:
+            timestamps.append(updated_at)
+        digest.update('%s:%s:%s\n' % (item.__class__.__name__, getattr(item, 'id', None),
+            updated_at.isoformat() if updated_at is not None else ''))
+    digest.update(repr(sorted(permissions or [])))
+    # The rendered representation depends on content negotiation
+    digest.update(request.headers.get('Accept', u'').encode('utf-8'))
+    if timestamps:
+        # HTTP dates have a resolution of one second
+        last_modified = max(timestamps).replace(microsecond=0)
+    else:
+        last_modified = None
+    return digest.hexdigest(), last_modified
+
+
+def __not_modified(etag, last_modified):
+    """Check if the request's conditional headers match the validators"""
+    if request.if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified is not None:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def __set_validators(response, etag, last_modified):
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.vary.add('Accept')
+
+
 def load_model(model, attributes=None, parameter=None,
-        workflow=False, kwargs=False, permission=None, addlperms=None):
+        workflow=False, kwargs=False, permission=None, addlperms=None, conditional=False,
+        load_only=False):
     """
     Decorator to load a model given a query parameter.
 
@@ -245,9 +854,25 @@ def load_model(model, attributes=None, parameter=None,
         permissions available to the user, apart from those granted by the models. In an app
         that uses Lastuser for authentication, passing ``lastuser.permissions`` will pass
         through permissions granted via Lastuser
+
+    :param conditional: If True, GET and HEAD requests get a weak ``ETag`` derived from
+        the loaded instances' ids and ``updated_at`` timestamps, the user's permissions
+        and the request's ``Accept`` header, and a ``Last-Modified`` date from the latest
+        ``updated_at`` timestamp. Requests with a matching ``If-None-Match`` or
+        ``If-Modified-Since`` header get a ``304 Not Modified`` response without calling
+        the decorated function, so no template is rendered. Use this only for views
+        whose output depends on nothing but these (such as ``TimestampMixin`` models
+        rendered with :func:`render_with`)
+
+    :param load_only: If True and the model declares
+        :attr:`~coaster.sqlalchemy.BaseMixin.serialize_fields`, only the columns in
+        :meth:`~coaster.sqlalchemy.BaseMixin.serialize_columns` are loaded, for views
+        that return :meth:`~coaster.sqlalchemy.BaseMixin.serialize` output. Other
+        attributes are loaded when first accessed, with a query each
     """
     return load_models((model, attributes, parameter),
-        workflow=workflow, kwargs=kwargs, permission=permission, addlperms=addlperms)
+        workflow=workflow, kwargs=kwargs, permission=permission, addlperms=addlperms,
+        conditional=conditional, load_only=load_only)
 
 
 def load_models(*chain, **kwargs):
@@ -284,10 +909,34 @@ def load_models(*chain, **kwargs):
             permission='view')
         def show_page(folder, page):
             return render_template('page.html', folder=folder, page=page)
+
+    Consecutive links in the chain that refer to each other through many-to-one
+    relationships (like ``'parent': 'folder'`` above) are loaded together in a single
+    JOINed query, or one query per model if a link has alternative models. Links with
+    callable or dotted attributes need the previously loaded instances and start a new
+    query, as do links after a model that defines ``redirect_view_args``. If a joined
+    query finds nothing, the request is aborted with a 404. With SQLAlchemy 1.0 or later,
+    these queries are compiled once as baked queries and each request only binds the
+    values from the URL.
+
+    :param load_only: If ``True``, models that declare
+        :attr:`~coaster.sqlalchemy.BaseMixin.serialize_fields` are loaded with only
+        the columns in :meth:`~coaster.sqlalchemy.BaseMixin.serialize_columns`, for
+        views that return :meth:`~coaster.sqlalchemy.BaseMixin.serialize` output.
+        Other attributes are loaded when first accessed, with a query each
     """
     def inner(f):
+        # The chain is compiled into runs on first use, when all mappers can be configured.
+        # The lock makes concurrent first requests wait for a single compilation
+        runs = []
+        compiling = Lock()
+
         @wraps(f)
         def decorated_function(**kw):
+            if not runs:
+                with compiling:
+                    if not runs:
+                        runs[:] = __chain_runs(chain, kwargs.get('load_only', False))
             permissions = None
             permission_required = kwargs.get('permission')
             if isinstance(permission_required, basestring):
@@ -295,91 +944,562 @@ def load_models(*chain, **kwargs):
             elif permission_required is not None:
                 permission_required = set(permission_required)
             result = {}
-            for models, attributes, parameter in chain:
-                if not isinstance(models, (list, tuple)):
-                    models = (models,)
-                item = None
-                for model in models:
-                    query = model.query
-                    url_check = False
-                    url_key = url_name = None
-                    for k, v in attributes.items():
-                        if k == 'url_name' and hasattr(model, 'url_id_attr'):
-                            url_key = v
-                            url_name = kw.get(url_key)
-                            parts = url_name.split('-')
-                            if request and request.method == 'GET':
-                                url_check = True
-                            try:
-                                url_id = int(parts[0])
-                            except ValueError:
-                                abort(404)
-                            query = query.filter_by(**{model.url_id_attr: url_id})
-                        else:
-                            if callable(v):
-                                query = query.filter_by(**{k: v(result, kw)})
-                            else:
-                                if '.' in v:
-                                    first, attrs = v.split('.', 1)
-                                    val = result.get(first)
-                                    for attr in attrs.split('.'):
-                                        val = getattr(val, attr)
-                                else:
-                                    val = result.get(v, kw.get(v))
-                                query = query.filter_by(**{k: val})
-                    item = query.first()
-                    if item is not None:
-                        # We found it, so don't look in additional models
-                        break
-                if item is None:
-                    abort(404)
-
-                if hasattr(item, 'redirect_view_args'):
-                    # This item is a redirect object. Redirect to destination
-                    view_args = dict(request.view_args)
-                    view_args.update(item.redirect_view_args())
-                    return redirect(url_for(request.endpoint, **view_args), code=302)
-
-                if permission_required:
-                    permissions = item.permissions(g.user, inherited=permissions)
-                    addlperms = kwargs.get('addlperms') or []
-                    if callable(addlperms):
-                        addlperms = addlperms() or []
-                    permissions.update(addlperms)
-                if g:
-                    g.permissions = permissions
-                if url_check:
-                    if item.url_name != url_name:
-                        # The url_name doesn't match.
-                        # Redirect browser to same page with correct url_name.
+            loaded = []
+            for links, plans in runs:
+                items = None
+                if plans:
+                    items = __load_run(links, plans, result, kw, kwargs.get('load_only', False))
+                    if items is None:
+                        # One of the links doesn't exist
+                        abort(404)
+                for index, (models, attributes, parameter, joins, linkplans) in enumerate(links):
+                    if items is None:
+                        item = __load_link(models, attributes, linkplans, result, kw,
+                            kwargs.get('load_only', False))
+                    else:
+                        item = items[index]
+
+                    if hasattr(item, 'redirect_view_args'):
+                        # This item is a redirect object. Redirect to destination
                         view_args = dict(request.view_args)
-                        view_args[url_key] = item.url_name
+                        view_args.update(item.redirect_view_args())
                         return redirect(url_for(request.endpoint, **view_args), code=302)
-                if parameter.startswith('g.'):
-                    parameter = parameter[2:]
-                    setattr(g, parameter, item)
-                result[parameter] = item
+
+                    if permission_required:
+                        permissions = item.permissions(g.user, inherited=permissions)
+                        addlperms = kwargs.get('addlperms') or []
+                        if callable(addlperms):
+                            addlperms = addlperms() or []
+                        permissions.update(addlperms)
+                    if g:
+                        g.permissions = permissions
+                    if 'url_name' in attributes and hasattr(item, 'url_id_attr') and request and request.method == 'GET':
+                        url_key = attributes['url_name']
+                        if item.url_name != kw.get(url_key):
+                            # The url_name doesn't match.
+                            # Redirect browser to same page with correct url_name.
+                            view_args = dict(request.view_args)
+                            view_args[url_key] = item.url_name
+                            return redirect(url_for(request.endpoint, **view_args), code=302)
+                    if parameter.startswith('g.'):
+                        parameter = parameter[2:]
+                        setattr(g, parameter, item)
+                    result[parameter] = item
+                    loaded.append(item)
             if kwargs.get('workflow'):
                 # Get workflow for the last item in the chain
                 wf = item.workflow()
-                if permission_required and not (permission_required & permissions):
-                    abort(403)
+            if permission_required and not (permission_required & permissions):
+                abort(403)
+
+            etag = last_modified = None
+            if kwargs.get('conditional') and request and request.method in ('GET', 'HEAD'):
+                etag, last_modified = __conditional_validators(loaded, permissions)
+                if __not_modified(etag, last_modified):
+                    rv = current_app.response_class(status=304)
+                    __set_validators(rv, etag, last_modified)
+                    return rv
+
+            if kwargs.get('workflow'):
                 if kwargs.get('kwargs'):
-                    return f(wf, kwargs=kw)
+                    rv = f(wf, kwargs=kw)
                 else:
-                    return f(wf)
+                    rv = f(wf)
             else:
-                if permission_required and not (permission_required & permissions):
-                    abort(403)
                 if kwargs.get('kwargs'):
-                    return f(kwargs=kw, **result)
+                    rv = f(kwargs=kw, **result)
                 else:
-                    return f(**result)
+                    rv = f(**result)
+            if etag is None:
+                return rv
+            rv = current_app.make_response(rv)
+            if rv.status_code == 200:
+                __set_validators(rv, etag, last_modified)
+            return rv
+        # Lets render_with refuse to cache responses without checking permissions
+        decorated_function._loads_models = True
         return decorated_function
     return inner
 
 
-def render_with(template, json=True):
+class ResponseCache(object):
+    """
+    Response cache for :func:`render_with`. Responses are cached by endpoint, view
+    arguments, query string and negotiated mimetype, and optionally by the return
+    value of a ``vary`` callable, such as one returning the current user's id or
+    permissions. Only successful (``200 OK``), non-streamed responses to ``GET`` and
+    ``HEAD`` requests that do not set cookies are cached. Usage::
+
+        event_cache = ResponseCache(timeout=60, stale=300)
+
+        @app.route('/<event>')
+        @render_with('event.html', cache=event_cache)
+        def event(event):
+            return {'event': event}
+
+    A response older than ``timeout`` seconds but within ``stale`` seconds after that
+    is served as is while a single background thread renders a fresh copy. The
+    refresh dispatches a copy of the request that triggered it in a new request
+    context, running ``before_request`` handlers and all decorators of the view
+    (including :func:`load_models`) again with the thread's own database session,
+    so views must not depend on the request body.
+
+    A cached response is returned without calling the decorators below
+    :func:`render_with`, so access checks must be placed above it, or the cache
+    must vary by user. :func:`render_with` refuses to cache or coalesce a view
+    decorated with :func:`load_models`; place :func:`load_models` above it instead::
+
+        @app.route('/<event>')
+        @load_models((Event, {'name': 'event'}, 'event'), permission='view')
+        @render_with('event.html', cache=event_cache)
+        def event(event):
+            return {'event': event}
+
+    :param int timeout: Seconds for which a cached response is fresh
+    :param int stale: Seconds after expiry for which a stale response may be served
+    :param vary: Optional callable that returns additional (hashable) cache key data
+    :param backend: Werkzeug cache to store responses in, such as a
+        :class:`~werkzeug.contrib.cache.RedisCache` shared between processes.
+        Defaults to an in-memory :class:`~coaster.cache.LRUCache`
+    :param int maxsize: Size of the default in-memory cache
+    :param str key_prefix: Prefix for cache keys, for backends shared with other data
+
+    Cache statistics are available in :attr:`stats` and :attr:`hit_ratio`.
+    """
+    def __init__(self, timeout=60, stale=0, vary=None, backend=None, maxsize=1000,
+            key_prefix='coaster/render_with/'):
+        self.timeout = timeout
+        self.stale = stale
+        self.vary = vary
+        self.backend = backend if backend is not None else LRUCache(maxsize=maxsize)
+        self.key_prefix = key_prefix
+        #: Counts of fresh hits, stale hits, misses and background refreshes, and
+        #: seconds spent rendering responses and saved by serving them from cache
+        self.stats = {'hits': 0, 'stale': 0, 'misses': 0, 'refreshes': 0,
+            'render_time': 0.0, 'render_time_saved': 0.0}
+        self._lock = Lock()
+
+    @property
+    def hit_ratio(self):
+        """Fraction of requests served from cache, including stale responses"""
+        hits = self.stats['hits'] + self.stats['stale']
+        total = hits + self.stats['misses']
+        return float(hits) / total if total else 0.0
+
+    def _count(self, stat, value=1):
+        with self._lock:
+            self.stats[stat] += value
+
+    def key(self, mimetype):
+        """Return the cache key for the current request and the negotiated mimetype"""
+        parts = [request.endpoint, sorted((request.view_args or {}).items()),
+            request.query_string, mimetype]
+        if self.vary is not None:
+            parts.append(self.vary())
+        return self.key_prefix + hashlib.sha1(repr(parts)).hexdigest()
+
+    def __call__(self, render, mimetype):
+        """
+        Return a cached response for the current request if available, calling
+        ``render`` to get and cache a new response otherwise.
+        """
+        if request.method not in ('GET', 'HEAD'):
+            return render()
+        key = self.key(mimetype)
+        if request.environ.get('coaster.cache_refresh') is self:
+            return self._render(key, render)
+        entry = self.backend.get(key)
+        if entry is None:
+            self._count('misses')
+            return self._render(key, render)
+        created, duration, frozen = entry
+        if time() - created < self.timeout:
+            self._count('hits')
+        else:
+            self._count('stale')
+            self._refresh(key, render)
+        self._count('render_time_saved', duration)
+        status, headers, data = frozen
+        return current_app.response_class(data, status=status, headers=headers)
+
+    def _render(self, key, render):
+        start = time()
+        response = render()
+        duration = time() - start
+        self._count('render_time', duration)
+        if (response.status_code == 200 and not response.is_streamed and
+                'Set-Cookie' not in response.headers):
+            self.backend.set(key, (time(), duration,
+                (response.status_code, response.headers.to_list(), response.get_data())),
+                timeout=int(ceil(self.timeout + self.stale)))
+        return response
+
+    def _refresh(self, key, render):
+        # Only one refresh per key, across processes if the backend is shared
+        lock = key + '/refresh'
+        if not self.backend.add(lock, True, timeout=max(int(ceil(self.stale)), 1)):
+            return
+        app = current_app._get_current_object()
+        environ = dict(request.environ)
+        environ.pop('werkzeug.request', None)
+        environ['wsgi.input'] = StringIO()
+        environ['coaster.cache_refresh'] = self
+
+        def refresh():
+            try:
+                with app.request_context(environ):
+                    app.full_dispatch_request()
+                self._count('refreshes')
+            except Exception:
+                app.logger.exception("Background refresh of cached response failed")
+            finally:
+                self.backend.delete(lock)
+
+        thread = Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+
+class _Flight(object):
+    # A computation in progress, which concurrent requests wait on
+    def __init__(self):
+        self.done = Event()
+        self.frozen = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent requests for the same page into a single computation.
+    The first request for a key computes the response while concurrent requests
+    with the same key wait for it and get a copy of the same response, instead of
+    all of them recomputing it at once when a popular page's cache entry expires.
+    Usable as a decorator below the route, or as the ``coalesce`` parameter of
+    :func:`render_with`, where it coalesces rendering per negotiated mimetype::
+
+        @app.route('/<event>')
+        @SingleFlight()
+        def event(event):
+            return render_template('event.html', event=event)
+
+        @app.route('/<event>/schedule')
+        @render_with('schedule.html', cache=schedule_cache, coalesce=SingleFlight())
+        def schedule(event):
+            return {'event': event}
+
+    Requests are coalesced per process unless ``lockdir`` is given, in which case
+    computations also take an exclusive lock on a file in that directory, and
+    requests in other worker processes on the same host that were waiting on the
+    lock use the response the lock holder saved there. Only successful,
+    non-streamed responses are shared. Otherwise waiting requests compute their own.
+    Lock files are removed when the computation is done, and saved responses once
+    they are ``expires`` seconds old. As saved responses are served to other
+    requests, ``lockdir`` must be private to the app's user. It is created if
+    missing, and :exc:`ValueError` is raised if other users can write to it.
+
+    Requests are only coalesced with requests from the same session (by session
+    cookie and ``Authorization`` header) unless ``per_session`` is False, which is
+    safe only for pages that are the same for all users.
+
+    :param vary: Optional callable that returns additional (hashable) key data.
+        Requests are keyed by endpoint, view arguments and query string
+    :param bool per_session: Coalesce requests only within the same session
+    :param str lockdir: Directory for lock and response files shared across processes
+    :param timeout: Maximum seconds to wait for a computation in this process
+        before computing independently. Waits indefinitely by default
+    :param int expires: Seconds after which saved responses are removed from ``lockdir``
+    """
+    def __init__(self, vary=None, per_session=True, lockdir=None, timeout=None, expires=60):
+        if lockdir is not None:
+            if fcntl is None:  # pragma: no cover
+                raise ValueError("File locks are not supported on this platform")
+            try:
+                os.makedirs(lockdir, 0700)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            st = os.stat(lockdir)
+            if st.st_uid != os.getuid() or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                raise ValueError("Lock directory %s must be owned by this user and not writable "
+                    "by others" % lockdir)
+        self.vary = vary
+        self.per_session = per_session
+        self.lockdir = lockdir
+        self.timeout = timeout
+        self.expires = expires
+        self._flights = {}
+        self._lock = Lock()
+        self._swept = time()
+
+    def __call__(self, f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if not request:
+                return f(*args, **kwargs)
+            return self.run(self.key(), lambda: current_app.make_response(f(*args, **kwargs)))
+        return decorated_function
+
+    def key(self, mimetype=None):
+        """Return the key for the current request and optional negotiated mimetype"""
+        parts = [request.endpoint, sorted((request.view_args or {}).items()),
+            request.query_string, mimetype]
+        if self.per_session:
+            parts.append((request.cookies.get(current_app.session_cookie_name),
+                request.headers.get('Authorization')))
+        if self.vary is not None:
+            parts.append(self.vary())
+        return hashlib.sha1(repr(parts)).hexdigest()
+
+    def run(self, key, func):
+        """
+        Call ``func`` to get a response for ``key``, or wait for a concurrent call
+        with the same key and return a copy of its response.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            flight.done.wait(self.timeout)
+            if flight.frozen is not None:
+                return self._thaw(flight.frozen)
+            return func()
+        try:
+            if self.lockdir is not None:
+                response, flight.frozen = self._run_locked(key, func)
+            else:
+                response = func()
+                flight.frozen = self._freeze(response)
+            return response
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _run_locked(self, key, func):
+        path = os.path.join(self.lockdir, key)
+        started = time()
+        try:
+            while True:
+                with open(path + '.lock', 'a') as lockfile:
+                    fcntl.flock(lockfile, fcntl.LOCK_EX)
+                    try:
+                        # Use the response of a computation that finished while we waited
+                        try:
+                            if os.path.getmtime(path + '.response') >= started:
+                                with open(path + '.response', 'rb') as responsefile:
+                                    frozen = self._load(responsefile.read())
+                                return self._thaw(frozen), frozen
+                        except (IOError, OSError, ValueError, TypeError):
+                            pass
+                        # The lock file is removed by its holder when done. If this one
+                        # was, wait on the file that replaced it instead
+                        try:
+                            if os.stat(path + '.lock').st_ino != os.fstat(lockfile.fileno()).st_ino:
+                                continue
+                        except OSError:
+                            continue
+                        try:
+                            response = func()
+                            frozen = self._freeze(response)
+                            if frozen is not None:
+                                fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+                                with os.fdopen(fd, 'wb') as responsefile:
+                                    responsefile.write(self._dump(frozen))
+                                os.rename(path + '.tmp', path + '.response')
+                            return response, frozen
+                        finally:
+                            os.unlink(path + '.lock')
+                    finally:
+                        fcntl.flock(lockfile, fcntl.LOCK_UN)
+        finally:
+            self._sweep()
+
+    def _sweep(self):
+        # Remove saved responses that are too old for any waiting request to use
+        now = time()
+        if now - self._swept < self.expires:
+            return
+        self._swept = now
+        for filename in os.listdir(self.lockdir):
+            if filename.endswith('.response'):
+                filepath = os.path.join(self.lockdir, filename)
+                try:
+                    if os.path.getmtime(filepath) < now - self.expires:
+                        os.unlink(filepath)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _freeze(response):
+        if (response.status_code != 200 or response.is_streamed or
+                'Set-Cookie' in response.headers):
+            return None
+        return (response.status_code, response.headers.to_list(), response.get_data())
+
+    @staticmethod
+    def _thaw(frozen):
+        status, headers, data = frozen
+        return current_app.response_class(data, status=status, headers=headers)
+
+    @staticmethod
+    def _dump(frozen):
+        # Saved responses are read by other processes, so they are stored as data
+        # that can't run code when loaded: a line of JSON with the status and
+        # headers, followed by the body
+        status, headers, data = frozen
+        return json.dumps([status, [(key.decode('latin-1'), value.decode('latin-1'))
+            for key, value in headers]]) + '\n' + data
+
+    @staticmethod
+    def _load(saved):
+        meta, sep, data = saved.partition('\n')
+        if not sep:
+            raise ValueError("Incomplete response")
+        status, headers = json.loads(meta)
+        if not isinstance(status, int) or not all(isinstance(key, unicode) and
+                isinstance(value, unicode) for key, value in headers):
+            raise ValueError("Invalid response")
+        return status, [(key.encode('latin-1'), value.encode('latin-1'))
+            for key, value in headers], data
+
+
+def __parse_accept(accept):
+    # Return a dictionary of media ranges to (quality, position) from an Accept header
+    ranges = {}
+    for position, item in enumerate(accept.split(',')):
+        params = item.split(';')
+        mimetype = params[0].strip().lower()
+        if '/' not in mimetype:
+            continue
+        quality = 1.0
+        for param in params[1:]:
+            name, sep, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = min(max(float(value), 0.0), 1.0)
+                except ValueError:
+                    pass
+        if mimetype not in ranges or ranges[mimetype][0] < quality:
+            ranges[mimetype] = (quality, position)
+    return ranges
+
+
+def __negotiate_mimetype(accept, mimetypes):
+    # Each mimetype is acceptable at the quality of the most specific media range
+    # matching it. The best mimetype has the highest quality, then the most specific
+    # match, then the earliest position in the Accept header. A '*/*' mimetype is the
+    # default and is acceptable at the highest quality, but loses to any mimetype
+    # named in the header at that quality.
+    ranges = __parse_accept(accept)
+    best = None
+    best_score = None
+    for mimetype in mimetypes:
+        if mimetype == '*/*':
+            continue
+        for specificity, media_range in (
+                (2, mimetype), (1, mimetype.split('/', 1)[0] + '/*'), (0, '*/*')):
+            if media_range in ranges:
+                quality, position = ranges[media_range]
+                score = (quality, specificity, -position)
+                if quality > 0 and (best_score is None or score > best_score):
+                    best, best_score = mimetype, score
+                break
+    if '*/*' in mimetypes:
+        quality = max([q for q, p in ranges.values()] or [1.0])
+        if best_score is None or (quality, 0.5) > best_score[:2]:
+            best = '*/*'
+    return best
+
+
+__negotiated = {}
+__negotiated_maxsize = 1000
+
+
+def __best_mimetype(accept, mimetypes):
+    # Negotiation results are memoized as few distinct Accept headers are seen. The
+    # memo is cleared when full instead of tracking recent use, which would cost
+    # more per request than the negotiation saves
+    key = (accept, mimetypes)
+    try:
+        return __negotiated[key]
+    except KeyError:
+        if len(__negotiated) >= __negotiated_maxsize:
+            __negotiated.clear()
+        result = __negotiated[key] = __negotiate_mimetype(accept, mimetypes)
+        return result
+
+
+def __stream_template(template_name, context, buffer_size):
+    # Like render_template, but returns an iterator that renders the template as
+    # it is consumed, in the current request context
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    stream = app.jinja_env.get_or_select_template(template_name).stream(context)
+    stream.enable_buffering(buffer_size)
+    return stream_with_context(stream)
+
+
+def __render_with(f, args, kwargs, templates, use_mimetype, stream=None):
+    # Get the result
+    result = f(*args, **kwargs)
+
+    # Is the result a Response object? Don't attempt rendering
+    if isinstance(result, (Response, WerkzeugResponse, current_app.response_class)):
+        return result
+
+    # Did the result include status code and headers?
+    if isinstance(result, tuple):
+        resultset = result
+        result = resultset[0]
+        if len(resultset) > 1:
+            status_code = resultset[1]
+        else:
+            status_code = None
+        if len(resultset) > 2:
+            headers = resultset[2]
+        else:
+            headers = None
+    else:
+        status_code = None
+        headers = None
+
+    # Now render the result with the template for the mimetype
+    if callable(templates[use_mimetype]):
+        rendered = templates[use_mimetype](result)
+        if isinstance(rendered, Response):
+            if status_code is not None:
+                rendered.status_code = status_code
+            if headers is not None:
+                rendered.headers.extend(headers)
+        else:
+            rendered = current_app.response_class(
+                rendered,
+                status=status_code,
+                headers=headers,
+                mimetype=use_mimetype)
+    elif stream is not None:
+        rendered = current_app.response_class(
+            __stream_template(templates[use_mimetype], result, stream),
+            status=status_code, headers=headers,
+            mimetype=None if use_mimetype == '*/*' else use_mimetype)
+    else:
+        if use_mimetype != '*/*':
+            rendered = current_app.response_class(
+                render_template(templates[use_mimetype], **result),
+                status=status_code, headers=headers,
+                mimetype=use_mimetype)
+        else:
+            rendered = render_template(templates[use_mimetype], **result)
+            if status_code is not None and headers is not None:
+                rendered = (rendered, status_code, headers)
+            elif status_code is not None:
+                rendered = (rendered, status_code)
+    return rendered
+
+
+def render_with(template, json=True, csv=False, msgpack=False, stream=False, cache=None,
+        coalesce=None):
     """
     Decorator to render the wrapped method with the given template (or dictionary
     of mimetype keys to templates, where the template is a string name of a template
@@ -418,6 +1538,11 @@ def render_with(template, json=True):
     returned with the same mimetype. Callable templates must return Response objects
     to ensure the correct mimetype is set.
 
+    The template is chosen by negotiation with the request's Accept header, which
+    honours quality values and wildcards such as ``text/*``. A template given as a
+    string (or with the ``*/*`` key) is the default, used unless the Accept header
+    prefers another of the available mimetypes.
+
     If the method is called outside a request context, the wrapped method's original
     return value is returned. This is meant to facilitate testing and should not be
     used to call the method from within another view handler as the presence of a
@@ -427,6 +1552,23 @@ def render_with(template, json=True):
 
     render_with provides a default JSONP handler for the ``application/json``,
     ``text/json`` and ``text/x-json`` mimetypes if :param:`json` is True (default).
+    A streaming CSV handler for ``text/csv`` is provided if :param:`csv` is True;
+    see :func:`csvstream` for the data it expects. A MessagePack handler for
+    ``application/x-msgpack`` is provided if :param:`msgpack` is True.
+
+    Templates are rendered in full before the response is sent. For long pages, pass
+    ``stream=True`` to send the page as it renders, which lowers the time to first
+    byte and peak memory. The output is sent in chunks of five template events; pass
+    a number instead of ``True`` to change this. Streamed responses are not cached
+    or coalesced, and the template must not depend on anything that changes after
+    the view returns.
+
+    Rendered responses can be cached by passing a :class:`ResponseCache` as
+    :param:`cache`. The wrapped method is not called when a cached response is
+    available. Concurrent requests that render the same response can be coalesced
+    into a single call by passing a :class:`SingleFlight` as :param:`coalesce`.
+    Decorators below render_with are skipped for cached and coalesced responses, so
+    :func:`load_models` and other access checks must be placed above it.
     """
     if json:
         templates = {
@@ -435,86 +1577,210 @@ def render_with(template, json=True):
             'text/x-json': jsonp,
             }
     else:
-        template = {}
+        templates = {}
+    if csv:
+        templates['text/csv'] = csvstream
+    if msgpack:
+        templates['application/x-msgpack'] = msgpackify
     if isinstance(template, basestring):
         templates['*/*'] = template
     elif isinstance(template, dict):
         templates.update(template)
     else:  # pragma: no cover
         raise ValueError("Expected string or dict for template")
+    mimetypes = tuple(sorted(templates))
+    if stream is True:
+        buffer_size = 5
+    elif stream:
+        buffer_size = stream
+    else:
+        buffer_size = None
 
     def inner(f):
+        if (cache is not None or coalesce is not None) and getattr(f, '_loads_models', False):
+            raise ValueError("load_models must be placed above render_with when caching or coalescing")
+
         @wraps(f)
         def decorated_function(*args, **kwargs):
             # Check if we need to bypass rendering
             render = kwargs.pop('_render', True)
 
-            # Get the result
-            result = f(*args, **kwargs)
-
-            # Is the result a Response object? Don't attempt rendering
-            if isinstance(result, (Response, WerkzeugResponse, current_app.response_class)):
-                return result
-
-            # Did the result include status code and headers?
-            if isinstance(result, tuple):
-                resultset = result
-                result = resultset[0]
-                if len(resultset) > 1:
-                    status_code = resultset[1]
-                else:
-                    status_code = None
-                if len(resultset) > 2:
-                    headers = resultset[2]
-                else:
-                    headers = None
-            else:
-                status_code = None
-                headers = None
-
-            # Find a matching mimetype between Accept headers and available templates
+            # Find the best match between Accept headers and available templates
             use_mimetype = None
             if render and request:
-                mimetypes = [m.strip() for m in request.headers.get(
-                    'Accept', '').replace(';', ',').split(',') if '/' in m]
-                use_mimetype = None
-                for mimetype in mimetypes:
-                    if mimetype in templates:
-                        use_mimetype = mimetype
-                        break
-                if use_mimetype is None:
-                    if '*/*' in templates:
-                        use_mimetype = '*/*'
-
-            # Now render the result with the template for the mimetype
-            if use_mimetype is not None:
-                if callable(templates[use_mimetype]):
-                    rendered = templates[use_mimetype](result)
-                    if isinstance(rendered, Response):
-                        if status_code is not None:
-                            rendered.status_code = status_code
-                        if headers is not None:
-                            rendered.headers.extend(headers)
-                    else:
-                        rendered = current_app.response_class(
-                            rendered,
-                            status_code=status_code,
-                            headers=headers,
-                            mimetype=use_mimetype)
-                else:
-                    if use_mimetype != '*/*':
-                        rendered = current_app.response_class(
-                            render_template(templates[use_mimetype], **result),
-                            status_code=status_code, headers=headers,
-                            mimetype=use_mimetype)
-                    else:
-                        rendered = render_template(templates[use_mimetype], **result)
-                        if status_code is not None and headers is not None:
-                            rendered = (rendered, status_code, headers)
-                        elif status_code is not None:
-                            rendered = (rendered, status_code)
-                return rendered
+                use_mimetype = __best_mimetype(request.headers.get('Accept', ''), mimetypes)
+
+            if use_mimetype is None:
+                return f(*args, **kwargs)
+            elif cache is None and coalesce is None:
+                return __render_with(f, args, kwargs, templates, use_mimetype, buffer_size)
+
+            def render():
+                return current_app.make_response(
+                    __render_with(f, args, kwargs, templates, use_mimetype, buffer_size))
+            if coalesce is not None:
+                render_one = render
+                key = coalesce.key(use_mimetype)
+
+                def render():
+                    return coalesce.run(key, render_one)
+            if cache is not None:
+                return cache(render, use_mimetype)
             else:
-                return result
+                return render()
         return decorated_function
     return inner
+
+
+def __batch_response(response):
+    # Return a dictionary describing a sub-request's response
+    result = {'status': response.status_code,
+        'headers': dict((k, v) for k, v in response.headers if k.lower() not in ('content-length', 'set-cookie'))}
+    if response.mimetype in ('application/json', 'text/json', 'text/x-json'):
+        result['body'] = json.loads(response.get_data())
+    elif response.mimetype.startswith('text/') or response.mimetype == 'application/javascript':
+        result['body'] = response.get_data(as_text=True)
+    else:
+        result['body'] = base64.b64encode(response.get_data())
+        result['encoding'] = 'base64'
+    return result
+
+
+def __batch_dispatch(app, environ, parent_session):
+    # Dispatch a sub-request in its own request context. As in a standalone
+    # request, URL value preprocessors and before_request handlers (of the app
+    # and the view's blueprint) run first and may return a response instead,
+    # as access checks do
+    ctx = app.request_context(environ)
+    _request_ctx_stack.push(ctx)
+    ctx.session = parent_session
+    try:
+        try:
+            rv = app.preprocess_request()
+            if rv is None:
+                if ctx.request.routing_exception is not None:
+                    raise ctx.request.routing_exception
+                rv = app.view_functions[ctx.request.url_rule.endpoint](**ctx.request.view_args)
+        except HTTPException, e:
+            rv = app.handle_http_exception(e)
+        except Exception:
+            if app.propagate_exceptions:
+                raise
+            app.log_exception(sys.exc_info())
+            rv = InternalServerError()
+        return __batch_response(app.make_response(rv))
+    finally:
+        _request_ctx_stack.pop()
+
+
+def dispatch_batch(subrequests, concurrent=False, max_workers=4):
+    """
+    Dispatch a list of sub-requests to the app's views within the current request
+    and return a list of their responses. Each sub-request is a dictionary with a
+    ``url`` (path and optional query string) and optional ``method`` (default
+    ``GET``), ``headers`` (a dictionary, added to the batch request's headers) and
+    ``data`` (a string or dictionary of form data). Each response is a dictionary
+    with ``status``, ``headers`` and ``body``, which is decoded if JSON, text if
+    textual, and base64-encoded otherwise (with ``encoding`` set to ``base64``).
+
+    Each sub-request has its own request context, so :func:`requestargs`,
+    :func:`load_models` and :func:`render_with` see its URL, parameters and headers,
+    while sharing the batch request's application context (including :obj:`~flask.g`
+    and ``g.user``), cookie session and database session. Errors are handled as in
+    standalone requests. URL value preprocessors and ``before_request`` handlers
+    run for each sub-request, so that access checks in them apply, while
+    ``after_request`` handlers run only for the batch request. Sub-requests can't
+    be batch requests themselves.
+
+    If ``concurrent`` is True, sub-requests are dispatched in up to ``max_workers``
+    threads. Each thread has its own application context, with a copy of
+    :obj:`~flask.g`, and its own Flask-SQLAlchemy database session, which is removed
+    when the thread is done, so instances in ``g`` from the batch request's session
+    must not be used to load additional data. Use this only for independent
+    sub-requests that do not write to the database.
+    """
+    app = current_app._get_current_object()
+    parent = _request_ctx_stack.top
+    base_headers = [(k, v) for k, v in parent.request.headers
+        if k.lower() not in ('content-type', 'content-length')]
+
+    def environ(subrequest):
+        headers = Headers(base_headers)
+        for k, v in (subrequest.get('headers') or {}).items():
+            headers[k] = v
+        return EnvironBuilder(subrequest['url'], base_url=parent.request.url_root,
+            method=subrequest.get('method', 'GET').upper(), headers=headers,
+            data=subrequest.get('data'), environ_base={
+                'REMOTE_ADDR': parent.request.environ.get('REMOTE_ADDR'),
+                'coaster.batch': True}).get_environ()
+
+    environs = [environ(subrequest) for subrequest in subrequests]
+    if not concurrent or len(environs) < 2:
+        return [__batch_dispatch(app, env, parent.session) for env in environs]
+
+    gvars = dict(g.__dict__)
+    results = [None] * len(environs)
+    errors = []
+    pending = Queue()
+    for index, env in enumerate(environs):
+        pending.put((index, env))
+
+    def worker():
+        # The database session is removed when the app context is torn down
+        with app.app_context():
+            g.__dict__.update(gvars)
+            try:
+                while True:
+                    try:
+                        index, env = pending.get_nowait()
+                    except Empty:
+                        break
+                    results[index] = __batch_dispatch(app, env, parent.session)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [Thread(target=worker) for i in range(min(max_workers, len(environs)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+def batch_view(concurrent=False, max_requests=20, max_workers=4):
+    """
+    Returns a view for a batch endpoint that dispatches sub-requests with
+    :func:`dispatch_batch`. Register it for ``POST`` requests::
+
+        app.add_url_rule('/api/batch', 'batch', batch_view(), methods=['POST'])
+
+    The request body must be a JSON object with a list of sub-requests as
+    ``requests``. The response is a JSON object with the list of responses as
+    ``responses``.
+
+    :param bool concurrent: Dispatch sub-requests concurrently if they are all
+        ``GET`` requests, which must then not write to the database
+    :param int max_requests: Maximum number of sub-requests in a batch. Sub-requests
+        can't be batch requests, so this bounds the views called per request
+    :param int max_workers: Maximum number of threads for concurrent dispatch
+    """
+    def view():
+        # Nested batches would multiply the work of a request beyond max_requests
+        if request.environ.get('coaster.batch'):
+            raise BadRequest("Batch requests can't be nested")
+        data = request.get_json(force=True, silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get('requests'), list):
+            raise BadRequest("Expected a JSON object with a list of requests")
+        if len(data['requests']) > max_requests:
+            raise BadRequest("A batch may have at most %d requests" % max_requests)
+        for subrequest in data['requests']:
+            if (not isinstance(subrequest, dict) or not isinstance(subrequest.get('url'), basestring) or
+                    not isinstance(subrequest.get('method', 'GET'), basestring)):
+                raise BadRequest("Each request must be a JSON object with a URL")
+        readonly = all(
+            subrequest.get('method', 'GET').upper() == 'GET' for subrequest in data['requests'])
+        return jsonp(responses=dispatch_batch(data['requests'],
+            concurrent=concurrent and readonly, max_workers=max_workers))
+    return view
@@ -63,4 +63,5 @@ setup(name='coaster',
     zip_safe=True,
     test_suite='tests',
     install_requires=requires,
+    extras_require={'msgpack': ['msgpack-python>=0.5.2']},
     )
@@ -1,6 +1,9 @@
 """
 Configuration used by coaster test suite
 """
+import os
+import tempfile
+
 SETTINGS_KEY = 'settings'
 ADMINS = ['test@example.com', ]
 DEFAULT_MAIL_SENDER = ('HasGeek', 'test@example.com')
@@ -10,3 +13,5 @@ MAIL_USERNAME = 'username'
 MAIL_PASSWORD = 'PASSWORD'
 SECRET_KEY = 'd vldvnvnvjn'
 SQLALCHEMY_DATABASE_URI = 'postgresql://:@localhost:5432/coaster_test'
+# Keep the log written by coaster.logging.init_app out of the working directory
+LOGFILE = os.path.join(tempfile.gettempdir(), 'coaster-test-error.log')
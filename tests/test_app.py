@@ -2,11 +2,32 @@
 
 import unittest
 from os import environ
+import os
 import sys
-from flask import Flask
-from coaster.app import _additional_config, configure, load_config_from_file, SandboxedFlask
+import shutil
+import tempfile
+from time import time, sleep
+import jinja2
+from flask import Flask, render_template, render_template_string
+from sqlalchemy import Column, Integer, Unicode
+from sqlalchemy.ext.declarative import declarative_base
+import coaster.app
+from coaster.app import (_additional_config, configure, load_config_from_file, SandboxedFlask,
+    SandboxBudgetExceeded,
+    TemplateBytecodeCache, precompile_templates, warmup, warmup_steps)
 from coaster.logging import init_app, LocalVarFormatter
 
+Base = declarative_base()
+
+
+class AllowedMixin(object):
+    id = Column(Integer, primary_key=True)
+
+
+class AllowedDocument(AllowedMixin, Base):
+    __tablename__ = 'allowed_document'
+    title = Column(Unicode(250))
+
 
 class TestCoasterUtils(unittest.TestCase):
     def setUp(self):
@@ -62,3 +83,273 @@ class TestSandBoxedFlask(unittest.TestCase):
 
         obj = Test("Name", "secret")
         self.assertEqual(template.render(obj=obj), "%s, " % (obj.name))
+
+    def test_attribute_cache(self):
+        env = self.app.jinja_env
+
+        def function():
+            pass
+
+        class Code(object):
+            func_code = u'code'
+
+        class Proxy(object):
+            def __init__(self, target):
+                self.target = target
+
+            @property
+            def __class__(self):
+                return self.target.__class__
+
+            def __getattr__(self, name):
+                return getattr(self.target, name)
+
+        # The safety of func_code depends on the object, including for proxies
+        template = env.from_string(u'{{ obj.func_code }}')
+        self.assertEqual(template.render(obj=Code()), u'code')
+        self.assertEqual(template.render(obj=Proxy(Code())), u'code')
+        self.assertEqual(template.render(obj=function), u'')
+        self.assertEqual(template.render(obj=Proxy(function)), u'')
+        self.assertEqual(template.render(obj=Code()), u'code')
+
+    def test_allow_attributes(self):
+        env = self.app.jinja_env
+        template = env.from_string(u'{{ obj.id }} {{ obj.title }} {% if obj.metadata %}M{% endif %}'
+            u'{{ obj._sa_instance_state }}')
+        document = AllowedDocument(id=1, title=u'Title')
+        self.assertEqual(template.render(obj=document), u'1 Title M')
+
+        # Safety is remembered per type, for declared attributes and others
+        key = (AllowedDocument, AllowedDocument)
+        self.assertEqual(env._attribute_safety[key + ('title',)], True)
+        self.assertEqual(env._attribute_safety[key + ('_sa_instance_state',)], False)
+        env.allow_attributes(AllowedMixin)
+        self.assertEqual(env._attribute_safety, {})
+        self.assertEqual(template.render(obj=document), u'1 Title M')
+        self.assertEqual(env._attribute_safety[key + ('id',)], True)
+        env.allow_attributes(AllowedDocument, ['title'])
+        self.assertEqual(env._attribute_safety, {})
+        self.assertEqual(template.render(obj=document), u'1 Title M')
+        self.assertEqual(env._attribute_safety[key + ('title',)], True)
+        self.assertRaises(ValueError, env.allow_attributes, AllowedDocument, ['_sa_instance_state'])
+
+        # Columns of a model are allowed by default
+        env.allow_attributes(AllowedDocument)
+        self.assertEqual(env._allowed_attributes[AllowedDocument], frozenset(['id', 'title']))
+
+
+class TestSandboxBudget(unittest.TestCase):
+    def setUp(self):
+        self.app = SandboxedFlask(__name__)
+        self.app.config.update(
+            SANDBOX_MAX_RENDER_TIME=0.2,
+            SANDBOX_MAX_OPERATIONS=10000,
+            SANDBOX_MAX_OUTPUT_SIZE=1000,
+            SANDBOX_MAX_DEPTH=20)
+        self.app.jinja_loader = jinja2.DictLoader({
+            'loop.html': u'{% for i in range(count) %}{{ i }}{% endfor %}',
+            'include.html': u'{% for i in range(10) %}{% include "loop.html" %}{% endfor %}',
+            })
+        self.env = self.app.jinja_env
+
+    def assertExceeds(self, limit, source, **context):
+        template = self.env.from_string(source)
+        with self.assertRaises(SandboxBudgetExceeded) as cm:
+            template.render(**context)
+        self.assertEqual(cm.exception.limit, limit)
+        self.assertEqual(cm.exception.code, 500)
+        self.assertEqual(self.env.budget_stats[limit], 1)
+
+    def test_within_budget(self):
+        self.assertEqual(self.env.get_template('loop.html').render(count=5), u'01234')
+        self.assertEqual(u''.join(self.env.get_template('loop.html').generate(count=3)), u'012')
+
+    def test_operations(self):
+        self.assertExceeds('operations', u'{% for i in range(20000) %}{% endfor %}')
+        # Operations in included templates count towards the budget
+        self.assertEqual(len(self.env.get_template('include.html').render(count=10)), 100)
+        with self.assertRaises(SandboxBudgetExceeded):
+            self.env.get_template('include.html').render(count=1000)
+        # Each render has its own budget
+        self.assertEqual(self.env.get_template('loop.html').render(count=5), u'01234')
+
+    def test_time(self):
+        self.app.config['SANDBOX_MAX_OPERATIONS'] = None
+        self.env = self.app.create_jinja_environment()
+        self.assertExceeds('time',
+            u'{% for i in range(100000) %}{% for j in range(100000) %}{% endfor %}{% endfor %}')
+
+    def test_streamed(self):
+        # Time spent waiting on the client doesn't count, and the budget is only
+        # current while the template runs
+        events = self.env.get_template('loop.html').generate(count=3)
+        self.assertEqual(next(events), u'0')
+        self.assertEqual(getattr(self.env._budgets, 'current', None), None)
+        sleep(0.3)
+        self.assertEqual(self.env.get_template('loop.html').render(count=5), u'01234')
+        self.assertEqual(u''.join(events), u'12')
+        self.assertEqual(self.env.budget_stats['time'], 0)
+
+    def test_output(self):
+        self.assertExceeds('output', u'{% for i in range(200) %}{{ text }}{% endfor %}', text=u'abcdef')
+
+    def test_depth(self):
+        self.assertExceeds('depth', u'{% macro nest(n) %}{{ nest(n + 1) }}{% endmacro %}{{ nest(0) }}')
+
+    def test_response(self):
+        app = self.app
+
+        @app.route('/')
+        def index():
+            return render_template_string(u'{% for i in range(20000) %}{% endfor %}')
+        self.assertEqual(app.test_client().get('/').status_code, 500)
+        self.assertEqual(self.env.budget_stats['operations'], 1)
+
+    def test_unlimited(self):
+        app = SandboxedFlask(__name__)
+        self.assertFalse(app.jinja_env.budgeted)
+        template = app.jinja_env.from_string(u'{% for i in range(20000) %}{% endfor %}done')
+        self.assertEqual(template.render(), u'done')
+
+
+class TestTemplateCache(unittest.TestCase):
+    def setUp(self):
+        self.templates = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        for name, source in [
+                ('page.html', u'<p>{{ text }}</p>'),
+                ('broken.html', u'{% if %}')]:
+            with open(os.path.join(self.templates, name), 'w') as f:
+                f.write(source)
+
+    def tearDown(self):
+        shutil.rmtree(self.templates)
+        shutil.rmtree(self.cache_dir)
+
+    def make_app(self, app_class):
+        app = app_class(__name__, template_folder=self.templates)
+        app.config['TEMPLATE_CACHE_DIR'] = self.cache_dir
+        coaster.app.init_app(app, 'testing')
+        return app
+
+    def cached_files(self, cache):
+        return sorted(f for f in os.listdir(cache.directory) if f.endswith('.cache'))
+
+    def test_precompile(self):
+        for app_class in (Flask, SandboxedFlask):
+            app = self.make_app(app_class)
+            cache = app.jinja_env.bytecode_cache
+            self.assertTrue(isinstance(cache, TemplateBytecodeCache))
+            self.assertTrue(cache.directory.startswith(self.cache_dir))
+            self.assertTrue(jinja2.__version__ in cache.directory)
+
+            compiled, errors = precompile_templates(app)
+            self.assertEqual(compiled, ['page.html'])
+            self.assertEqual([name for name, error in errors], ['broken.html'])
+            self.assertEqual(len(self.cached_files(cache)), 1)
+
+            # A new app (as in a new worker) loads the compiled template from the cache
+            app = self.make_app(app_class)
+            with app.test_request_context():
+                self.assertEqual(render_template('page.html', text='cached'), u'<p>cached</p>')
+            self.assertEqual(len(self.cached_files(cache)), 1)
+            shutil.rmtree(cache.directory)
+
+    def test_modified(self):
+        app = self.make_app(Flask)
+        cache = app.jinja_env.bytecode_cache
+        precompile_templates(app)
+        first = self.cached_files(cache)
+        filename = os.path.join(self.templates, 'page.html')
+        with open(filename, 'w') as f:
+            f.write(u'<div>{{ text }}</div>')
+        os.utime(filename, (time() + 10, time() + 10))
+
+        app = self.make_app(Flask)
+        with app.test_request_context():
+            self.assertEqual(render_template('page.html', text='new'), u'<div>new</div>')
+        # The entry for the earlier version is replaced
+        self.assertEqual(len(self.cached_files(cache)), 1)
+        self.assertNotEqual(first, self.cached_files(cache))
+
+    def test_budgeted(self):
+        # Bytecode compiled without limits is not used when limits are set
+        with open(os.path.join(self.templates, 'loop.html'), 'w') as f:
+            f.write(u'{% for i in range(count) %}{{ i }}{% endfor %}')
+        app = self.make_app(SandboxedFlask)
+        with app.test_request_context():
+            self.assertEqual(render_template('loop.html', count=3), u'012')
+        app = SandboxedFlask(__name__, template_folder=self.templates)
+        app.config['TEMPLATE_CACHE_DIR'] = self.cache_dir
+        coaster.app.init_app(app, 'testing')
+        app.config['SANDBOX_MAX_OPERATIONS'] = 10
+        with app.test_request_context():
+            self.assertRaises(SandboxBudgetExceeded, render_template, 'loop.html', count=20)
+        self.assertEqual(len(self.cached_files(app.jinja_env.bytecode_cache)), 2)
+
+    def test_directories(self):
+        # Caches for other versions of Jinja2 are removed
+        os.makedirs(os.path.join(self.cache_dir, 'jinja2-2.0'))
+        os.makedirs(os.path.join(self.cache_dir, 'other'))
+        self.make_app(Flask)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ['jinja2-%s' % jinja2.__version__, 'other'])
+
+        # The instance folder is used if the directory is True
+        app = Flask(__name__, instance_path=self.cache_dir)
+        app.config['TEMPLATE_CACHE_DIR'] = True
+        coaster.app.init_app(app, 'testing')
+        self.assertTrue(app.jinja_env.bytecode_cache.directory.startswith(
+            os.path.join(self.cache_dir, 'template_cache')))
+
+    def test_disabled(self):
+        for cache_dir in (None, False):
+            app = Flask(__name__)
+            if cache_dir is not None:
+                app.config['TEMPLATE_CACHE_DIR'] = cache_dir
+            coaster.app.init_app(app, 'testing')
+            self.assertEqual(app.jinja_env.bytecode_cache, None)
+
+    def test_app_cache(self):
+        # The app's own bytecode cache is kept when TEMPLATE_CACHE_DIR isn't set
+        cache = jinja2.MemcachedBytecodeCache({})
+        app = Flask(__name__)
+        app.jinja_options = dict(app.jinja_options, bytecode_cache=cache)
+        coaster.app.init_app(app, 'testing')
+        self.assertTrue(app.jinja_env.bytecode_cache is cache)
+
+        app = Flask(__name__)
+        app.jinja_env.bytecode_cache = cache
+        coaster.app.init_app(app, 'testing')
+        self.assertTrue(app.jinja_env.bytecode_cache is cache)
+
+
+class TestWarmup(unittest.TestCase):
+    def test_warmup(self):
+        app = Flask(__name__)
+        app.config['TEMPLATE_CACHE_DIR'] = False
+        timings = warmup(app)
+        self.assertEqual(timings.keys(), [name for name, step in warmup_steps])
+        self.assertTrue(all(timing >= 0 for timing in timings.values()))
+
+    def test_failed_step(self):
+        app = Flask(__name__)
+        calls = []
+
+        def broken(app):
+            raise ValueError("Broken")
+        timings = warmup(app, [('broken', broken), ('working', calls.append)])
+        self.assertEqual(timings.keys(), ['broken', 'working'])
+        self.assertEqual(calls, [app])
+
+    def test_init_app(self):
+        templates = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(templates, 'page.html'), 'w') as f:
+                f.write(u'<p>{{ text }}</p>')
+            app = Flask(__name__, template_folder=templates)
+            app.config['TEMPLATE_CACHE_DIR'] = False
+            app.config['WARMUP'] = True
+            coaster.app.init_app(app, 'testing')
+            self.assertEqual(len(app.jinja_env.cache), 1)
+        finally:
+            shutil.rmtree(templates)
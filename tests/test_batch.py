@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from threading import Event
+from flask import Flask, Blueprint, g, json, session, abort
+from coaster.views import requestargs, render_with, batch_view, dispatch_batch
+
+app = Flask(__name__)
+app.secret_key = 'batch'
+app.add_url_rule('/batch', 'batch', batch_view(max_requests=10), methods=['POST'])
+app.add_url_rule('/batch/concurrent', 'batch_concurrent', batch_view(concurrent=True), methods=['POST'])
+
+before_requests = []
+
+
+@app.before_request
+def load_user():
+    before_requests.append(1)
+    g.user = g.get('user', 'user')
+
+
+@app.route('/add')
+@render_with({'text/plain': lambda data: repr(data)})
+@requestargs(('a', int), ('b', int))
+def add(a, b):
+    return {'sum': a + b, 'user': g.user}
+
+
+@app.route('/echo', methods=['POST'])
+@requestargs('text')
+def echo(text):
+    return text.upper()
+
+
+@app.route('/session')
+def read_session():
+    return session.get('name', u'')
+
+
+@app.route('/missing')
+def missing():
+    abort(404)
+
+
+arrivals = []
+everyone_arrived = Event()
+
+
+@app.route('/together/<int:number>')
+@render_with({})
+@requestargs(('expected', int), ('timeout', float))
+def together(number, expected, timeout=5):
+    # Reports whether the expected number of sub-requests were in this view at once
+    arrivals.append(number)
+    if len(arrivals) >= expected:
+        everyone_arrived.set()
+    return {'number': number, 'user': g.user, 'together': everyone_arrived.wait(timeout)}
+
+
+@app.route('/binary')
+def binary():
+    return app.response_class('\x00\x01', mimetype='application/octet-stream')
+
+
+admin = Blueprint('admin', __name__)
+
+
+@admin.before_request
+def forbid():
+    abort(403)
+
+
+@admin.route('/secret')
+def secret():
+    return 'SECRET'
+
+app.register_blueprint(admin, url_prefix='/admin')
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        app.testing = True
+        self.client = app.test_client()
+        del before_requests[:]
+        del arrivals[:]
+        everyone_arrived.clear()
+
+    def batch(self, requests, url='/batch'):
+        response = self.client.post(url, data=json.dumps({'requests': requests}),
+            headers=[('Accept', 'application/json')])
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)['responses']
+
+    def test_batch(self):
+        responses = self.batch([
+            {'url': '/add?a=1&b=2'},
+            {'url': '/add?a=3&b=4', 'headers': {'Accept': 'text/plain'}},
+            {'url': '/add?a=1&b=x'},
+            {'url': '/echo', 'method': 'POST', 'data': {'text': 'hello'}},
+            {'url': '/echo'},
+            {'url': '/missing'},
+            {'url': '/nowhere'},
+            {'url': '/binary'},
+            ])
+        # For the batch request and each sub-request
+        self.assertEqual(len(before_requests), 9)
+        self.assertEqual(responses[0]['status'], 200)
+        self.assertEqual(responses[0]['body'], {'sum': 3, 'user': 'user'})
+        self.assertEqual(responses[1]['body'], repr({'sum': 7, 'user': 'user'}))
+        self.assertEqual(responses[1]['headers']['Content-Type'], 'text/plain; charset=utf-8')
+        self.assertEqual(responses[2]['status'], 400)
+        self.assertEqual(responses[3]['body'], u'HELLO')
+        self.assertEqual(responses[4]['status'], 405)
+        self.assertEqual(responses[5]['status'], 404)
+        self.assertEqual(responses[6]['status'], 404)
+        self.assertEqual(responses[7]['body'], 'AAE=')
+        self.assertEqual(responses[7]['encoding'], 'base64')
+
+    def test_blueprint_hooks(self):
+        self.assertEqual(self.client.get('/admin/secret').status_code, 403)
+        responses = self.batch([{'url': '/admin/secret'}])
+        self.assertEqual(responses[0]['status'], 403)
+        self.assertNotEqual(responses[0]['body'], 'SECRET')
+
+    def test_nested(self):
+        responses = self.batch([{'url': '/batch', 'method': 'POST',
+            'data': json.dumps({'requests': [{'url': '/session'}]})}])
+        self.assertEqual(responses[0]['status'], 400)
+
+    def test_session(self):
+        with self.client.session_transaction() as sess:
+            sess['name'] = u'batch'
+        responses = self.batch([{'url': '/session'}])
+        self.assertEqual(responses[0]['body'], u'batch')
+
+    def test_invalid(self):
+        self.assertEqual(self.client.post('/batch', data='[]').status_code, 400)
+        self.assertEqual(self.client.post('/batch', data='{"requests": [{}]}').status_code, 400)
+        self.assertEqual(self.client.post('/batch',
+            data='{"requests": [{"url": "/add", "method": 1}]}').status_code, 400)
+        self.assertEqual(self.client.post('/batch',
+            data=json.dumps({'requests': [{'url': '/session'}] * 11})).status_code, 400)
+
+    def test_concurrent(self):
+        requests = [{'url': '/together/%d?expected=4' % number} for number in range(4)]
+        responses = self.batch(requests, '/batch/concurrent')
+        self.assertEqual([r['body'] for r in responses],
+            [{'number': number, 'user': 'user', 'together': True} for number in range(4)])
+
+        # Batches with requests other than GET are dispatched sequentially, so each
+        # sub-request leaves the view before the next arrives
+        del arrivals[:]
+        everyone_arrived.clear()
+        responses = self.batch([{'url': '/together/%d?expected=3&timeout=0.05' % number}
+            for number in range(3)] + [
+            {'url': '/echo', 'method': 'POST', 'data': {'text': 'hello'}}], '/batch/concurrent')
+        self.assertEqual([r['body']['together'] for r in responses[:3]], [False, False, True])
+        self.assertEqual(arrivals, [0, 1, 2])
+        self.assertEqual(responses[3]['body'], u'HELLO')
+
+        # Outside a batch view
+        del arrivals[:]
+        everyone_arrived.clear()
+        with app.test_request_context('/', headers=[('Accept', 'application/json')]):
+            g.user = 'direct'
+            responses = dispatch_batch([{'url': '/together/%d?expected=2' % number}
+                for number in range(2)], concurrent=True, max_workers=2)
+        self.assertEqual([(r['body']['user'], r['body']['together']) for r in responses],
+            [('direct', True), ('direct', True)])
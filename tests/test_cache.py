@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from time import time
+from datetime import datetime
+from flask import Flask, render_template, render_template_string
+from jinja2 import DictLoader
+from coaster.app import init_app, SandboxedFlask
+from coaster.cache import LRUCache, FragmentCache
+
+renders = []
+
+
+def render_count(name):
+    renders.append(name)
+    return len(renders)
+
+
+class Project(object):
+    __tablename__ = 'project'
+
+    def __init__(self, id, title):
+        self.id = id
+        self.title = title
+        self.updated_at = datetime(2014, 7, 1)
+
+
+class TestFragmentCache(unittest.TestCase):
+    template = (u'{% autoescape true %}{% cache key, 0, project, "sessions" %}'
+        u'<h1>{{ project.title }}</h1>{{ render_count(key) }}{% endcache %}{% endautoescape %}')
+
+    def setUp(self):
+        del renders[:]
+        self.app = Flask(__name__)
+        init_app(self.app, 'testing')
+        self.app.jinja_env.globals['render_count'] = render_count
+
+    def render(self, app, **context):
+        with app.test_request_context():
+            return render_template_string(self.template, **context)
+
+    def test_cache(self):
+        project = Project(1, u'<Project>')
+        first = self.render(self.app, key='a', project=project)
+        self.assertEqual(first, u'<h1>&lt;Project&gt;</h1>1')
+        self.assertEqual(self.render(self.app, key='a', project=project), first)
+        self.assertEqual(self.render(self.app, key='b', project=project), u'<h1>&lt;Project&gt;</h1>2')
+        self.assertEqual(renders, ['a', 'b'])
+
+    def test_invalidate(self):
+        cache = self.app.jinja_env.fragment_cache
+        project = Project(1, u'Project')
+        other = Project(2, u'Other')
+        self.render(self.app, key='a', project=project)
+        self.render(self.app, key='b', project=other)
+
+        # Invalidating a model's tag discards only fragments tagged with it
+        cache.invalidate(project)
+        self.render(self.app, key='a', project=project)
+        self.render(self.app, key='b', project=other)
+        self.assertEqual(renders, ['a', 'b', 'a'])
+
+        # Invalidating a string tag discards all fragments tagged with it
+        cache.invalidate('sessions')
+        self.render(self.app, key='a', project=project)
+        self.render(self.app, key='b', project=other)
+        self.assertEqual(renders, ['a', 'b', 'a', 'a', 'b'])
+
+        # Updating a model discards its fragments
+        project.updated_at = datetime(2014, 7, 2)
+        self.render(self.app, key='a', project=project)
+        self.assertEqual(renders, ['a', 'b', 'a', 'a', 'b', 'a'])
+
+    def test_namespace(self):
+        backend = LRUCache()
+        first = FragmentCache(backend, namespace='first:')
+        second = FragmentCache(backend, namespace='second:')
+        self.assertEqual(first.fetch('key', None, (), lambda: u'first'), u'first')
+        self.assertEqual(second.fetch('key', None, (), lambda: u'second'), u'second')
+        self.assertEqual(first.fetch('key', None, (), lambda: u'changed'), u'first')
+        self.assertTrue(first.key('key').startswith('first:fragment:'))
+
+    def test_timeout(self):
+        backend = LRUCache()
+        cache = FragmentCache(backend)
+        self.app.jinja_env.fragment_cache = cache
+        with self.app.test_request_context():
+            render_template_string(u'{% cache "timeout", 60 %}fragment{% endcache %}')
+        expires, value = backend._cache[cache.key('timeout')]
+        self.assertTrue(55 < expires - time() <= 60)
+        self.assertEqual(value, u'fragment')
+
+    def test_sandboxed(self):
+        app = SandboxedFlask(__name__)
+        init_app(app, 'testing')
+        app.jinja_env.globals['render_count'] = render_count
+        project = Project(1, u'Project')
+        self.assertEqual(self.render(app, key='a', project=project), u'<h1>Project</h1>1')
+        self.assertEqual(self.render(app, key='a', project=project), u'<h1>Project</h1>1')
+
+    def test_scope(self):
+        """Fragments are cached per template, and per the vary callable"""
+        app = SandboxedFlask(__name__)
+        app.jinja_loader = DictLoader({
+            'first.html': u'{% cache "key" %}first {{ render_count("first") }}{% endcache %}',
+            'second.html': u'{% cache "key" %}second {{ render_count("second") }}{% endcache %}',
+            })
+        init_app(app, 'testing')
+        tenant = []
+        app.jinja_env.fragment_cache.vary = lambda: tenant[0]
+        app.jinja_env.globals['render_count'] = render_count
+        with app.test_request_context():
+            tenant.append('one')
+            self.assertEqual(render_template('first.html'), u'first 1')
+            self.assertEqual(render_template('second.html'), u'second 2')
+            self.assertEqual(render_template('first.html'), u'first 1')
+            tenant[0] = 'two'
+            self.assertEqual(render_template_string(u'{% cache "key" %}{{ render_count("x") }}{% endcache %}'),
+                u'3')
+            self.assertEqual(render_template('first.html'), u'first 4')
+
+    def test_lazy_environment(self):
+        """init_app leaves the Jinja environment to be created with the final config"""
+        app = SandboxedFlask(__name__)
+        app.config['TEMPLATE_CACHE_DIR'] = False
+        init_app(app, 'testing')
+        self.assertFalse('jinja_env' in app.__dict__)
+        app.config['SANDBOX_MAX_DEPTH'] = 5
+        app.config['FRAGMENT_CACHE_TIMEOUT'] = 60
+        self.assertEqual(app.jinja_env.max_depth, 5)
+        self.assertEqual(app.jinja_env.fragment_cache.default_timeout, 60)
+        self.assertTrue(any('cache' in ext.tags for ext in app.jinja_env.extensions.values()))
+
+        # An environment that already exists is updated instead
+        app = Flask(__name__)
+        app.jinja_env
+        init_app(app, 'testing')
+        with app.test_request_context():
+            self.assertEqual(render_template_string(u'{% cache "key" %}cached{% endcache %}'), u'cached')
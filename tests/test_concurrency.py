@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+from threading import Thread, Event
+from flask import Flask, request
+from coaster.views import load_models, requestargs, render_with
+from coaster.db import db
+
+from test_models import Container, NamedDocument
+
+# A file database, so that all threads see the same data
+dbfile = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+dbfile.close()
+
+app = Flask(__name__)
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + dbfile.name
+db.init_app(app)
+
+
+# Requests wait in the view until all of them have arrived, which they can only
+# do if they are handled concurrently
+arrivals = []
+everyone_arrived = Event()
+
+
+def arrive(expected, timeout=5):
+    arrivals.append(1)
+    if len(arrivals) >= expected:
+        everyone_arrived.set()
+    return everyone_arrived.wait(timeout)
+
+
+@app.route('/decorated/<container>/<document>')
+@render_with({'text/plain': lambda data: data['title']})
+@load_models(
+    (Container, {'name': 'container'}, 'container'),
+    (NamedDocument, {'name': 'document', 'container': 'container'}, 'document'))
+@requestargs(('expected', int))
+def decorated_view(container, document, expected):
+    if not arrive(expected):
+        return {'title': u"Alone"}
+    return {'title': document.title}
+
+
+@app.route('/plain/<container>/<document>')
+def plain_view(container, document):
+    container = Container.query.filter_by(name=container).first_or_404()
+    document = NamedDocument.query.filter_by(name=document, container=container).first_or_404()
+    if not arrive(int(request.args['expected'])):
+        return u"Alone"
+    return document.title
+
+
+class TestConcurrency(unittest.TestCase):
+    """
+    Views are synchronous, so I/O-bound views scale with the threads or processes
+    of the WSGI server. Decorated views must scale just like undecorated ones.
+    """
+    requests = 8
+
+    def setUp(self):
+        with app.test_request_context():
+            db.create_all()
+            c = Container(name=u'c')
+            db.session.add(c)
+            db.session.add(NamedDocument(title=u"Document", container=c))
+            db.session.commit()
+
+    def tearDown(self):
+        with app.test_request_context():
+            db.drop_all()
+
+    @classmethod
+    def tearDownClass(cls):
+        os.unlink(dbfile.name)
+
+    def test_overlap(self):
+        # Every request must reach its view before any of them returns
+        for path in ['/decorated/c/document', '/plain/c/document']:
+            del arrivals[:]
+            everyone_arrived.clear()
+            responses = []
+
+            def get():
+                response = app.test_client().get(path, query_string={'expected': self.requests},
+                    headers=[('Accept', 'text/plain')])
+                responses.append((response.status_code, response.data))
+
+            threads = [Thread(target=get) for i in range(self.requests)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(responses, [(200, 'Document')] * self.requests, path)
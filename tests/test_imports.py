@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+import sys
+import subprocess
+from flask import json
+
+# Dependencies that are slow to import and are only loaded when used
+LAZY_MODULES = ['bcrypt', 'pytz', 'tldextract', 'unidecode', 'bleach', 'markdown', 'pygments']
+
+
+def imported_after(statement):
+    # Run in a new interpreter to start with no modules imported
+    code = 'import sys, json; %s; print(json.dumps(sorted(sys.modules)))' % statement
+    output = subprocess.check_output([sys.executable, '-c', code],
+        cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    return set(name.split('.')[0] for name in json.loads(output.splitlines()[-1]))
+
+
+class TestImports(unittest.TestCase):
+    def test_lazy_imports(self):
+        """Importing coaster doesn't load dependencies that aren't used"""
+        imported = imported_after(
+            'import coaster, coaster.utils, coaster.gfm, coaster.sqlalchemy, coaster.views, coaster.app')
+        self.assertEqual([name for name in LAZY_MODULES if name in imported], [])
+
+    def test_loaded_on_use(self):
+        imported = imported_after(
+            'from coaster.gfm import markdown; from coaster.utils import make_name, sorted_timezones; '
+            'markdown(u"`code`"); make_name(u"name"); sorted_timezones()')
+        self.assertEqual([name for name in LAZY_MODULES if name in imported],
+            ['pytz', 'unidecode', 'markdown', 'pygments'])
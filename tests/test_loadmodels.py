@@ -4,16 +4,16 @@ import unittest
 from sqlalchemy import Column, ForeignKey
 from sqlalchemy.orm import relationship
 
-from coaster.views import load_model, load_models
-from coaster.sqlalchemy import BaseMixin, BaseNameMixin, BaseScopedIdMixin
+from coaster.views import load_model, load_models, render_with, ResponseCache
+from coaster.sqlalchemy import BaseMixin, BaseNameMixin, BaseScopedIdMixin, permissions_for
 from coaster.db import db
 
 from test_models import (app1, app2, Container, NamedDocument,
     ScopedNamedDocument, IdNamedDocument, ScopedIdDocument,
-    ScopedIdNamedDocument, User)
+    ScopedIdNamedDocument, SerializedDocument, SerializedChild, User, QueryCounter)
 
 from werkzeug.exceptions import Forbidden, NotFound
-from flask import Flask, g
+from flask import Flask, Response, g
 
 
 # --- Models ------------------------------------------------------------------
@@ -81,6 +81,15 @@ def t_container(container, kwargs):
     return container
 
 
+conditional_calls = []
+
+
+@load_model(Container, {'name': 'container'}, 'container', conditional=True)
+def t_conditional_container(container):
+    conditional_calls.append(container)
+    return container.name
+
+
 @load_model(User, {'username': 'username'}, 'g.user')
 def t_load_user_to_g(user):
     return user
@@ -183,6 +192,26 @@ def t_dotted_document_delete(document, child):
     return child
 
 
+@load_models(
+    (ParentDocument, {'name': 'document'}, 'document'),
+    (ChildDocument, {'id': 'child', 'parent': 'document.middle'}, 'child'),
+    permission='edit'
+    )
+@render_with({'text/plain': lambda data: Response(repr(data), mimetype='text/plain')},
+    cache=ResponseCache(timeout=60))
+def t_cached_document_edit(document, child):
+    return {'child': child.id}
+
+
+@load_models(
+    (Container, {'name': 'container'}, 'container'),
+    (SerializedDocument, {'name': 'document', 'container': 'container'}, 'document'),
+    (SerializedChild, {'name': 'child', 'parent': 'document'}, 'child'),
+    load_only=True)
+def t_serialized_child(container, document, child):
+    return document.serialize(), child.serialize()
+
+
 # --- Tests -------------------------------------------------------------------
 
 class TestLoadModels(unittest.TestCase):
@@ -252,6 +281,38 @@ class TestLoadModels(unittest.TestCase):
             g.user = User(username='test')
             self.assertEqual(t_container(container=u'c'), self.container)
 
+    def test_conditional(self):
+        del conditional_calls[:]
+        with self.app.test_request_context('/c'):
+            response = t_conditional_container(container=u'c')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, 'c')
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+        self.assertTrue(etag.upper().startswith('W/'))
+
+        for headers in [[('If-None-Match', etag)], [('If-Modified-Since', last_modified)]]:
+            with self.app.test_request_context('/c', headers=headers):
+                response = t_conditional_container(container=u'c')
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.headers['ETag'], etag)
+        # The view was not called for a 304
+        self.assertEqual(len(conditional_calls), 1)
+
+        # A different representation or a change in the instance gets a new ETag
+        with self.app.test_request_context('/c', headers=[('If-None-Match', etag), ('Accept', 'text/plain')]):
+            self.assertEqual(t_conditional_container(container=u'c').status_code, 200)
+        self.container.title = u"Changed"
+        self.session.commit()
+        with self.app.test_request_context('/c', headers=[('If-None-Match', etag)]):
+            self.assertEqual(t_conditional_container(container=u'c').status_code, 200)
+        # Non-ASCII Accept headers are accepted
+        with self.app.test_request_context('/c', headers=[('Accept', u'text/plain, text/\xe9')]):
+            self.assertEqual(t_conditional_container(container=u'c').status_code, 200)
+        # Non-GET requests are not conditional
+        with self.app.test_request_context('/c', method='POST'):
+            self.assertEqual(t_conditional_container(container=u'c'), u'c')
+
     def test_named_document(self):
         self.assertEqual(t_named_document(container=u'c', document=u'named-document'), self.nd1)
         self.assertEqual(t_named_document(container=u'c', document=u'another-named-document'), self.nd2)
@@ -265,6 +326,43 @@ class TestLoadModels(unittest.TestCase):
             response = t_redirect_document(container=u'c', document=u'redirect-document')
             self.assertEqual(response.status_code, 302)
             self.assertEqual(response.headers['Location'], '/c/named-document')
+        with QueryCounter() as counter:
+            with self.app.test_request_context('/c/redirect-document'):
+                t_redirect_document(container=u'c', document=u'redirect-document')
+            # One query per alternative model
+            self.assertEqual(counter.count, 2)
+
+    def test_named_document_single_query(self):
+        """A chain joined by relationships is loaded in a single query"""
+        with QueryCounter() as counter:
+            self.assertEqual(t_named_document(container=u'c', document=u'named-document'), self.nd1)
+        self.assertEqual(counter.count, 1)
+        with QueryCounter() as counter:
+            self.assertEqual(t_scoped_id_named_document(container=u'c', document=u'1-scoped-id-named-document'),
+                self.sind1)
+        self.assertEqual(counter.count, 1)
+        # If the query finds nothing, that's a 404 without loading the links one at a time
+        with QueryCounter() as counter:
+            self.assertRaises(NotFound, t_named_document, container=u'c', document=u'missing-document')
+            self.assertRaises(NotFound, t_named_document, container=u'missing', document=u'named-document')
+        self.assertEqual(counter.count, 2)
+
+    def test_load_only(self):
+        """Models with serialize_fields are loaded with only the columns needed"""
+        d = SerializedDocument(title=u"Serialized", container=self.container, content=u"Content")
+        self.session.add(SerializedChild(title=u"Serialized Child", document=d, content=u"Child"))
+        self.session.commit()
+        self.session.expunge_all()
+        with QueryCounter() as counter:
+            document, child = t_serialized_child(container=u'c', document=u'serialized', child=u'child')
+        self.assertEqual(document['title'], u"Serialized")
+        self.assertEqual(unicode(document['content']), u"Content")
+        self.assertEqual(child, {'name': u'child', 'title': u"Serialized Child", 'heading': u"Child"})
+        # A single JOINed query loads all three, without the unserialized columns
+        self.assertEqual(counter.count, 1)
+        self.assertFalse('data' in counter.statements[0])
+        self.assertFalse('serialized_child.content_text' in counter.statements[0])
+        self.assertTrue('serialized_document.content_text' in counter.statements[0])
 
     def test_scoped_named_document(self):
         self.assertEqual(t_scoped_named_document(container=u'c', document=u'scoped-named-document'), self.snd1)
@@ -313,6 +411,60 @@ class TestLoadModels(unittest.TestCase):
         self.assertEqual(self.pc.permissions(user, inherited=inherited), set(['add-video', 'view']))
         self.assertEqual(inherited, set(['add-video']))
 
+    def test_memoized_parent_permissions(self):
+        """Parent permissions are evaluated once per request for all children"""
+        calls = []
+
+        def permissions(container, user, inherited=None):
+            calls.append(container)
+            perms = super(Container, container).permissions(user, inherited)
+            perms.add('view')
+            return perms
+
+        Container.permissions = permissions
+        try:
+            user = User(username=u'foo')
+            with self.app.test_request_context():
+                self.assertEqual(self.snd1.permissions(user), set(['view']))
+                self.assertEqual(self.snd2.permissions(user), set(['view']))
+                self.assertEqual(self.sid1.permissions(user), set(['view']))
+                # The returned set is a copy
+                self.snd1.permissions(user).add('edit')
+                self.assertEqual(self.snd2.permissions(user), set(['view']))
+            self.assertEqual(len(calls), 1)
+            # The memo does not outlive the request
+            with self.app.test_request_context():
+                self.snd1.permissions(user)
+            self.assertEqual(len(calls), 2)
+        finally:
+            del Container.permissions
+
+    def test_permissions_for(self):
+        """permissions_for evaluates each distinct ancestor once, even outside a request"""
+        calls = []
+
+        def permissions(container, user, inherited=None):
+            calls.append(container)
+            return super(Container, container).permissions(user, inherited) | set(['view'])
+
+        Container.permissions = permissions
+        user = User(username=u'foo')
+        items = [self.snd1, self.snd2, self.sid1, self.pc]
+        for item in items[:-1]:
+            item.parent.name  # Load parents before the session goes away with the request
+        self.ctx.pop()
+        try:
+            perms = permissions_for(items, user)
+        finally:
+            self.ctx.push()
+            del Container.permissions
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(perms, {
+            self.snd1: set(['view']),
+            self.snd2: set(['view']),
+            self.sid1: set(['view']),
+            self.pc: set(['view', 'edit', 'delete'])})
+
     def test_loadmodel_permissions(self):
         with self.app.test_request_context():
             g.user = User(username='foo')
@@ -320,6 +472,21 @@ class TestLoadModels(unittest.TestCase):
             self.assertEqual(t_dotted_document_edit(document=u'parent', child=1), self.child1)
             self.assertRaises(Forbidden, t_dotted_document_delete, document=u'parent', child=1)
 
+    def test_cached_permissions(self):
+        """Permissions are checked for cached responses when load_models is above render_with"""
+        with self.app.test_request_context(headers=[('Accept', 'text/plain')]):
+            g.user = User(username='foo')
+            self.assertEqual(t_cached_document_edit(document=u'parent', child=1).data, "{'child': 1}")
+        with self.app.test_request_context(headers=[('Accept', 'text/plain')]):
+            g.user = User(username='bar')
+            self.assertRaises(Forbidden, t_cached_document_edit, document=u'parent', child=1)
+
+        def view(document, child):
+            return {}
+        decorator = load_models((ParentDocument, {'name': 'document'}, 'document'), permission='view')
+        self.assertRaises(ValueError, render_with('view.html', cache=ResponseCache()), decorator(view))
+        render_with('view.html')(decorator(view))
+
     def test_load_user_to_g(self):
         with self.app.test_request_context():
             user = User(username=u'baz')
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import sys
+import os
+import gc
+import weakref
+import logging
+import tempfile
+import asyncore
+import smtpd
+from email import message_from_string
+from threading import Event, Thread, current_thread
+from time import time, sleep
+from flask import Flask
+from coaster.logging import init_app, QueueHandler, DigestSMTPHandler, LocalVarFormatter
+
+
+class SMTPServer(smtpd.SMTPServer):
+    """Local SMTP server that keeps messages"""
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        self.thread = Thread(target=asyncore.loop, kwargs={'timeout': 0.05, 'map': self._map})
+        self.thread.start()
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append(message_from_string(data))
+
+    def stop(self):
+        self.close()
+        self.thread.join()
+
+
+class ListHandler(logging.Handler):
+    def __init__(self, wait=None):
+        logging.Handler.__init__(self)
+        self.records = []
+        self.threads = []
+        self.wait = wait
+        self.entered = Event()
+
+    def emit(self, record):
+        self.entered.set()
+        if self.wait is not None:
+            self.wait.wait()
+        self.records.append(record)
+        self.threads.append(current_thread())
+
+
+def make_logger(handler):
+    logger = logging.getLogger('coaster.test.%s' % id(handler))
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    return logger
+
+
+class TestQueueHandler(unittest.TestCase):
+    def test_background(self):
+        release = Event()
+        target = ListHandler(wait=release)
+        handler = QueueHandler([target])
+        logger = make_logger(handler)
+
+        start = time()
+        logger.warning("Warning %d", 1)
+        logger.info("Info")
+        self.assertTrue(time() - start < 0.1)
+        self.assertEqual(target.records, [])
+
+        release.set()
+        handler.stop()
+        self.assertEqual([r.getMessage() for r in target.records], ["Warning 1", "Info"])
+        self.assertTrue(current_thread() not in target.threads)
+
+        # The listener is started again when required
+        logger.warning("Restarted")
+        handler.stop()
+        self.assertEqual(target.records[-1].getMessage(), "Restarted")
+
+    def test_exception(self):
+        target = ListHandler()
+        target.setLevel(logging.ERROR)
+        handler = QueueHandler([target])
+        handler.setFormatter(LocalVarFormatter())
+        logger = make_logger(handler)
+        try:
+            secret_value = 'value in frame'  # NOQA
+            raise ValueError("Failed")
+        except ValueError:
+            logger.exception("Error")
+        logger.warning("Below the target's level")
+        handler.stop()
+        self.assertEqual(len(target.records), 1)
+        record = target.records[0]
+        self.assertEqual(record.exc_info[:2], (ValueError, record.exc_info[1]))
+        self.assertEqual(record.exc_info[2], None)
+        self.assertTrue("ValueError: Failed" in record.exc_text)
+        self.assertTrue("'value in frame'" in record.exc_text)
+        self.assertTrue("'value in frame'" in logging.Formatter().format(record))
+        self.assertEqual(record.exc_captured, None)
+
+    def test_captured(self):
+        formatter = LocalVarFormatter()
+        try:
+            large_value = range(100000)  # NOQA
+            raise ValueError("Failed")
+        except ValueError:
+            exc_info = sys.exc_info()
+        captured = formatter.captureException(exc_info)
+        del exc_info
+        text = formatter.formatCaptured(captured)
+        self.assertTrue(text.startswith("Traceback (most recent call last):\n"))
+        self.assertTrue('raise ValueError("Failed")' in text)
+        self.assertTrue("ValueError: Failed\n" in text)
+        # Large values are shortened
+        self.assertTrue("[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, ...]" in text)
+        self.assertFalse("99999" in text)
+
+    def test_overflow(self):
+        release = Event()
+        target = ListHandler(wait=release)
+        handler = QueueHandler([target], maxsize=2)
+        logger = make_logger(handler)
+        try:
+            logger.warning("Record 0")
+            target.entered.wait(1)
+            for index in range(1, 10):
+                logger.warning("Record %d", index)
+            # One record is with the target handler, two are in the queue
+            self.assertEqual(handler.dropped, 7)
+        finally:
+            release.set()
+        handler.stop()
+        self.assertEqual([r.getMessage() for r in target.records], [
+            "Record 0", "Record 1", "Record 2",
+            "7 log records were dropped because the queue was full"])
+
+    def test_init_app(self):
+        fd, logfile = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            app = Flask(__name__)
+            app.config['LOGFILE'] = logfile
+            init_app(app)
+            handler = [h for h in app.logger.handlers if isinstance(h, QueueHandler)][0]
+            app.logger.error("Logged in the background")
+            handler.stop()
+            with open(logfile) as f:
+                self.assertTrue("Logged in the background" in f.read())
+            app.logger.removeHandler(handler)
+            handler.close()
+        finally:
+            os.remove(logfile)
+
+
+def fail(value):
+    raise ValueError(value)
+
+
+class TestDigestSMTPHandler(unittest.TestCase):
+    def setUp(self):
+        self.server = SMTPServer()
+        self.now = 1404203400.0
+        self.handler = DigestSMTPHandler(('127.0.0.1', self.server.port), 'logs@example.com',
+            ['admin@example.com'], 'App failure', interval=600, clock=lambda: self.now)
+        self.logger = make_logger(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+        self.server.stop()
+
+    def log_error(self, value):
+        try:
+            fail(value)
+        except ValueError:
+            self.logger.exception("Error in view")
+
+    def test_digest(self):
+        for value in range(5):
+            self.log_error(value)
+            self.now += 1
+        # Different message, but the same error
+        self.log_error('other')
+        try:
+            {}['missing']
+        except KeyError:
+            self.logger.exception("Error in view")
+        for value in range(3):
+            self.logger.error("Message %d", value)
+        self.assertEqual([m['Subject'] for m in self.server.messages], ['App failure'] * 3)
+
+        # Suppressed errors are sent in a digest
+        self.handler.send_digest()
+        self.assertEqual(len(self.server.messages), 4)
+        digest = self.server.messages[3]
+        self.assertEqual(digest['Subject'], 'App failure (digest)')
+        body = digest.get_payload()
+        self.assertTrue("5 times between" in body)
+        self.assertTrue("Error in view (ValueError: 0)" in body)
+        self.assertTrue("2 times between" in body)
+        self.assertTrue("Message 0" in body)
+
+        # The interval has passed, so the error is sent again
+        self.now += 600
+        self.log_error('again')
+        self.assertEqual(len(self.server.messages), 5)
+        self.assertTrue("ValueError: again" in self.server.messages[4].get_payload())
+
+        # No digest when there were no repeats
+        self.handler.send_digest()
+        self.assertEqual(len(self.server.messages), 5)
+
+    def test_maxsize(self):
+        self.handler.maxsize = 2
+        self.log_error(0)
+        self.logger.error("Message 0")
+        self.log_error(1)
+        self.logger.error("Message 0")
+        self.assertEqual(len(self.server.messages), 2)
+
+        # The error seen least recently is forgotten, with its repeat counted
+        self.logger.error("Message 1")
+        self.assertEqual(len(self.handler.errors), 2)
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(self.handler.overflow, 1)
+        self.logger.error("Message 0")
+        self.assertEqual(len(self.server.messages), 3)
+
+        self.handler.send_digest()
+        body = self.server.messages[3].get_payload()
+        self.assertTrue("2 times between" in body)
+        self.assertTrue("Message 0" in body)
+        self.assertTrue("1 times: errors that are no longer tracked" in body)
+        self.assertEqual(self.handler.overflow, 0)
+
+    def test_periodic(self):
+        """Digests are sent every interval in the background"""
+        handler = DigestSMTPHandler(('127.0.0.1', self.server.port), 'logs@example.com',
+            ['admin@example.com'], 'App failure', interval=0.05)
+        self.logger.removeHandler(self.handler)
+        self.logger.addHandler(handler)
+        try:
+            for value in range(2):
+                self.log_error(value)
+            for i in range(200):
+                if len(self.server.messages) > 1:
+                    break
+                sleep(0.01)
+            self.assertEqual(len(self.server.messages), 2)
+            self.assertEqual(self.server.messages[1]['Subject'], 'App failure (digest)')
+        finally:
+            self.logger.removeHandler(handler)
+            handler.close()
+
+    def test_shutdown(self):
+        """Pending digests are sent when logging shuts down, and handlers aren't kept alive"""
+        handler = QueueHandler([self.handler])
+        self.logger.removeHandler(self.handler)
+        self.logger.addHandler(handler)
+        for value in range(2):
+            self.log_error(value)
+        self.logger.removeHandler(handler)
+        logging.shutdown([weakref.ref(handler)])
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(self.server.messages[1]['Subject'], 'App failure (digest)')
+
+        reference = weakref.ref(handler)
+        del handler
+        gc.collect()
+        self.assertEqual(reference(), None)
+
+    def test_queued(self):
+        """Errors are recognised after passing through a QueueHandler"""
+        handler = QueueHandler([self.handler])
+        self.logger.removeHandler(self.handler)
+        self.logger.addHandler(handler)
+        for value in range(3):
+            self.log_error(value)
+        handler.stop()
+        self.logger.removeHandler(handler)
+        self.assertEqual(len(self.server.messages), 1)
+        self.handler.send_digest()
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertTrue("2 times between" in self.server.messages[1].get_payload())
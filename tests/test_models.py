@@ -4,11 +4,14 @@ import unittest
 
 from time import sleep
 from datetime import datetime, timedelta
-from flask import Flask
+from flask import Flask, json
 from coaster.sqlalchemy import (BaseMixin, BaseNameMixin, BaseScopedNameMixin,
-    BaseIdNameMixin, BaseScopedIdMixin, BaseScopedIdNameMixin, JsonDict)
+    BaseIdNameMixin, BaseScopedIdMixin, BaseScopedIdNameMixin, AncestorPathMixin, JsonDict,
+    MarkdownColumn)
 from coaster.db import db
-from sqlalchemy import Column, Integer, Unicode, UniqueConstraint, ForeignKey
+from coaster.views import jsonp, csvstream
+from coaster.msgpack import packb, unpackb
+from sqlalchemy import Column, Integer, Unicode, UniqueConstraint, ForeignKey, event
 from sqlalchemy.orm import relationship, synonym
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import MultipleResultsFound
@@ -93,6 +96,45 @@ class ScopedIdNamedDocument(BaseScopedIdNameMixin, db.Model):
     __table_args__ = (UniqueConstraint('container_id', 'url_id'),)
 
 
+class PathDocument(AncestorPathMixin, BaseScopedNameMixin, db.Model):
+    __tablename__ = 'path_document'
+    container_id = Column(Integer, ForeignKey('container.id'))
+    container = relationship(Container)
+    parent = synonym('container')
+    __table_args__ = (UniqueConstraint('container_id', 'name'),)
+
+
+class PathComment(AncestorPathMixin, BaseScopedIdMixin, db.Model):
+    __tablename__ = 'path_comment'
+    document_id = Column(Integer, ForeignKey('path_document.id'))
+    document = relationship(PathDocument)
+    parent = synonym('document')
+    __table_args__ = (UniqueConstraint('document_id', 'url_id'),)
+
+
+class SerializedDocument(BaseNameMixin, db.Model):
+    __tablename__ = 'serialized_document'
+    serialize_fields = ('name', 'title', 'content')
+    container_id = Column(Integer, ForeignKey('container.id'))
+    container = relationship(Container)
+    content = MarkdownColumn('content')
+    data = Column(JsonDict)
+
+
+class SerializedChild(BaseScopedNameMixin, db.Model):
+    __tablename__ = 'serialized_child'
+    serialize_fields = ('name', 'title', 'heading')
+    document_id = Column(Integer, ForeignKey('serialized_document.id'), nullable=False)
+    document = relationship(SerializedDocument)
+    parent = synonym('document')
+    content = MarkdownColumn('content')
+    __table_args__ = (UniqueConstraint('document_id', 'name'),)
+
+    @property
+    def heading(self):
+        return self.short_title()
+
+
 class User(BaseMixin, db.Model):
     __tablename__ = 'user'
     username = Column(Unicode(80), nullable=False)
@@ -104,6 +146,25 @@ class MyData(db.Model):
     data = Column(JsonDict)
 
 
+# -- Helpers ------------------------------------------------------------------
+
+class QueryCounter(object):
+    """Context manager that counts and records SQL statements executed on the db engine"""
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def _count(self, conn, cursor, statement, *args, **kwargs):
+        self.count += 1
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(db.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        event.remove(db.engine, 'before_cursor_execute', self._count)
+
 
 # -- Tests --------------------------------------------------------------------
 
@@ -367,6 +428,147 @@ class TestCoasterModels(unittest.TestCase):
         self.assertEqual(Container.query.filter_by(name=u'c3').one_or_none(), None)
         self.assertRaises(MultipleResultsFound, Container.query.one_or_none)
 
+    def test_jsonp_stream_query(self):
+        """Queries passed to jsonp are streamed"""
+        c = self.make_container()
+        for number in range(3):
+            self.session.add(NamedDocument(title=u"Document %d" % number, container=c))
+        self.session.commit()
+        r = jsonp(documents=NamedDocument.query.order_by(NamedDocument.id).with_entities(
+            NamedDocument.name, NamedDocument.title))
+        self.assertTrue(r.is_streamed)
+        self.assertEqual([(d['name'], d['title']) for d in json.loads(r.get_data())['documents']], [
+            (u'document-0', u'Document 0'), (u'document-1', u'Document 1'),
+            (u'document-2', u'Document 2')])
+
+    def test_msgpack_query(self):
+        """Queries are encoded in MessagePack as in JSON"""
+        c = self.make_container()
+        for number in range(3):
+            self.session.add(NamedDocument(title=u"Document %d" % number, container=c))
+        self.session.commit()
+        query = NamedDocument.query.order_by(NamedDocument.id).with_entities(
+            NamedDocument.name, NamedDocument.title)
+        self.assertEqual(unpackb(packb({'documents': query}))['documents'],
+            json.loads(jsonp(documents=query).get_data())['documents'])
+
+    def test_csvstream_query(self):
+        """Queries passed to csvstream are streamed"""
+        c = self.make_container()
+        for number in range(3):
+            self.session.add(NamedDocument(title=u"Document %d" % number, container=c))
+        self.session.commit()
+        query = NamedDocument.query.order_by(NamedDocument.id)
+        r = csvstream({'rows': query.with_entities(NamedDocument.name, NamedDocument.title)})
+        self.assertEqual(r.get_data().splitlines(), ['name,title', 'document-0,Document 0',
+            'document-1,Document 1', 'document-2,Document 2'])
+        r = csvstream({'rows': query, 'columns': ['title', ('Container', 'container.id')]})
+        self.assertEqual(r.get_data().splitlines(), ['title,Container', 'Document 0,%d' % c.id,
+            'Document 1,%d' % c.id, 'Document 2,%d' % c.id])
+
+    def test_serialize(self):
+        """Models are serialized with their declared fields"""
+        c = self.make_container()
+        d = SerializedDocument(title=u"Document", container=c, content=u"*Hello*",
+            data={u'large': u'blob'})
+        self.session.add(d)
+        self.session.add(SerializedChild(title=u"Document Child", document=d, content=u"Child"))
+        self.session.commit()
+
+        self.assertEqual(d.serialize(), {'name': u'document', 'title': u'Document',
+            'content': d.content})
+        self.assertEqual(SerializedDocument.serialize_columns(),
+            ['container_id', u'content_html', u'content_text', 'id', 'name', 'title', 'updated_at'])
+        self.assertEqual(SerializedChild.serialize_columns(),
+            ['document_id', 'id', 'name', 'title', 'updated_at'])
+        # Models that don't declare fields serialize all columns
+        self.assertEqual(sorted(c.serialize()), ['content', 'created_at', 'id', 'name', 'title', 'updated_at'])
+
+        self.session.expunge_all()
+        with QueryCounter() as counter:
+            documents = list(SerializedDocument.query.serialized())
+        self.assertEqual(counter.count, 1)
+        # Columns are selected directly, so no instances are loaded
+        self.assertEqual(len(self.session.identity_map), 0)
+        self.assertEqual(documents, [{'name': u'document', 'title': u'Document',
+            'content': SerializedDocument.query.first().content}])
+        self.assertEqual(documents[0]['content'].html, u'<p><em>Hello</em></p>')
+
+        # Models with fields that aren't columns are loaded with only the columns needed
+        self.session.expunge_all()
+        with QueryCounter() as counter:
+            children = list(SerializedChild.query.serialized())
+        self.assertEqual(children, [{'name': u'child', 'title': u'Document Child', 'heading': u'Child'}])
+        self.assertFalse('content_text' in counter.statements[0])
+
+    def test_query_with_parents(self):
+        """Listing scoped models with their parents takes the same number of queries for any length"""
+        def listing_queries(count):
+            for i in range(count):
+                c = Container(name=u'c%d' % i, title=u'Container %d' % i)
+                self.session.add(ScopedNamedDocument(container=c, title=u'Container %d Document' % i))
+                self.session.add(ScopedIdDocument(container=c))
+            self.session.commit()
+            self.session.expunge_all()
+            with QueryCounter() as counter:
+                titles = [d.short_title() for d in ScopedNamedDocument.query.with_parents()]
+                perms = [d.permissions(None) for d in ScopedIdDocument.query.with_parents(depth=2)]
+            self.assertEqual(len(titles), count)
+            self.assertEqual(titles[0], u'Document')
+            self.assertEqual(len(perms), count)
+            ScopedNamedDocument.query.delete()
+            ScopedIdDocument.query.delete()
+            Container.query.delete()
+            self.session.commit()
+            return counter.count
+
+        self.assertEqual(listing_queries(2), listing_queries(10))
+        # Models without a parent are left alone
+        self.assertEqual(str(Container.query.with_parents()), str(Container.query))
+
+    def test_ancestor_path(self):
+        c1 = Container(name=u'c1', title=u'Container')
+        c2 = Container(name=u'c2', title=u'Other Container')
+        d1 = PathDocument(container=c1, title=u'Container Document')
+        d2 = PathDocument(container=c2, title=u'Other Document')
+        comment = PathComment(document=d1)
+        self.session.add_all([c1, c2, d1, d2, comment])
+        self.session.commit()
+        self.assertEqual(d1.ancestor_path, u'container:%d/' % c1.id)
+        self.assertEqual(comment.ancestor_path, u'container:%d/path_document:%d/' % (c1.id, d1.id))
+        self.assertEqual(comment.node_path, comment.ancestor_path + u'path_comment:%d/' % comment.id)
+        self.assertEqual(d1.ancestors(), [c1])
+
+        # Ancestors and inherited permissions are loaded in one query
+        comment_id = comment.id
+        self.session.expunge_all()
+        comment = PathComment.query.get(comment_id)
+        with QueryCounter() as counter:
+            ancestors = comment.ancestors()
+            self.assertEqual(comment.permissions(None), set())
+        self.assertEqual(counter.count, 1)
+        self.assertEqual([a.name for a in ancestors], [u'c1', u'document'])
+        c1, d1 = ancestors
+        c2 = Container.query.filter_by(name=u'c2').one()
+        self.assertEqual(d1.descendants(PathComment).all(), [comment])
+        self.assertEqual(PathDocument.query.filter_by(container=c2).one().descendants(PathComment).all(), [])
+
+        # Reparenting updates the paths of all descendants
+        d1.container = c2
+        self.session.commit()
+        self.assertEqual(d1.ancestor_path, u'container:%d/' % c2.id)
+        self.assertEqual(comment.ancestor_path, u'container:%d/path_document:%d/' % (c2.id, d1.id))
+        self.session.expunge_all()
+        comment = PathComment.query.get(comment_id)
+        self.assertEqual(comment.ancestor_path, u'container:%d/path_document:%d/' % (c2.id, d1.id))
+        self.assertEqual([a.name for a in comment.ancestors()], [u'c2', u'document'])
+
+        # Detached instances walk their loaded parents
+        self.assertEqual(comment.parent.parent.name, u'c2')
+        self.session.expunge(comment)
+        self.assertEqual([a.name for a in comment.ancestors()], [u'c2', u'document'])
+        self.assertEqual(comment.permissions(None), set())
+
 
 class TestCoasterModels2(TestCoasterModels):
     app = app2
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from datetime import datetime
+from decimal import Decimal
+from flask import Flask, json
+from markupsafe import Markup
+from coaster import msgpack
+from coaster.msgpack import packb, unpackb
+
+app = Flask(__name__)
+
+
+class TestMsgpack(unittest.TestCase):
+    def setUp(self):
+        self.ctx = app.test_request_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        self.ctx.pop()
+
+    def test_encoding(self):
+        for value, packed in [
+                (None, '\xc0'),
+                (True, '\xc3'),
+                (False, '\xc2'),
+                (1, '\x01'),
+                (-1, '\xff'),
+                (200, '\xcc\xc8'),
+                (-200, '\xd1\xff\x38'),
+                (70000, '\xce\x00\x01\x11\x70'),
+                (1.5, '\xcb\x3f\xf8\x00\x00\x00\x00\x00\x00'),
+                (u'é', '\xa2\xc3\xa9'),
+                ('a' * 40, '\xda\x00\x28' + 'a' * 40),
+                ([1, 2], '\x92\x01\x02'),
+                ({'a': 1}, '\x81\xa1a\x01'),
+                ]:
+            self.assertEqual(packb(value), packed)
+
+    def test_roundtrip(self):
+        values = [0, 127, 128, 255, 256, 65535, 65536, 2 ** 32 - 1, 2 ** 32, 2 ** 64 - 1,
+            -32, -33, -128, -129, -32768, -32769, -2 ** 31, -2 ** 31 - 1, -2 ** 63]
+        strings = [u'', u'a' * 31, u'a' * 32, u'a' * 255, u'a' * 256, u'a' * 65536, u'ünïcode']
+        data = {
+            u'integers': values,
+            u'strings': strings,
+            u'lists': [range(15), range(16), range(65536)],
+            u'maps': [dict((unicode(i), i) for i in range(count)) for count in (15, 16, 65536)],
+            u'nested': {u'list': [None, True, False, 1.25, {u'key': [u'value']}]},
+            }
+        self.assertEqual(unpackb(packb(data)), data)
+        self.assertRaises(OverflowError, packb, 2 ** 64)
+
+    def test_types(self):
+        """Types are encoded as in JSON responses"""
+        now = datetime(2014, 7, 1, 12, 30)
+        data = {
+            'datetime': now,
+            'decimal': Decimal('1.5'),
+            'markup': Markup(u'<b>bold</b>'),
+            'generator': (i for i in range(3)),
+            }
+        self.assertEqual(unpackb(packb(data)), {
+            'datetime': json.loads(json.dumps(now)),
+            'decimal': 1.5,
+            'markup': u'<b>bold</b>',
+            'generator': [0, 1, 2],
+            })
+        self.assertRaises(TypeError, packb, object())
+
+    def test_pure_python(self):
+        """The pure-Python encoder matches the C extension, if installed"""
+        if msgpack._msgpack is None:
+            return
+        data = {u'key': [1, -200, 1.5, u'é', None, True, 'a' * 40, Decimal('2.5')]}
+        c_packed = packb(data)
+        parts = []
+        msgpack._pack_dict(data, msgpack._make_default(), parts.append)
+        self.assertEqual(''.join(parts), c_packed)
@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import os
 import unittest
-from flask import Flask, Response
-from jinja2 import TemplateNotFound
-from coaster.views import render_with, jsonp
+import shutil
+from functools import wraps
+import tempfile
+from threading import Thread
+from time import sleep, time
+from flask import Flask, Response, request
+from jinja2 import TemplateNotFound, DictLoader
+from coaster.app import SandboxedFlask
+from coaster.views import render_with, jsonp, csvstream, ResponseCache, SingleFlight
+from coaster.msgpack import unpackb
 
 # --- Test setup --------------------------------------------------------------
 
@@ -60,6 +68,143 @@ def view_for_star():
     return {'data': 'value'}, 201
 
 
+@app.route('/renderedview6')
+@render_with({
+    'text/plain': viewcallable,
+    'text/html': returns_string}, json=False)
+def view_without_json():
+    return {'data': 'value'}
+
+
+@app.route('/renderedview7')
+@render_with('renderedview7.html')
+def view_with_default():
+    return {'data': 'value'}
+
+
+@app.route('/packedview')
+@render_with('packedview.html', msgpack=True)
+def packed_view():
+    return {'data': 'value', 'items': [1, 2, 3]}
+
+
+class Participant(object):
+    def __init__(self, fullname, email):
+        self.fullname = fullname
+        self.email = email
+
+
+@app.route('/participants')
+@render_with('participants.html', csv=True)
+def participants():
+    return {
+        'rows': (Participant(u"Participant %d ✓" % number, 'p%d@example.com' % number)
+            for number in xrange(5000)),
+        'columns': [('Name', 'fullname'), 'email', ('Domain', 'email.__class__.__name__')],
+        'filename': 'participants.csv',
+        }
+
+
+@app.route('/participants.csv')
+@render_with({'*/*': csvstream})
+def participants_csv():
+    return {
+        'rows': [{'name': u"Participant é ✓", 'count': 1}, {'name': None, 'count': 2}],
+        'columns': ['name', 'count'],
+        'encoding': 'latin-1',
+        }
+
+
+cached_calls = []
+fresh_cache = ResponseCache(timeout=60, vary=lambda: request.headers.get('X-User'))
+stale_cache = ResponseCache(timeout=0, stale=60)
+
+
+@app.route('/cachedview/<item>')
+@render_with({'text/plain': viewcallable}, cache=fresh_cache)
+def cached_view(item):
+    cached_calls.append(item)
+    return {'item': item, 'calls': len(cached_calls)}
+
+
+@app.route('/cachedview/<item>/missing')
+@render_with({'text/plain': viewcallable}, cache=fresh_cache)
+def cached_view_404(item):
+    cached_calls.append(item)
+    return {'item': item}, 404
+
+
+def counted(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        cached_calls.append('decorator')
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+@app.route('/staleview')
+@counted
+@render_with({'text/plain': viewcallable}, cache=stale_cache)
+def stale_view():
+    cached_calls.append('stale')
+    return {'calls': cached_calls.count('stale')}
+
+
+coalesced_calls = []
+
+
+@app.route('/coalescedview')
+@SingleFlight()
+def coalesced_view():
+    coalesced_calls.append('plain')
+    sleep(0.2)
+    return "Coalesced %d" % len(coalesced_calls)
+
+
+@app.route('/coalescedrender')
+@render_with({'text/plain': viewcallable}, coalesce=SingleFlight())
+def coalesced_render():
+    coalesced_calls.append(request.headers.get('Accept'))
+    sleep(0.2)
+    return {'calls': len(coalesced_calls)}
+
+
+streamed_templates = DictLoader({
+    'streamed.html': u'<ul>{% for item in items %}<li>{{ item }}</li>{% endfor %}</ul>',
+    })
+
+
+def make_streaming_app(app):
+    app.jinja_loader = streamed_templates
+
+    @app.route('/streamed')
+    @render_with({'text/html': 'streamed.html'}, stream=2)
+    def streamed():
+        return {'items': range(6)}, 201, {'X-Streamed': 'yes'}
+
+    @app.route('/streamed/any')
+    @render_with('streamed.html', stream=True)
+    def streamed_any():
+        return {'items': [u'<b>']}
+    return app
+
+streaming_app = make_streaming_app(Flask(__name__))
+sandboxed_app = make_streaming_app(SandboxedFlask(__name__))
+
+
+def concurrent_get(path, headers_list):
+    responses = [None] * len(headers_list)
+
+    def get(index, headers):
+        responses[index] = app.test_client().get(path, headers=headers)
+    threads = [Thread(target=get, args=(index, headers)) for index, headers in enumerate(headers_list)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return responses
+
+
 # --- Tests -------------------------------------------------------------------
 
 class TestLoadModels(unittest.TestCase):
@@ -105,5 +250,242 @@ class TestLoadModels(unittest.TestCase):
         self.assertTrue(isinstance(response, Response))
         resp = self.app.get('/renderedview4', headers=[('Accept', 'text/plain')])
         self.assertEqual(resp.headers['Referrer'], "http://example.com")
-        #resp = self.app.get('/renderedview5', headers=[('Accept', 'text/plain')])
-        #self.assertEqual(resp.status_code, 201)
+        resp = self.app.get('/renderedview5', headers=[('Accept', 'text/plain')])
+        self.assertEqual(resp.status_code, 201)
+
+    def test_negotiation(self):
+        """
+        Test that templates are chosen using quality values and wildcards.
+        """
+        for acceptheader, mimetype in [
+                ('text/plain', 'text/plain'),
+                ('text/plain;q=0.5,text/html', 'text/html'),
+                ('text/html;level=1;q=0.4,text/plain;q=0.5', 'text/plain'),
+                ('application/xml,text/*;q=0.9', 'text/html'),
+                ('text/*,text/plain;q=0.1', 'text/html'),
+                ('text/*,text/html;q=0', 'text/plain'),
+                ('*/*', 'text/html'),
+                ('*/*,text/plain', 'text/plain'),
+                ('application/json', None),
+                ('', None)]:
+            with app.test_request_context('/renderedview6', headers=[('Accept', acceptheader)]):
+                response = view_without_json()
+            if mimetype is None:
+                # No template matched, so the view's return value isn't rendered
+                self.assertEqual(response, {'data': 'value'})
+            else:
+                self.assertEqual(response.mimetype, mimetype, acceptheader)
+
+        # The default template is used unless another mimetype is preferred
+        for acceptheader, mimetype in [
+                ('text/html,application/xml;q=0.9,*/*;q=0.8', '*/*'),
+                ('application/json', 'application/json'),
+                ('application/json;q=0.5,text/html', '*/*'),
+                ('application/*', 'application/json'),
+                ('image/png', '*/*'),
+                ('', '*/*')]:
+            try:
+                response = self.app.get('/renderedview7', headers=[('Accept', acceptheader)])
+            except TemplateNotFound:
+                self.assertEqual(mimetype, '*/*', acceptheader)
+            else:
+                self.assertEqual(response.mimetype, mimetype, acceptheader)
+
+    def test_msgpack(self):
+        """
+        Test MessagePack responses.
+        """
+        response = self.app.get('/packedview', headers=[('Accept', 'application/x-msgpack')])
+        self.assertEqual(response.mimetype, 'application/x-msgpack')
+        self.assertEqual(unpackb(response.data), {'data': 'value', 'items': [1, 2, 3]})
+        response = self.app.get('/packedview', headers=[('Accept', 'application/json')])
+        self.assertEqual(response.mimetype, 'application/json')
+
+    def test_csv(self):
+        """
+        Test streamed CSV responses.
+        """
+        response = self.app.get('/participants', headers=[('Accept', 'text/csv')])
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.headers['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertEqual(response.headers['Content-Disposition'], 'attachment; filename="participants.csv"')
+        lines = response.data.splitlines()
+        self.assertEqual(len(lines), 5001)
+        self.assertEqual(lines[0], 'Name,email,Domain')
+        self.assertEqual(lines[1], 'Participant 0 ✓,p0@example.com,str')
+        self.assertEqual(lines[5000], 'Participant 4999 ✓,p4999@example.com,str')
+
+        response = self.app.get('/participants.csv')
+        self.assertEqual(response.headers['Content-Type'], 'text/csv; charset=latin-1')
+        self.assertFalse('Content-Disposition' in response.headers)
+        self.assertEqual(response.data, u'name,count\r\nParticipant é ?,1\r\n,2\r\n'.encode('latin-1'))
+
+    def test_response_cache(self):
+        """
+        Test cached rendering.
+        """
+        del cached_calls[:]
+        first = self.app.get('/cachedview/a', headers=[('Accept', 'text/plain')])
+        self.assertEqual(first.status_code, 200)
+        second = self.app.get('/cachedview/a', headers=[('Accept', 'text/plain')])
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second.headers['Content-Type'], first.headers['Content-Type'])
+        self.assertEqual(cached_calls, ['a'])
+        # View arguments, query strings, mimetypes and vary keys are cached separately
+        self.app.get('/cachedview/b', headers=[('Accept', 'text/plain')])
+        self.app.get('/cachedview/a?page=2', headers=[('Accept', 'text/plain')])
+        self.app.get('/cachedview/a', headers=[('Accept', 'application/json')])
+        self.app.get('/cachedview/a', headers=[('Accept', 'text/plain'), ('X-User', 'user1')])
+        self.assertEqual(cached_calls, ['a', 'b', 'a', 'a', 'a'])
+        # Only successful GET requests are cached
+        self.app.get('/cachedview/a/missing', headers=[('Accept', 'text/plain')])
+        self.app.get('/cachedview/a/missing', headers=[('Accept', 'text/plain')])
+        self.assertEqual(len(cached_calls), 7)
+        self.assertEqual(fresh_cache.stats['hits'], 1)
+        self.assertEqual(fresh_cache.stats['misses'], 7)
+        self.assertEqual(fresh_cache.hit_ratio, 1.0 / 8)
+        self.assertTrue(fresh_cache.stats['render_time_saved'] > 0)
+        # Rendering can still be bypassed
+        with app.test_request_context('/cachedview/a'):
+            self.assertEqual(cached_view('a', _render=False), {'item': 'a', 'calls': 8})
+
+    def test_response_cache_stale(self):
+        """
+        Test that stale cached responses are served while refreshing them.
+        """
+        del cached_calls[:]
+        first = self.app.get('/staleview', headers=[('Accept', 'text/plain')])
+        self.assertEqual(first.data, "{'calls': 1}")
+        second = self.app.get('/staleview', headers=[('Accept', 'text/plain')])
+        self.assertEqual(second.data, "{'calls': 1}")
+        for i in range(100):
+            if stale_cache.stats['refreshes']:
+                break
+            sleep(0.01)
+        self.assertEqual(stale_cache.stats['refreshes'], 1)
+        # The refresh dispatches the request again, through decorators above render_with
+        self.assertEqual(cached_calls, ['decorator', 'stale', 'decorator', 'decorator', 'stale'])
+        third = self.app.get('/staleview', headers=[('Accept', 'text/plain')])
+        self.assertEqual(third.data, "{'calls': 2}")
+        self.assertEqual(stale_cache.stats['stale'], 2)
+
+    def test_single_flight(self):
+        """
+        Test that concurrent requests are coalesced.
+        """
+        del coalesced_calls[:]
+        responses = concurrent_get('/coalescedview', [[]] * 5)
+        self.assertEqual(coalesced_calls, ['plain'])
+        self.assertEqual([r.data for r in responses], ["Coalesced 1"] * 5)
+        # Later requests compute again
+        self.assertEqual(self.app.get('/coalescedview').data, "Coalesced 2")
+
+        # render_with coalesces per mimetype
+        del coalesced_calls[:]
+        responses = concurrent_get('/coalescedrender',
+            [[('Accept', 'text/plain')]] * 3 + [[('Accept', 'application/json')]] * 3)
+        self.assertEqual(sorted(coalesced_calls), ['application/json', 'text/plain'])
+        self.assertEqual(len(set(r.data for r in responses[:3])), 1)
+        self.assertEqual(len(set(r.data for r in responses[3:])), 1)
+        self.assertEqual(responses[0].headers['Content-Type'], 'text/plain; charset=utf-8')
+        self.assertEqual(responses[3].headers['Content-Type'], 'application/json')
+
+    def test_single_flight_lockdir(self):
+        """
+        Test that computations are shared across processes with a lock directory.
+        """
+        lockdir = tempfile.mkdtemp()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            sleep(0.2)
+            return Response("Computed %d" % len(calls))
+
+        # Separate instances stand in for separate processes
+        flights = [SingleFlight(lockdir=lockdir) for i in range(4)]
+        responses = [None] * len(flights)
+
+        def run(index):
+            with app.test_request_context():
+                responses[index] = flights[index].run('key', compute)
+        try:
+            threads = [Thread(target=run, args=(index,)) for index in range(len(flights))]
+            threads[0].start()
+            sleep(0.05)
+            for thread in threads[1:]:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            # Lock files are removed when done, and responses when expired
+            self.assertEqual(os.listdir(lockdir), ['key.response'])
+            flight = SingleFlight(lockdir=lockdir, expires=0)
+            with app.test_request_context():
+                flight.run('other', lambda: Response(status=404))
+            self.assertEqual(os.listdir(lockdir), [])
+        finally:
+            shutil.rmtree(lockdir)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([r.data for r in responses], ["Computed 1"] * 4)
+
+    def test_single_flight_saved(self):
+        """
+        Test that saved responses are data, and that the lock directory must be private.
+        """
+        lockdir = tempfile.mkdtemp()
+        try:
+            response = Response(u"Body \u2014\n", headers=[('X-Name', u'\xe9')])
+            frozen = SingleFlight._freeze(response)
+            self.assertEqual(SingleFlight._load(SingleFlight._dump(frozen)), frozen)
+            for saved in ['', '{"status": 200}\n', '[200, [1]]\n', "cos\nsystem\n(S'true'\ntR."]:
+                self.assertRaises((ValueError, TypeError), SingleFlight._load, saved)
+
+            # Unreadable responses are ignored
+            with open(os.path.join(lockdir, 'key.response'), 'w') as f:
+                f.write("cos\nsystem\n(S'true'\ntR.")
+            # As if saved while waiting on the lock
+            os.utime(os.path.join(lockdir, 'key.response'), (time() + 60, time() + 60))
+            with app.test_request_context():
+                self.assertEqual(SingleFlight(lockdir=lockdir).run('key', lambda: Response("Computed")).data,
+                    "Computed")
+
+            os.chmod(lockdir, 0777)
+            self.assertRaises(ValueError, SingleFlight, lockdir=lockdir)
+            os.chmod(lockdir, 0700)
+            SingleFlight(lockdir=os.path.join(lockdir, 'new'))
+            self.assertEqual(os.stat(os.path.join(lockdir, 'new')).st_mode & 0777, 0700)
+        finally:
+            shutil.rmtree(lockdir)
+
+    def test_single_flight_session(self):
+        """
+        Test that requests are only coalesced within a session unless asked to.
+        """
+        keys = []
+        for cookie in ('session=a', 'session=b'):
+            with app.test_request_context('/coalescedview', headers=[('Cookie', cookie)]):
+                keys.append((SingleFlight().key(), SingleFlight(per_session=False).key()))
+        self.assertNotEqual(keys[0][0], keys[1][0])
+        self.assertEqual(keys[0][1], keys[1][1])
+
+    def test_stream(self):
+        """
+        Test that templates are rendered as a stream in chunks of the buffer size.
+        """
+        for streaming in (streaming_app, sandboxed_app):
+            with streaming.test_request_context('/streamed', headers=[('Accept', 'text/html')]):
+                response = streaming.make_response(streaming.view_functions['streamed']())
+                self.assertTrue(response.is_streamed)
+                self.assertEqual(response.status_code, 201)
+                self.assertEqual(response.headers['X-Streamed'], 'yes')
+                self.assertEqual(response.headers['Content-Type'], 'text/html; charset=utf-8')
+                chunks = list(response.response)
+            self.assertEqual(chunks[0], u'<ul><li>0</li>')
+            self.assertTrue(len(chunks) > 1)
+            self.assertEqual(u''.join(chunks),
+                u'<ul>' + u''.join(u'<li>%d</li>' % i for i in range(6)) + u'</ul>')
+
+            client = streaming.test_client()
+            response = client.get('/streamed/any')
+            self.assertEqual(response.data, '<ul><li>&lt;b&gt;</li></ul>')
+            self.assertEqual(response.headers['Content-Type'], 'text/html; charset=utf-8')
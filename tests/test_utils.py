@@ -3,6 +3,7 @@
 import datetime
 import unittest
 from coaster.utils import LabeledEnum, make_password, check_password, parse_isoformat, sanitize_html, sorted_timezones, namespace_from_url
+from coaster.utils import _sorted_timezones
 
 
 class MY_ENUM(LabeledEnum):
@@ -50,7 +51,18 @@ class TestCoasterUtils(unittest.TestCase):
         self.assertEqual(sanitize_html("<html><head><title>Test sanitize_html</title></head><p>P</p><body><!-- Body Comment-><p>Body</p></body></html>"), u'Test sanitize_html<p>P</p>')
 
     def test_sorted_timezones(self):
-        self.assertTrue(isinstance(sorted_timezones(), list))
+        timezones = sorted_timezones()
+        self.assertTrue(isinstance(timezones, list))
+        timezones.pop()
+        self.assertEqual(len(sorted_timezones()), len(timezones) + 1)
+
+    def test_sorted_timezones_dst(self):
+        # Offsets are those at the time in UTC. Daylight saving time on Lord Howe
+        # Island started at 15:30 UTC on 4 October 2014, on the half hour
+        labels = [dict(_sorted_timezones(datetime.datetime(2014, 10, 4, 15, minute)))['Australia/Lord_Howe']
+            for minute in (15, 30)]
+        self.assertTrue(labels[0].startswith(u'+10:30 - Australia: Australia/Lord Howe'))
+        self.assertTrue(labels[1].startswith(u'+11:00 - Australia: Australia/Lord Howe'))
 
     def test_namespace_from_url(self):
         self.assertEqual(namespace_from_url(u'https://github.com/hasgeek/coaster'), u'com.github')
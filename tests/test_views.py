@@ -3,7 +3,8 @@
 import unittest
 from flask import Flask, session, json
 from coaster.app import load_config_from_file
-from coaster.views import get_current_url, get_next_url, jsonp, requestargs, RequestTypeError, BadRequest
+from coaster.views import (get_current_url, get_next_url, jsonp, requestargs, RequestTypeError,
+    RequestValueError, BadRequest)
 
 
 def index():
@@ -24,6 +25,21 @@ def f1(p1, p2=None, p3=None):
     return p1, p2, p3
 
 
+@requestargs('p1', ('p2[]', int), source='json')
+def f_json(p1, p2=None):
+    return p1, p2
+
+
+@requestargs('p1', source='form')
+def f_form(p1=None):
+    return p1
+
+
+@requestargs('p1')
+def f_buggy(p1):
+    return len(p1, p1)
+
+
 class TestCoasterViews(unittest.TestCase):
     def setUp(self):
         self.app = Flask(__name__)
@@ -51,9 +67,17 @@ class TestCoasterViews(unittest.TestCase):
     def test_jsonp(self):
         with self.app.test_request_context('/?callback=callback'):
             kwargs = {'lang': 'en-us', 'query': 'python'}
+            r = jsonp(**kwargs)
+            response = 'callback({"%s":"%s","%s":"%s"});' % ('lang', kwargs['lang'], 'query', kwargs['query'])
+            self.assertEqual(response, r.data)
+
+        # Debug mode indents output
+        self.app.debug = True
+        with self.app.test_request_context('/?callback=callback'):
             r = jsonp(**kwargs)
             response = 'callback({\n  "%s": "%s",\n  "%s": "%s"\n});' % ('lang', kwargs['lang'], 'query', kwargs['query'])
             self.assertEqual(response, r.data)
+        self.app.debug = False
 
         with self.app.test_request_context('/'):
             param1, param2 = 1, 2
@@ -70,6 +94,34 @@ class TestCoasterViews(unittest.TestCase):
             self.assertEqual(resp['param1'], param1)
             self.assertEqual(resp['param2'], param2)
 
+    def test_jsonp_stream(self):
+        def numbers(count):
+            for number in xrange(count):
+                yield {'number': number}
+
+        with self.app.test_request_context('/'):
+            r = jsonp(numbers=numbers(5000), count=5000, empty=iter([]))
+            self.assertTrue(r.is_streamed)
+            chunks = list(r.response)
+        self.assertTrue(len(chunks) > 1)
+        resp = json.loads(''.join(chunks))
+        self.assertEqual(resp['count'], 5000)
+        self.assertEqual(resp['empty'], [])
+        self.assertEqual(resp['numbers'], [{'number': number} for number in xrange(5000)])
+
+        with self.app.test_request_context('/?callback=callback'):
+            r = jsonp(numbers=numbers(2))
+            self.assertEqual(r.mimetype, 'application/javascript')
+            self.assertEqual(r.get_data(), 'callback({"numbers":[{"number":0},{"number":1}]});')
+
+        # Keys are coerced to strings as in json.dumps
+        with self.app.test_request_context('/'):
+            r = jsonp({1: numbers(1), 2.5: 'float', False: 'false', None: 'null'})
+            self.assertTrue(r.is_streamed)
+            self.assertEqual(json.loads(r.get_data()),
+                {'1': [{'number': 0}], '2.5': 'float', 'false': 'false', 'null': 'null'})
+            self.assertRaises(TypeError, lambda: jsonp({(1, 2): numbers(1)}).get_data())
+
     def test_requestargs(self):
         with self.app.test_request_context('/?p3=1&p3=2&p2=3&p1=1'):
             self.assertEqual(f(), (u'1', 3, [1, 2]))
@@ -83,3 +135,31 @@ class TestCoasterViews(unittest.TestCase):
         with self.app.test_request_context('/?p2=2&p4=4'):
             self.assertRaises(TypeError, f, p4='4')
             self.assertRaises(BadRequest, f, p4='4')
+            self.assertRaises(RequestTypeError, f, p1='1', p4='4')
+            self.assertRaises(RequestTypeError, f)
+        with self.app.test_request_context('/?p2=x'):
+            self.assertRaises(RequestValueError, f, p1='1')
+
+        # TypeErrors inside the function are not recast
+        with self.app.test_request_context('/?p1=1'):
+            try:
+                f_buggy()
+            except TypeError, e:
+                self.assertFalse(isinstance(e, BadRequest))
+            else:
+                raise AssertionError("TypeError not raised")
+
+        with self.app.test_request_context('/?p1=1', method='POST', data=json.dumps({'p1': 'a', 'p2': ['1', 2]}),
+                content_type='application/json'):
+            self.assertEqual(f_json(), ('a', [1, 2]))
+        with self.app.test_request_context('/', method='POST', data=json.dumps({'p1': 'a', 'p2': '3'}),
+                content_type='application/json'):
+            self.assertEqual(f_json(), ('a', [3]))
+        with self.app.test_request_context('/', method='POST', data=json.dumps({'p1': 'a', 'p2': [1, None]}),
+                content_type='application/json'):
+            self.assertRaises(RequestValueError, f_json)
+        with self.app.test_request_context('/?p1=1', method='POST', data={'p1': '2'}):
+            self.assertEqual(f_form(), '2')
+        with self.app.test_request_context('/?p1=1'):
+            self.assertEqual(f_form(), None)
+        self.assertRaises(ValueError, requestargs, 'p1', source='cookies')
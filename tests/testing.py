@@ -1,5 +1,10 @@
 """
 Configuration used by coaster test suite
 """
+import os
+import tempfile
+
 TEST_KEY = 'test'
 ADMINS = ['test@example.com']
+# Keep the log written by coaster.logging.init_app out of the working directory
+LOGFILE = os.path.join(tempfile.gettempdir(), 'coaster-test-error.log')